@@ -7,14 +7,22 @@ Library functions for performing batch correction
 """
 from collections import Counter
 from itertools import izip
-import struct
 
+import h5py as h5
 import numpy as np
-from sklearn.metrics.pairwise import rbf_kernel
+import scipy.sparse as sp_sparse
 import sklearn.neighbors as sk_neighbors
 
+import cellranger.analysis.neighbors as cr_neighbors
+
 DEFAULT_BALLTREE_LEAFSIZE = 40
 
+# Gaussian kernel weights exp(-x) are exactly zero in double precision beyond this x
+MAX_KERNEL_EXPONENT = 746.0
+
+BATCH_NN_BATCH_ID_ATTR = 'batch_id'
+BATCH_NN_BATCH_START_ATTR = 'batch_start'
+
 
 def batch_effect_score(dimred_matrix, batch_ids, knn=100, subsample=0.1):
     """
@@ -32,19 +40,18 @@ def batch_effect_score(dimred_matrix, batch_ids, knn=100, subsample=0.1):
         batch: count * 1.0 / sum(counter.values()) for batch, count in counter.iteritems()
     }
 
-    # BallTree for KNN
-    balltree = sk_neighbors.BallTree(dimred_matrix, leaf_size=DEFAULT_BALLTREE_LEAFSIZE)
+    neighbor_index = cr_neighbors.build_neighbor_index(dimred_matrix)
 
     np.random.seed(0)
     select_bc_idx = np.array([i for i in range(num_bcs) if np.random.uniform() < subsample])
 
     num_nn = min(select_bc_idx.shape[0] - 1, knn)
-    knn_idx = balltree.query(dimred_matrix[select_bc_idx], k=num_nn + 1, return_distance=False)
+    knn_idx, _ = cr_neighbors.query_knn(neighbor_index, dimred_matrix[select_bc_idx], num_nn)
 
     same_batch_ratio = []
     for bc, neighbors in izip(select_bc_idx, knn_idx):
         batch_id = batch_ids[bc]
-        same_batch = len([i for i in neighbors[1:] if batch_ids[i] == batch_id])
+        same_batch = len([i for i in neighbors if batch_ids[i] == batch_id])
         same_batch_ratio.append((same_batch * 1.0 / num_nn) / batch_to_percentage[batch_id])
 
     return np.mean(same_batch_ratio)
@@ -62,48 +69,66 @@ def find_knn(curr_matrix, ref_matrix, knn):
     return nn_idx.ravel().astype(int)
 
 
-def serialize_batch_nearest_neighbor(fp, batch_nearest_neighbor):
-    for (a, b), s in batch_nearest_neighbor.iteritems():
-        fp.write(struct.pack("qqQ", a, b, len(s)))
-        for i, j in s:
-            fp.write(struct.pack("qq", i, j))
+def save_batch_nearest_neighbor(filename, batch_id, batch_start, batch_nearest_neighbor):
+    """
+    Save the nearest neighbors of the barcodes of one batch in each other batch
+    to HDF5. batch_nearest_neighbor maps each other batch id to an int32 array
+    with one row per barcode of batch_id (starting at global index batch_start)
+    holding the global indices of its nearest neighbors in that batch.
+    """
+    with h5.File(filename, 'w') as f:
+        f.attrs[BATCH_NN_BATCH_ID_ATTR] = batch_id
+        f.attrs[BATCH_NN_BATCH_START_ATTR] = batch_start
+        for other_batch_id, nn_idx in batch_nearest_neighbor.iteritems():
+            f.create_dataset(str(other_batch_id), data=nn_idx.astype(np.int32, copy=False))
+
+
+def load_batch_nearest_neighbor(filename):
+    """
+    Load a file written by save_batch_nearest_neighbor.
+
+    Returns:
+        (int, int, dict): batch id, global index of its first barcode and
+            the nearest neighbor array for each other batch id.
+    """
+    with h5.File(filename, 'r') as f:
+        batch_id = int(f.attrs[BATCH_NN_BATCH_ID_ATTR])
+        batch_start = int(f.attrs[BATCH_NN_BATCH_START_ATTR])
+        batch_nearest_neighbor = {int(key): f[key][:] for key in f}
+    return batch_id, batch_start, batch_nearest_neighbor
 
 
-def deserialize_batch_nearest_neighbor(fp):
+def find_mutual_nearest_neighbor(nn_ij, start_i, nn_ji, start_j):
     """
-    >>> from cStringIO import StringIO
-    >>> batch1 = dict()
-    >>> batch1[(0, 1)] = set([(1, 2), (3, 4), (5, 6)])
-    >>> batch1[(1, 2)] = set([(7, 8), (9, 10)])
-    >>> batch1[(3, 4)] = set([(11, 12)])
-    >>> fp = StringIO()
-    >>> serialize_batch_nearest_neighbor(fp, batch1)
-    >>> fp.seek(0)
-    >>> batch2 = deserialize_batch_nearest_neighbor(fp)
-    >>> batch1 == batch2
-    True
+    Find the mutual nearest neighbor pairs between batches i and j with a
+    sorted-array join on pair keys.
+
+    Args:
+        nn_ij (np.ndarray): Global indices of the neighbors in batch j of each
+            barcode of batch i, one row per barcode of batch i.
+        start_i (int): Global index of the first barcode of batch i.
+        nn_ji (np.ndarray): Same as nn_ij, with batches i and j swapped.
+        start_j (int): Global index of the first barcode of batch j.
+
+    Returns:
+        (np.ndarray, np.ndarray): Global indices of the paired barcodes in batch i
+            and batch j, sorted by barcode of batch i.
+
+    >>> nn_ij = np.array([[3, 4], [4, 3], [3, 4]])
+    >>> nn_ji = np.array([[0, 2], [2, 1]])
+    >>> find_mutual_nearest_neighbor(nn_ij, 0, nn_ji, 3)
+    (array([0, 1, 2, 2]), array([3, 4, 3, 4]))
     """
-    batch_nearest_neighbor = {}
-    while True:
-        fmt = "qqQ"
-        sz = struct.calcsize("qqQ")
-        buf = fp.read(sz)
-        if len(buf) == 0:
-            break
-        elif len(buf) != sz:
-            raise RuntimeError("corrupted batch_nearest_neighbor stream (key)")
-        a, b, slen = struct.unpack(fmt, buf)
-        fmt = "qq"
-        sz = struct.calcsize("qq")
-        s = set()
-        for _ in xrange(slen):
-            buf = fp.read(sz)
-            if len(buf) != sz:
-                raise RuntimeError("corrupted batch_nearest_neighbor stream (set)")
-            i, j = struct.unpack(fmt, buf)
-            s.add((i, j))
-        batch_nearest_neighbor[(a, b)] = s
-    return batch_nearest_neighbor
+    num_keys = max(start_i + nn_ij.shape[0], start_j + nn_ji.shape[0])
+    idx_i = np.arange(start_i, start_i + nn_ij.shape[0], dtype=np.int64)
+    idx_j = np.arange(start_j, start_j + nn_ji.shape[0], dtype=np.int64)
+
+    # Key each (barcode in i, barcode in j) pair by a single integer
+    keys_ij = np.repeat(idx_i, nn_ij.shape[1]) * num_keys + nn_ij.ravel()
+    keys_ji = nn_ji.ravel().astype(np.int64) * num_keys + np.repeat(idx_j, nn_ji.shape[1])
+    mutual = np.intersect1d(keys_ij, keys_ji, assume_unique=True)
+
+    return mutual // num_keys, mutual % num_keys
 
 
 def correction_vector(dimred_matrix, cur_submatrix_idx, mnn_cur_idx, mnn_ref_idx, sigma):
@@ -116,33 +141,42 @@ def correction_vector(dimred_matrix, cur_submatrix_idx, mnn_cur_idx, mnn_ref_idx
     2. For each barcode in cur dataset, a batch-correction vector is calculated
     as a weighted average of these pair-specific vectors, as computed with a
     Gaussian kernel.
+
+    The kernel weight of a pair only depends on its cell in the current dataset,
+    so the pair-specific vectors are first summed per cell. Each barcode then
+    only visits the MNN cells close enough to get a weight that is nonzero in
+    double precision, which keeps the cost linear in the number of barcodes.
     """
     num_pcs = dimred_matrix.shape[1]
-    corr_vector = np.zeros((0, num_pcs))
+    gamma = 0.5 * sigma
 
-    # the number of mnn and submatrix dim might be very large, process by chunk to save memory
-    cur_submatrix_size = len(cur_submatrix_idx)
-    mnn_size = len(mnn_cur_idx)
-    # based on empirical testing
-    cur_submatrix_chunk_size = int(1e6 / num_pcs)
-    mnn_chunk_size = int(2e7 / num_pcs)
+    # sum the pair-specific vectors and count the pairs of each MNN cell in cur dataset
+    mnn_cur_idx = np.asarray(mnn_cur_idx)
+    mnn_ref_idx = np.asarray(mnn_ref_idx)
+    anchors, pair_anchors, anchor_pairs = np.unique(mnn_cur_idx, return_inverse=True, return_counts=True)
+    bias = dimred_matrix[mnn_ref_idx] - dimred_matrix[mnn_cur_idx]
+    anchor_bias = np.column_stack([np.bincount(pair_anchors, weights=bias[:, pc], minlength=len(anchors))
+                                   for pc in xrange(num_pcs)])
 
-    for i in range(0, cur_submatrix_size, cur_submatrix_chunk_size):
-        cur_submatrix_chunk = cur_submatrix_idx[i : i + cur_submatrix_chunk_size]
-        cur_submatrix = dimred_matrix[cur_submatrix_chunk]
+    balltree = sk_neighbors.BallTree(dimred_matrix[anchors], leaf_size=DEFAULT_BALLTREE_LEAFSIZE)
+    radius = np.sqrt(MAX_KERNEL_EXPONENT / gamma)
 
-        weighted_sum, weights_sum = np.zeros(cur_submatrix.shape), np.zeros(cur_submatrix.shape)
-
-        for j in xrange(0, mnn_size, mnn_chunk_size):
-            mnn_cur_chunk = mnn_cur_idx[j : j + mnn_chunk_size]
-            mnn_ref_chunk = mnn_ref_idx[j : j + mnn_chunk_size]
-
-            mnn_cur = dimred_matrix[mnn_cur_chunk]
-            weights = rbf_kernel(cur_submatrix, mnn_cur, gamma=0.5 * sigma)
-            bias = dimred_matrix[mnn_ref_chunk] - mnn_cur
-            weighted_sum += np.dot(weights, bias)
-            weights_sum += np.tile(np.sum(weights, axis=1), (num_pcs, 1)).T
-
-        corr_vector = np.vstack((corr_vector, weighted_sum / weights_sum))
+    corr_vector = np.empty((len(cur_submatrix_idx), num_pcs))
+    # the number of barcodes might be very large, process by chunk to save memory
+    cur_submatrix_chunk_size = int(1e6 / num_pcs)
+    for i in xrange(0, len(cur_submatrix_idx), cur_submatrix_chunk_size):
+        cur_submatrix = dimred_matrix[cur_submatrix_idx[i : i + cur_submatrix_chunk_size]]
+        neighbors, distances = balltree.query_radius(cur_submatrix, radius, return_distance=True)
+
+        num_neighbors = np.fromiter((len(n) for n in neighbors), dtype=np.int64, count=len(neighbors))
+        rows = np.repeat(np.arange(len(neighbors)), num_neighbors)
+        cols = np.concatenate(neighbors) if len(neighbors) > 0 else np.zeros(0, dtype=int)
+        dists = np.concatenate(distances) if len(distances) > 0 else np.zeros(0)
+        weights = sp_sparse.csr_matrix((np.exp(-gamma * np.square(dists)), (rows, cols)),
+                                       shape=(len(neighbors), len(anchors)))
+
+        weighted_sum = weights.dot(anchor_bias)
+        weights_sum = weights.dot(anchor_pairs.astype(np.float64))
+        corr_vector[i : i + len(neighbors)] = weighted_sum / weights_sum[:, np.newaxis]
 
     return corr_vector
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2019 10X Genomics, Inc. All rights reserved.
+#
+
+"""
+Randomized block Krylov SVD, an alternative to irlb for large matrices.
+
+Instead of one matrix-vector product per Lanczos step, each iteration multiplies the
+matrix by a block of vectors at once, so the matrix is traversed only a few times
+and each product can be split across threads. See:
+
+    Randomized Block Krylov Methods for Stronger and Faster Approximate Singular Value Decomposition,
+    C. Musco and C. Musco, NIPS 2015
+"""
+
+import numpy as np
+import scipy.linalg
+
+def scaled_dot(A, X, center=None, scale=None, transpose=False):
+    """ Multiply a block of vectors by the implicitly centered and scaled matrix
+    (A - center) / scale, using the same semantics as irlb.
+
+    Args:
+        A: Matrix or operator with dot and transpose methods, of dimension j * k.
+        X (np.ndarray): Block of vectors, of dimension k * l (j * l if transpose).
+        center (np.ndarray): Length k vector subtracted from each row of A.
+        scale (np.ndarray): Length k vector dividing each column of A.
+        transpose (bool): Multiply by the transpose of the centered and scaled matrix.
+
+    Returns:
+        np.ndarray: Product of dimension j * l (k * l if transpose).
+    """
+    if transpose:
+        Y = np.asarray(A.transpose().dot(X))
+        if center is not None:
+            Y = Y - np.outer(center, X.sum(axis=0))
+        if scale is not None:
+            Y = Y / scale[:, np.newaxis]
+        return Y
+
+    if scale is not None:
+        X = X / scale[:, np.newaxis]
+    Y = np.asarray(A.dot(X))
+    if center is not None:
+        Y = Y - center.dot(X)[np.newaxis, :]
+    return Y
+
+
+def _orthonormalize(X, Q=None):
+    """ Orthonormal basis of the columns of X, made orthogonal to the orthonormal columns of Q """
+    if Q is not None and Q.shape[1] > 0:
+        # Project twice, so that rounding errors don't reintroduce components along Q
+        for _ in xrange(2):
+            X = X - Q.dot(Q.T.dot(X))
+    return scipy.linalg.qr(X, mode='economic', overwrite_a=True, check_finite=False)[0]
+
+
+def _ritz(Q, Z, n):
+    """ Rayleigh-Ritz approximation of the top n singular triplets from an orthonormal
+    basis Q of right singular vectors and Z = A^T A Q.
+
+    Returns the singular values, right singular vectors and the relative residuals
+    |A^T A v_i / d_i - d_i v_i| / d_1, i.e. |A^T u_i - d_i v_i| / d_1 for u_i = A v_i / d_i.
+    """
+    C = Q.T.dot(Z)
+    (w, y) = scipy.linalg.eigh((C + C.T) / 2, check_finite=False)
+    order = np.argsort(w)[::-1][0:n]
+    w, y = w[order], y[:, order]
+    d = np.sqrt(np.maximum(w, 0))
+    safe_d = np.where(d > 0, d, 1)
+    R = Z.dot(y) / safe_d[np.newaxis, :] - Q.dot(y) * d[np.newaxis, :]
+    residuals = np.linalg.norm(R, axis=0) / max(d[0], np.finfo(d.dtype).tiny)
+    return d, Q.dot(y), residuals
+
+
+def block_krylov_svd(A, n, n_iter=4, tol=None, max_iter=None, n_oversamples=10, center=None, scale=None,
+                     random_state=0, dtype=np.float64):
+    """Estimate a few of the largest singular values and corresponding singular
+    vectors of a matrix by randomized block Krylov iteration.
+
+    The Krylov basis is kept in the space of the columns of A, so its size grows with
+    the number of columns rather than rows. Each iteration traverses the matrix twice.
+
+    Keyword arguments:
+    n_iter        -- Number of iterations, or the minimum number of iterations if tol is given.
+    tol           -- Stop once the largest relative residual |A^T u - d v| / d_1 is at most tol.
+                     If None, run exactly n_iter iterations.
+    max_iter      -- Maximum number of iterations when tol is given (4 * n_iter if None).
+    n_oversamples -- Number of extra vectors in the random block beyond n.
+    center        -- As in irlb.
+    scale         -- As in irlb.
+    dtype         -- Type of the Krylov basis. Use np.float32 to halve its memory footprint.
+
+    Returns a tuple with the same entries as irlb: the left singular vectors, the
+    singular values, the right singular vectors, the number of iterations and the
+    number of matrix-block products.
+    """
+    if center is not None and not isinstance(center, np.ndarray):
+        raise TypeError("center must be a numpy.ndarray")
+    if scale is not None and not isinstance(scale, np.ndarray):
+        raise TypeError("scale must be a numpy.ndarray")
+    if min(A.shape) < 2:
+        raise ValueError("The input matrix must be at least 2x2.")
+    if max_iter is None:
+        max_iter = n_iter if tol is None else 4 * n_iter
+
+    rng = np.random.RandomState(random_state)
+    num_cols = A.shape[1]
+    block_size = min(n + n_oversamples, min(A.shape))
+    max_basis = min(num_cols, block_size * (max_iter + 1))
+
+    # Orthonormal Krylov basis Q = [X, (A^T A) X, ..., (A^T A)^q X] and Z = A^T A Q
+    Q = np.empty((num_cols, max_basis), dtype=dtype)
+    Z = np.empty((num_cols, max_basis), dtype=dtype)
+    X = rng.standard_normal((num_cols, block_size)).astype(dtype)
+    basis_size = 0
+    mprod = 0
+    it = 0
+    while True:
+        X = _orthonormalize(X, Q[:, 0:basis_size])[:, 0:(max_basis - basis_size)]
+        new_size = basis_size + X.shape[1]
+        Q[:, basis_size:new_size] = X
+        Z[:, basis_size:new_size] = scaled_dot(A, scaled_dot(A, X, center, scale), center, scale, transpose=True)
+        mprod += 2
+        X = Z[:, basis_size:new_size]
+        basis_size = new_size
+
+        if it >= n_iter or basis_size == max_basis:
+            (d, V, residuals) = _ritz(Q[:, 0:basis_size], Z[:, 0:basis_size], n)
+            if tol is None or residuals.max() <= tol or it >= max_iter or basis_size == max_basis:
+                break
+        it += 1
+
+    U = scaled_dot(A, V, center, scale) / np.where(d > 0, d, 1)[np.newaxis, :]
+    mprod += 1
+    return (U, d, V, it, mprod)
+
+
+def get_svd_residuals(A, U, d, V, center=None, scale=None):
+    """ Relative residuals of an approximate SVD, the larger of |A v_i - d_i u_i| / d_1 and
+    |A^T u_i - d_i v_i| / d_1, the quantities irlb compares against its tolerance to decide convergence. """
+    R = scaled_dot(A, V, center, scale) - U * d[np.newaxis, :]
+    Rt = scaled_dot(A, U, center, scale, transpose=True) - V * d[np.newaxis, :]
+    return np.maximum(np.linalg.norm(R, axis=0), np.linalg.norm(Rt, axis=0)) / d[0]
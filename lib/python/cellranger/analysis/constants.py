@@ -45,6 +45,11 @@ PCA_N_COMPONENTS_DEFAULT = 10
 NUM_IRLB_MATRIX_ENTRIES_PER_MEM_GB = 10e6  # based on empirical testing
 IRLB_BASE_MEM_GB = 1
 ANALYSIS_H5_PCA_GROUP = 'pca'
+PCA_ENGINE_IRLB = 'irlb'
+PCA_ENGINE_BLOCK_KRYLOV = 'block_krylov'
+PCA_BLOCK_KRYLOV_MIN_NNZ = 1e6  # inputs this large use block Krylov iteration by default (see pca.get_pca_engine)
+PCA_BLOCK_KRYLOV_N_ITER = 4  # minimum number of block Krylov iterations
+PCA_BLOCK_KRYLOV_MAX_ITER = 30  # irlb runs instead if block Krylov hasn't converged by then
 
 # chemistry batch correction
 # this upper limit was determined via testing,
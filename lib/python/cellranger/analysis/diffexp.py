@@ -4,6 +4,7 @@
 #
 
 import collections
+import multiprocessing
 import numpy as np
 import os
 import pandas as pd
@@ -19,6 +20,9 @@ import cellranger.io as cr_io
 
 SSEQ_ZETA_QUANTILE = 0.995
 
+# Maximum number of NB probabilities evaluated at once by nb_exact_test_batch
+EXACT_TEST_BATCH_SIZE = 1 << 20
+
 DIFFERENTIAL_EXPRESSION = collections.namedtuple('DIFFERENTIAL_EXPRESSION', ['data'])
 
 def estimate_size_factors(x):
@@ -179,6 +183,105 @@ def nb_exact_test(x_a, x_b, size_factor_a, size_factor_b, mu, phi):
 
     return np.exp(logsumexp(log_p_all[more_extreme]) - logsumexp(log_p_all))
 
+def nb_exact_test_batch(x_a, x_b, size_factor_a, size_factor_b, mu, phi, memo=None):
+    """ Compute p-values for many pairwise exact tests using the negative binomial.
+    Equivalent to calling nb_exact_test on each element, but the conditional
+    distributions of all tests are evaluated together as one ragged array.
+    Args:
+      x_a (np.array(int)) - Total count in group A, one per test
+      x_b (np.array(int)) - Total count in group B, one per test
+      size_factor_a (float/np.array) - Sum of size factors for group A
+      size_factor_b (float/np.array) - Sum of size factors for group B
+      mu (np.array(float)) - Common mean count, one per test
+      phi (np.array(float)) - Common dispersion, one per test
+      memo (dict) - Optional cache of p-values keyed by test inputs; updated in place.
+    Returns:
+      p-values (np.array) """
+    x_a = np.array(x_a, ndmin=1, copy=False).astype(np.int64)
+    x_b = np.array(x_b, ndmin=1, copy=False).astype(np.int64)
+    size_factor_a = np.broadcast_to(np.asarray(size_factor_a, dtype=np.float64), x_a.shape)
+    size_factor_b = np.broadcast_to(np.asarray(size_factor_b, dtype=np.float64), x_a.shape)
+    mu = np.broadcast_to(np.asarray(mu, dtype=np.float64), x_a.shape)
+    phi = np.broadcast_to(np.asarray(phi, dtype=np.float64), x_a.shape)
+
+    p_values = np.ones(len(x_a))
+    todo = np.flatnonzero(((x_a + x_b) > 0) & (phi != 0) &
+                          (size_factor_a != 0) & (size_factor_b != 0))
+    if len(todo) == 0:
+        return p_values
+
+    # Collapse repeated tests so each distinct input is only evaluated once
+    inputs = np.column_stack((x_a[todo].astype(np.float64), x_b[todo].astype(np.float64),
+                              size_factor_a[todo], size_factor_b[todo], mu[todo], phi[todo]))
+    inputs, inverse = np.unique(inputs, axis=0, return_inverse=True)
+    unique_p = np.full(len(inputs), np.nan)
+
+    if memo is not None:
+        keys = map(tuple, inputs)
+        for i, key in enumerate(keys):
+            unique_p[i] = memo.get(key, np.nan)
+
+    pending = np.flatnonzero(np.isnan(unique_p))
+    lengths = (inputs[pending, 0] + inputs[pending, 1] + 1).astype(np.int64)
+
+    # Split the pending tests into batches of bounded total length
+    cum_lengths = np.cumsum(lengths)
+    start = 0
+    while start < len(pending):
+        offset = cum_lengths[start - 1] if start > 0 else 0
+        stop = max(start + 1, np.searchsorted(cum_lengths, offset + EXACT_TEST_BATCH_SIZE, side='right'))
+        idx = pending[start:stop]
+        unique_p[idx] = _nb_exact_test_ragged(inputs[idx], lengths[start:stop])
+        start = stop
+
+    if memo is not None:
+        for i in pending:
+            memo[keys[i]] = unique_p[i]
+
+    p_values[todo] = unique_p[inverse]
+    return p_values
+
+def _nb_exact_test_ragged(inputs, lengths):
+    """ Evaluate a batch of exact NB tests. Test t covers the counts 0..x_a+x_b
+    of its conditional distribution, laid out contiguously in one flat array.
+    Args:
+      inputs (np.array) - Rows of (x_a, x_b, size_factor_a, size_factor_b, mu, phi)
+      lengths (np.array(int)) - x_a + x_b + 1 for each row
+    Returns:
+      p-values (np.array) """
+    x_a, x_b, sa, sb, mu, phi = inputs.T
+    x = x_a + x_b
+    r = 1.0 / phi
+
+    starts = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    test_idx = np.repeat(np.arange(len(lengths)), lengths)
+    all_k = np.arange(lengths.sum()) - starts[test_idx]
+    rev_k = (lengths - 1)[test_idx] - all_k
+    all_x = all_k.astype(np.float64)
+    rev_x = rev_k.astype(np.float64)
+
+    # log(k!) for every count in the batch, looked up from a shared table
+    log_factorial = gammaln(np.arange(1, np.max(lengths) + 1, dtype=np.float64))
+
+    const = x * np.log(mu / (r + mu)) + (sa + sb) * np.log(r / (r + mu)) - gammaln(sa * r) - gammaln(sb * r)
+    log_p_all = gammaln((sa * r)[test_idx] + all_x) + gammaln((sb * r)[test_idx] + rev_x) - \
+        (log_factorial[all_k] + log_factorial[rev_k])
+    log_p_all += const[test_idx]
+
+    log_p_obs = log_p_all[starts + x_a.astype(np.int64)]
+    more_extreme = log_p_all <= log_p_obs[test_idx]
+
+    # Segmented log-sum-exp over each test's distribution
+    max_all = np.maximum.reduceat(log_p_all, starts)
+    scaled = np.exp(log_p_all - max_all[test_idx])
+    sum_all = np.add.reduceat(scaled, starts)
+    sum_extreme = np.add.reduceat(np.where(more_extreme, scaled, 0.0), starts)
+
+    p_values = sum_extreme / sum_all
+    p_values[np.add.reduceat(more_extreme.astype(np.int64), starts) == 0] = 0.0
+    return p_values
+
 def nb_asymptotic_test(x_a, x_b, size_factor_a, size_factor_b, mu, phi):
     """ Compute p-value for a pairwise exact test using a fast beta approximation
     to the conditional joint distribution of (x_a, x_b).
@@ -245,19 +348,37 @@ def sseq_differential_expression(x, cond_a, cond_b, sseq_params, big_count=900):
     x_a = x[:, cond_a]
     x_b = x[:, cond_b]
 
-    # Number of features
-    G = x.shape[0]
-
     # Size factors
     size_factor_a = np.sum(sseq_params['size_factors'][cond_a])
     size_factor_b = np.sum(sseq_params['size_factors'][cond_b])
 
-    # Compute p-value for each feature
-    p_values = np.ones(G)
-
     feature_sums_a = np.squeeze(np.asarray(x_a.sum(axis=1)))
     feature_sums_b = np.squeeze(np.asarray(x_b.sum(axis=1)))
 
+    return sseq_differential_expression_from_sums(feature_sums_a, feature_sums_b,
+                                                  size_factor_a, size_factor_b,
+                                                  sseq_params, big_count=big_count)
+
+def sseq_differential_expression_from_sums(feature_sums_a, feature_sums_b,
+                                           size_factor_a, size_factor_b,
+                                           sseq_params, big_count=900, memo=None):
+    """ Run sSeq pairwise differential expression test on precomputed group totals.
+      Args:
+        feature_sums_a (np.array): Total count of each feature in group A
+        feature_sums_b (np.array): Total count of each feature in group B
+        size_factor_a (float): Sum of size factors for group A
+        size_factor_b (float): Sum of size factors for group B
+        sseq_params (dict): Precomputed global parameters
+        big_count (int): Use asymptotic approximation if both counts > this
+        memo (dict): Optional cache of exact test p-values (see nb_exact_test_batch)
+      Returns:
+        A pd.DataFrame with DE results for group A relative to group B """
+    # Number of features
+    G = len(feature_sums_a)
+
+    # Compute p-value for each feature
+    p_values = np.ones(G)
+
     big = tk_stats.numpy_logical_and_list([sseq_params['use_g'], feature_sums_a > big_count, feature_sums_b > big_count])
     small = np.logical_and(sseq_params['use_g'], np.logical_not(big))
 
@@ -265,11 +386,11 @@ def sseq_differential_expression(x, cond_a, cond_b, sseq_params, big_count=900):
                      (np.sum(small), np.sum(big)))
 
     # Compute exact test for small-count features
-    for i in np.flatnonzero(small):
-        p_values[i] = nb_exact_test(feature_sums_a[i], feature_sums_b[i],
-                                    size_factor_a, size_factor_b,
-                                    sseq_params['mean_g'][i],
-                                    sseq_params['phi_g'][i])
+    p_values[small] = nb_exact_test_batch(feature_sums_a[small], feature_sums_b[small],
+                                          size_factor_a, size_factor_b,
+                                          sseq_params['mean_g'][small],
+                                          sseq_params['phi_g'][small],
+                                          memo=memo)
     # Compute asymptotic approximation for big-count features
     p_values[big] = nb_asymptotic_test(feature_sums_a[big],
                                        feature_sums_b[big],
@@ -298,12 +419,47 @@ def sseq_differential_expression(x, cond_a, cond_b, sseq_params, big_count=900):
 
     return de_result
 
-
-def run_differential_expression(matrix, clusters, sseq_params=None):
+def sum_features_by_cluster(x, clusters, n_clusters):
+    """ Sum counts of every feature within every cluster in one sparse product.
+      Args:
+        x - Sparse matrix (csc) of counts (feature x cell)
+        clusters (np.array(int)): 1-based cluster labels, one per cell
+        n_clusters (int): Number of clusters
+      Returns:
+        np.array of shape (features, n_clusters) """
+    n_cells = len(clusters)
+    indicator = scipy.sparse.csc_matrix((np.ones(n_cells, dtype=np.float64),
+                                         (np.arange(n_cells), clusters - 1)),
+                                        shape=(n_cells, n_clusters))
+    return np.asarray((x * indicator).todense())
+
+def _cluster_differential_expression(job_args):
+    """ Compute DE results for a group of clusters vs all other cells.
+      Args:
+        job_args (tuple): (cluster sums, rest sums, cluster size factors,
+                           rest size factors, sseq_params)
+      Returns:
+        np.array with 3 columns (mean, log2, adjusted p-value) per cluster """
+    sums_a, sums_b, size_factors_a, size_factors_b, sseq_params = job_args
+
+    # Exact tests are memoized across the clusters handled by this job
+    memo = {}
+    results = np.zeros((sums_a.shape[0], 3 * sums_a.shape[1]))
+    for i in xrange(sums_a.shape[1]):
+        de_result = sseq_differential_expression_from_sums(
+            sums_a[:, i], sums_b[:, i], size_factors_a[i], size_factors_b[i],
+            sseq_params, memo=memo)
+        results[:, 0 + 3 * i] = de_result['norm_mean_a']
+        results[:, 1 + 3 * i] = de_result['log2_fold_change']
+        results[:, 2 + 3 * i] = de_result['adjusted_p_value']
+    return results
+
+def run_differential_expression(matrix, clusters, sseq_params=None, num_procs=1):
     """ Compute differential expression for each cluster vs all other cells
         Args: matrix      - GeneBCMatrix  :  feature expression data
               clusters    - np.array(int) :  1-based cluster labels
-              sseq_params - dict          :  params from compute_sseq_params """
+              sseq_params - dict          :  params from compute_sseq_params
+              num_procs   - int           :  number of processes to spread clusters over """
 
     n_clusters = np.max(clusters)
 
@@ -312,22 +468,35 @@ def run_differential_expression(matrix, clusters, sseq_params=None):
         sys.stdout.flush()
         sseq_params = compute_sseq_params(matrix.m)
 
+    # Per-cluster feature sums and size factors; "rest" is everything else
+    print 'Computing feature sums for %d clusters...' % n_clusters
+    sys.stdout.flush()
+    sums_a = sum_features_by_cluster(matrix.m, clusters, n_clusters)
+    sums_b = np.squeeze(np.asarray(matrix.m.sum(axis=1)))[:, np.newaxis] - sums_a
+    size_factors_a = np.bincount(clusters - 1, weights=sseq_params['size_factors'],
+                                 minlength=n_clusters)
+    size_factors_b = np.sum(sseq_params['size_factors']) - size_factors_a
+
     # Create a numpy array with 3*K columns;
     # each group of 3 columns is mean, log2, pvalue for cluster i
-    all_de_results = np.zeros((matrix.features_dim, 3 * n_clusters))
+    num_jobs = max(1, min(num_procs, n_clusters))
+    job_clusters = np.array_split(np.arange(n_clusters), num_jobs)
+    job_args = [(sums_a[:, c], sums_b[:, c], size_factors_a[c], size_factors_b[c], sseq_params)
+                for c in job_clusters]
 
-    for cluster in xrange(1, 1 + n_clusters):
-        in_cluster = clusters == cluster
-        group_a = np.flatnonzero(in_cluster)
-        group_b = np.flatnonzero(np.logical_not(in_cluster))
-        print 'Computing DE for cluster %d...' % cluster
-        sys.stdout.flush()
+    print 'Computing DE for %d clusters in %d jobs...' % (n_clusters, num_jobs)
+    sys.stdout.flush()
+    if num_jobs > 1:
+        pool = multiprocessing.Pool(num_jobs)
+        try:
+            job_results = pool.map(_cluster_differential_expression, job_args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        job_results = map(_cluster_differential_expression, job_args)
 
-        de_result = sseq_differential_expression(
-            matrix.m, group_a, group_b, sseq_params)
-        all_de_results[:, 0 + 3 * (cluster - 1)] = de_result['norm_mean_a']
-        all_de_results[:, 1 + 3 * (cluster - 1)] = de_result['log2_fold_change']
-        all_de_results[:, 2 + 3 * (cluster - 1)] = de_result['adjusted_p_value']
+    all_de_results = np.hstack(job_results)
 
     return DIFFERENTIAL_EXPRESSION(all_de_results)
 
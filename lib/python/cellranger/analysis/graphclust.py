@@ -4,7 +4,6 @@
 #
 import collections
 import cPickle
-import errno
 import h5py
 import itertools
 import numpy as np
@@ -25,6 +24,15 @@ GRAPHCLUST = collections.namedtuple('GRAPHCLUST', ['clusters'])
 LOUVAIN_CONVERT_BINPATH = 'convert'
 LOUVAIN_BINPATH = 'louvain'
 
+# Types used by Louvain's binary graph format (see graph_binary.cpp)
+LOUVAIN_NODE_COUNT_DTYPE = np.int32
+LOUVAIN_DEGREE_DTYPE = np.uint64
+LOUVAIN_LINK_DTYPE = np.int32
+LOUVAIN_WEIGHT_DTYPE = np.longdouble
+
+# Rows of the graph adjacency matrix to materialize at a time
+GRAPH_BLOCK_ROWS = 1 << 14
+
 def compute_nearest_neighbors(submatrix, balltree, k, row_start):
     """ Compute k nearest neighbors on a submatrix
     Args: submatrix (np.ndarray): Data submatrix
@@ -98,43 +106,80 @@ def run_louvain_weighted_clustering(bin_filename, weight_filename, louvain_out):
                                '-l', '-1',
                            ], stdout=f)
 
-def pipe_unweighted_edgelist_to_convert(matrix, bin_filename):
-    """ Pipe an unweighted edgelist (COO sparse matrix) to Louvain's convert utility """
-
-    proc = tk_subproc.Popen([LOUVAIN_CONVERT_BINPATH,
-                           '-i', '-',
-                           '-o', bin_filename,
-                         ], stdin=subprocess.PIPE)
-
-
-    # Check if the process terminated early
-    time.sleep(3)
-    retcode = proc.poll()
-    if retcode is not None:
-        proc.stdin.close()
-        proc.wait()
-        raise Exception("'convert' command terminated early with exit code %d" % proc.returncode)
-
-    # Stream text triplets to 'convert'
-    print 'Writing %d elements.' % len(matrix.row)
-
+def iter_row_blocks(matrix, block_rows=GRAPH_BLOCK_ROWS):
+    """ Yield consecutive row blocks of a CSR matrix """
+    for row_start in xrange(0, matrix.shape[0], block_rows):
+        yield matrix[row_start:(row_start + block_rows), :]
+
+def iter_snn_blocks(nn, k_nearest, block_rows=GRAPH_BLOCK_ROWS):
+    """ Yield consecutive row blocks of the shared-nearest-neighbor matrix.
+    Args: nn - nearest-neighbor boolean matrix
+          k_nearest - number of nearest neighbors per row
+          block_rows - number of SNN rows to compute at a time
+    Yields: CSR matrices; together they form nn.dot(nn.T) / k_nearest """
+    nn = nn.tocsr()
+    nn_t = nn.T.tocsr()
+    for nn_block in iter_row_blocks(nn, block_rows):
+        snn_block = nn_block.dot(nn_t) / float(k_nearest)
+        yield snn_block.tocsr()
+
+def write_louvain_graph(row_blocks, num_nodes, bin_filename, weight_filename=None):
+    """ Write a symmetric adjacency matrix in Louvain's binary graph format.
+    This is the format produced by Louvain's convert utility: the node count,
+    the cumulative degree of each node, then the neighbors of each node.
+    Edge weights, if any, go to a separate file in the same link order.
+    Args: row_blocks - iterable of CSR matrices holding consecutive rows of the adjacency matrix
+          num_nodes - total number of rows
+          bin_filename - output graph file
+          weight_filename - output weights file, or None for an unweighted graph
+    Returns: Number of links written (each undirected edge counts twice) """
+    degrees = np.zeros(num_nodes, dtype=LOUVAIN_DEGREE_DTYPE)
+    degree_offset = np.dtype(LOUVAIN_NODE_COUNT_DTYPE).itemsize
+    links_offset = degree_offset + degrees.nbytes
+
+    weight_file = open(weight_filename, 'wb') if weight_filename is not None else None
     try:
-        for ij in itertools.izip(matrix.row, matrix.col):
-            proc.stdin.write('%d\t%d\n' % ij)
-        proc.stdin.close()
-    except IOError as e:
-        if e.errno == errno.EPIPE:
-            proc.stdin.close()
-            proc.wait()
-            raise Exception("'convert' binary closed the pipe before we finished writing to it. It terminated with exit code %d" % proc.returncode)
-
-    proc.wait()
-
-    if proc.returncode != 0:
-        raise Exception("'convert' command failed with exit code %d" % proc.returncode)
-
-    if not os.path.exists(bin_filename):
-        raise Exception("'convert' failed to write the matrix file. Please see the standard error file (_stderr) to see if it emitted any errors.")
+        with open(bin_filename, 'wb') as bin_file:
+            np.array(num_nodes, dtype=LOUVAIN_NODE_COUNT_DTYPE).tofile(bin_file)
+
+            # Stream the links; the degree sequence is filled in afterwards
+            bin_file.seek(links_offset)
+            row_start = 0
+            for block in row_blocks:
+                block.sort_indices()
+                row_end = row_start + block.shape[0]
+                degrees[row_start:row_end] = np.diff(block.indptr)
+                block.indices.astype(LOUVAIN_LINK_DTYPE).tofile(bin_file)
+                if weight_file is not None:
+                    block.data.astype(LOUVAIN_WEIGHT_DTYPE).tofile(weight_file)
+                row_start = row_end
+            assert row_start == num_nodes
+
+            bin_file.seek(degree_offset)
+            np.cumsum(degrees, out=degrees).tofile(bin_file)
+    finally:
+        if weight_file is not None:
+            weight_file.close()
+
+    return int(degrees[-1]) if num_nodes > 0 else 0
+
+def write_unweighted_louvain_graph(nn, bin_filename):
+    """ Write a nearest-neighbor matrix as an unweighted, undirected Louvain graph.
+    Equivalent to piping its edgelist through Louvain's convert utility. """
+    with LogPerf('symmetrize'):
+        adj = (nn + nn.T).tocsr()
+        adj.data[:] = 1
+
+    with LogPerf('write_graph'):
+        return write_louvain_graph(iter_row_blocks(adj), adj.shape[0], bin_filename)
+
+def write_snn_louvain_graph(nn, k_nearest, bin_filename, weight_filename):
+    """ Write the SNN similarity of a nearest-neighbor matrix as a weighted Louvain graph.
+    The SNN matrix is built and written in row blocks and is never held in memory whole.
+    Returns: Number of links written (each undirected edge counts twice) """
+    with LogPerf('snn_write_graph'):
+        return write_louvain_graph(iter_snn_blocks(nn, k_nearest), nn.shape[0],
+                            bin_filename, weight_filename)
 
 def run_louvain_unweighted_clustering(bin_filename, louvain_out):
     """ Run Louvain clustering on an unweighted edge-list """
@@ -145,25 +190,6 @@ def run_louvain_unweighted_clustering(bin_filename, louvain_out):
                                '-l', '-1',
                            ], stdout=f)
 
-def compute_snn_matrix(nn, k_nearest):
-    """ Compute shared-nearest-neighbor matrix from a nearest-neighbor boolean matrix """
-    with LogPerf('tocsr'):
-        nn = nn.tocsr(copy=False)
-
-    # The SNN (shared nearest neighbor) similarity is
-    #   The length of the nearest-neighbor intersection between two rows
-    #   (divided by the max number of neighbors)
-    # This can be computed via the dot products of rows in the boolean NN matrix
-    with LogPerf('snn'):
-        snn = (nn.dot(nn.T)) / float(k_nearest)
-
-    # Use the SNN similarity in the modularity optimization algorithm
-    # Louvain takes a text edge-list and converts to its own binary format
-    with LogPerf('tocoo'):
-        snn = snn.tocoo(copy=False)
-
-    return snn
-
 def load_louvain_results(num_barcodes, use_bcs, louvain_out):
     """ Load Louvain modularity results.
     Args: num_barcodes - total number of cell barcodes
@@ -171,17 +197,28 @@ def load_louvain_results(num_barcodes, use_bcs, louvain_out):
           louvain_out - path to louvain output file.
     Returns: Array of cluster labels  """
 
+    # Each line is a pair of integers: "used_bc_idx cluster"
+    results = np.fromfile(louvain_out, dtype=int, sep=' ').reshape(-1, 2)
+
+    # Take max of community cluster ids reported by Louvain.
+    # 1-based cluster ids. Report 0 if barcode wasn't used.
     labels = np.zeros(num_barcodes, dtype=int)
-    with open(louvain_out) as f:
-        for line in f:
-            used_bc_idx, cluster = map(int, line.strip().split(' '))
-            # Take max of community cluster ids reported by Louvain.
-            # 1-based cluster ids. Report 0 if barcode wasn't used.
-
-            bc_idx = use_bcs[used_bc_idx]
-            labels[bc_idx] = max(labels[bc_idx], 1 + cluster)
+    np.maximum.at(labels, use_bcs[results[:, 0]], 1 + results[:, 1])
     return labels
 
+def get_num_neighbors(num_bcs, num_neighbors=None, neighbor_a=None, neighbor_b=None):
+    """ Compute the number of nearest neighbors used to build the graph: the larger of
+    num_neighbors and a + b*log10(num_bcs), clamped to [1, num_bcs - 1] """
+    given_num_neighbors = num_neighbors if num_neighbors is not None else analysis_constants.GRAPHCLUST_NEIGHBORS_DEFAULT
+    given_neighbor_a = neighbor_a if neighbor_a is not None else analysis_constants.GRAPHCLUST_NEIGHBOR_A_DEFAULT
+    given_neighbor_b = neighbor_b if neighbor_b is not None else analysis_constants.GRAPHCLUST_NEIGHBOR_B_DEFAULT
+
+    # Take max of {num_neighbors, a + b*log10(n)}
+    use_neighbors = int(max(given_num_neighbors, np.round(given_neighbor_a + given_neighbor_b * np.log10(num_bcs))))
+
+    # Clamp to [1, n - 1]
+    return max(1, min(use_neighbors, num_bcs-1))
+
 def matrix_density(m):
     return m.nnz / float(m.shape[0]*m.shape[1])
 
@@ -55,7 +55,7 @@ def invcheck(x):
         return 0.0
 
 #pylint: disable=too-many-statements
-def irlb(A, n, tol=0.0001, maxit=50, center=None, scale=None, random_state=0):
+def irlb(A, n, tol=0.0001, maxit=50, center=None, scale=None, random_state=0, dtype=np.float64):
     """Estimate a few of the largest singular values and corresponding singular
     vectors of matrix using the implicitly restarted Lanczos bidiagonalization
     method of Baglama and Reichel, see:
@@ -66,6 +66,8 @@ def irlb(A, n, tol=0.0001, maxit=50, center=None, scale=None, random_state=0):
     Keyword arguments:
     tol   -- An estimation tolerance. Smaller means more accurate estimates.
     maxit -- Maximum number of Lanczos iterations allowed.
+    dtype -- Type of the approximate singular vectors. Use np.float32 to halve
+             their memory footprint on matrices with many rows.
 
     Given an input matrix A of dimension j * k, and an input desired number
     of singular values n, the function returns a tuple X with five entries:
@@ -103,9 +105,9 @@ def irlb(A, n, tol=0.0001, maxit=50, center=None, scale=None, random_state=0):
     k = nu
     smax = 1
 
-    V = np.zeros((n, m_b))  # Approximate right vectors
-    W = np.zeros((m, m_b))  # Approximate left vectors
-    F = np.zeros((n, 1))  # Residual vector
+    V = np.zeros((n, m_b), dtype=dtype)  # Approximate right vectors
+    W = np.zeros((m, m_b), dtype=dtype)  # Approximate left vectors
+    F = np.zeros((n, 1), dtype=dtype)  # Residual vector
     B = np.zeros((m_b, m_b))  # Bidiagonal approximation
 
     V[:, 0] = np.random.randn(n)  # Initial vector
@@ -17,30 +17,38 @@ KMEANS = collections.namedtuple('KMEANS', ['clusters', 'cluster_score'])
 # Clamp centroid distances to this value for DBI calc
 MIN_CENTROID_DIST = 1e-3
 
+# Number of cells per mini-batch when fitting with MiniBatchKMeans
+MINIBATCH_SIZE = 10000
+
+# Number of warm-start initializations tried for each K in a sweep
+SWEEP_CANDIDATES = 3
+
 def compute_db_index(matrix, kmeans):
     '''
     Compute Davies-Bouldin index, a measure of clustering quality.
     Faster and possibly more reliable than silhouette score.
     '''
-    n = matrix.shape[0]
-    k = kmeans.n_clusters
-
     centers = kmeans.cluster_centers_
     labels = kmeans.labels_
+    return compute_db_index_from_sq_dists(centers, labels,
+                                          compute_sq_dists(matrix, centers, labels))
+
+def compute_sq_dists(matrix, centers, labels):
+    ''' Squared euclidean distance from each row of matrix to its assigned center '''
+    return np.square(matrix - centers[labels, :]).sum(axis=1)
+
+def compute_db_index_from_sq_dists(centers, labels, sq_dists):
+    '''
+    Compute Davies-Bouldin index given each point's squared distance to its center.
+    '''
+    k = centers.shape[0]
 
     centroid_dists = sp_dist.squareform(sp_dist.pdist(centers))
     # Avoid divide-by-zero
     centroid_dists[np.abs(centroid_dists) < MIN_CENTROID_DIST] = MIN_CENTROID_DIST
 
-    wss = np.zeros(k)
-    counts = np.zeros(k)
-
-    for i in xrange(n):
-        label = labels[i]
-        # note: this is 2x faster than scipy sqeuclidean
-        sqdist = np.square(matrix[i,:] - centers[label,:]).sum()
-        wss[label] += sqdist
-        counts[label] += 1
+    wss = np.bincount(labels, weights=sq_dists, minlength=k)
+    counts = np.bincount(labels, minlength=k).astype(float)
 
     # Handle empty clusters
     counts[counts == 0] = 1
@@ -54,6 +62,19 @@ def compute_db_index(matrix, kmeans):
 
     return db_score
 
+def create_kmeans_clustering(clusters, n_clusters, cluster_score):
+    ''' Args: clusters (np.array(int)): 1-based cluster labels '''
+    clusters = cr_clustering.relabel_by_size(clusters)
+
+    clustering_key = cr_clustering.format_clustering_key(cr_clustering.CLUSTER_TYPE_KMEANS, n_clusters)
+
+    return cr_clustering.create_clustering(clusters=clusters,
+                                           num_clusters=n_clusters,
+                                           cluster_score=cluster_score,
+                                           clustering_type=cr_clustering.CLUSTER_TYPE_KMEANS,
+                                           global_sort_key=n_clusters,
+                                           description=cr_clustering.humanify_clustering_key(clustering_key))
+
 def run_kmeans(transformed_matrix, n_clusters, random_state=None):
     if random_state is None:
         random_state=analysis_constants.RANDOM_STATE
@@ -63,16 +84,62 @@ def run_kmeans(transformed_matrix, n_clusters, random_state=None):
 
     cluster_score = compute_db_index(transformed_matrix, kmeans)
 
-    clusters = cr_clustering.relabel_by_size(clusters)
+    return create_kmeans_clustering(clusters, n_clusters, cluster_score)
 
-    clustering_key = cr_clustering.format_clustering_key(cr_clustering.CLUSTER_TYPE_KMEANS, n_clusters)
+def run_kmeans_sweep(transformed_matrix, min_clusters, max_clusters, random_state=None, use_minibatch=False):
+    '''
+    Run k-means for every K in [min_clusters, max_clusters] in one pass.
+    The first K is seeded with k-means++. Each subsequent K starts from the previous
+    centroids plus one new centroid, drawn with probability proportional to each point's
+    squared distance to its current center; the best of SWEEP_CANDIDATES such starts is kept.
+    Those distances are also used for the Davies-Bouldin index, so they are computed once per K.
+    Args: transformed_matrix (np.ndarray): cells x components
+          use_minibatch (bool): Fit with MiniBatchKMeans (for very large datasets)
+    Returns: list of CLUSTERING, one per K
+    '''
+    if random_state is None:
+        random_state=analysis_constants.RANDOM_STATE
 
-    return cr_clustering.create_clustering(clusters=clusters,
-                                           num_clusters=n_clusters,
-                                           cluster_score=cluster_score,
-                                           clustering_type=cr_clustering.CLUSTER_TYPE_KMEANS,
-                                           global_sort_key=n_clusters,
-                                           description=cr_clustering.humanify_clustering_key(clustering_key))
+    prng = np.random.RandomState(random_state)
+    n = transformed_matrix.shape[0]
+
+    clusterings = []
+    centers, sq_dists = None, None
+
+    for n_clusters in xrange(min_clusters, max_clusters + 1):
+        # Candidate initializations as (init, n_init)
+        if centers is None:
+            inits = [('k-means++', 3 if use_minibatch else 10)]
+        else:
+            total = sq_dists.sum()
+            p = sq_dists / total if total > 0 else None
+            new_centers = transformed_matrix[prng.choice(n, size=SWEEP_CANDIDATES, p=p), :]
+            inits = [(np.vstack((centers, new_center)), 1) for new_center in new_centers]
+            # Also try a few fresh starts so a poor split at a small K does not persist
+            inits.append(('k-means++', SWEEP_CANDIDATES))
+
+        # Keep the best of the candidate initializations
+        kmeans = None
+        for init, n_init in inits:
+            if use_minibatch:
+                candidate = sk_cluster.MiniBatchKMeans(n_clusters=n_clusters, init=init, n_init=n_init,
+                                                       batch_size=MINIBATCH_SIZE, random_state=random_state)
+            else:
+                candidate = sk_cluster.KMeans(n_clusters=n_clusters, init=init, n_init=n_init,
+                                              random_state=random_state)
+            candidate.fit(transformed_matrix)
+            if kmeans is None or candidate.inertia_ < kmeans.inertia_:
+                kmeans = candidate
+
+        labels = kmeans.labels_
+        centers = kmeans.cluster_centers_
+
+        sq_dists = compute_sq_dists(transformed_matrix, centers, labels)
+        cluster_score = compute_db_index_from_sq_dists(centers, labels, sq_dists)
+
+        clusterings.append(create_kmeans_clustering(labels + 1, n_clusters, cluster_score))
+
+    return clusterings
 
 def save_kmeans_h5(f, n_clusters, kmeans):
     clustering_key = cr_clustering.format_clustering_key(cr_clustering.CLUSTER_TYPE_KMEANS, n_clusters)
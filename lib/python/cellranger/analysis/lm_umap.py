@@ -11,6 +11,7 @@ import collections
 import numpy as np
 import os
 import umap
+import umap.umap_
 import martian
 
 UMAP = collections.namedtuple('UMAP', ['transformed_umap_matrix',
@@ -19,8 +20,38 @@ UMAP = collections.namedtuple('UMAP', ['transformed_umap_matrix',
                                        ])
 
 
+def fit_transform_with_knn(umap_reducer, x, knn):
+    """ Equivalent of umap_reducer.fit_transform(x), except that the nearest neighbors of each row are
+    taken from knn, (indices, distances) arrays excluding the row itself, instead of being searched for. """
+    n_neighbors = min(umap_reducer.n_neighbors, knn[0].shape[1] + 1)
+
+    # UMAP counts each row as its own nearest neighbor
+    (knn_indices, knn_dists) = knn
+    num_rows = knn_indices.shape[0]
+    knn_indices = np.column_stack([np.arange(num_rows), knn_indices[:, :n_neighbors-1]]).astype(np.int64)
+    knn_dists = np.column_stack([np.zeros(num_rows), knn_dists[:, :n_neighbors-1]]).astype(np.float32)
+
+    x = np.asarray(x, dtype=np.float32)
+    graph = umap.umap_.fuzzy_simplicial_set(x, n_neighbors, umap_reducer.random_state, umap_reducer.metric, {},
+                                            knn_indices, knn_dists, umap_reducer.angular_rp_forest,
+                                            umap_reducer.set_op_mix_ratio, umap_reducer.local_connectivity,
+                                            umap_reducer.verbose)
+    (a, b) = umap.umap_.find_ab_params(umap_reducer.spread, umap_reducer.min_dist)
+    return umap.umap_.simplicial_set_embedding(x, graph, umap_reducer.n_components, umap_reducer.learning_rate,
+                                               a, b, umap_reducer.repulsion_strength,
+                                               umap_reducer.negative_sample_rate, umap_reducer.n_epochs or 0,
+                                               umap_reducer.init, umap_reducer.random_state, umap_reducer.metric,
+                                               {}, umap_reducer.verbose)
+
+
 def run_umap(transformed_pca_matrix, name='UMAP', key='UMAP', input_pcs=None, n_neighbors=None,
-             min_dist=None, metric=None, umap_dims=None, random_state=None):
+             min_dist=None, metric=None, umap_dims=None, random_state=None, knn=None):
+    """ Run UMAP on the rows of a matrix.
+
+    knn: optional (indices, distances) arrays of at least n_neighbors - 1 nearest neighbors of each row,
+         excluding the row itself and computed with the same metric, used instead of UMAP's own
+         neighbor search.
+    """
 
     if umap_dims is None:
         umap_dims = analysis_constants.UMAP_N_COMPONENTS
@@ -42,12 +73,17 @@ def run_umap(transformed_pca_matrix, name='UMAP', key='UMAP', input_pcs=None, n_
     if input_pcs is not None:
         transformed_pca_matrix = transformed_pca_matrix[:, :input_pcs]
 
+    def fit_transform(umap_reducer):
+        if knn is not None:
+            return fit_transform_with_knn(umap_reducer, transformed_pca_matrix, knn)
+        return umap_reducer.fit_transform(transformed_pca_matrix)
+
     try:
         umap_reducer = umap.UMAP(n_neighbors=n_neighbors, min_dist=min_dist,
                                  n_components=umap_dims, metric=metric,
                                  random_state=np.random.RandomState(random_state))
 
-        transformed_umap_matrix = umap_reducer.fit_transform(transformed_pca_matrix)
+        transformed_umap_matrix = fit_transform(umap_reducer)
     except ValueError:
         martian.log_info('Failed to run UMAP with default setting on this data. Trying random initialization.')
 
@@ -56,7 +92,7 @@ def run_umap(transformed_pca_matrix, name='UMAP', key='UMAP', input_pcs=None, n_
                                  random_state=np.random.RandomState(random_state),
                                  init='random')
 
-        transformed_umap_matrix = umap_reducer.fit_transform(transformed_pca_matrix)
+        transformed_umap_matrix = fit_transform(umap_reducer)
     except:
         martian.log_info('Failed to run UMAP on this data. Filling in 0s as UMAP embeddings.')
         transformed_umap_matrix = np.zeros((transformed_pca_matrix.shape[0], umap_dims), dtype=np.float32)
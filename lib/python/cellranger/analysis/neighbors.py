@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2019 10X Genomics, Inc. All rights reserved.
+#
+
+"""
+k-nearest-neighbor graph shared by the analyses that need neighbors of each barcode
+in PCA space, so the neighbor search runs once per analysis.
+
+Graph clustering always reads the graph. UMAP reads it when its metric is KNN_GRAPH_METRIC and it
+uses all PCs. t-SNE (bh_sne runs its own VP-tree search) and chemistry batch correction (which runs
+before the final PCA) search for neighbors themselves.
+"""
+
+import cPickle
+import h5py
+import numpy as np
+import scipy.sparse as sp_sparse
+import scipy.spatial as sp_spatial
+
+DEFAULT_KDTREE_LEAFSIZE = 40
+
+# Approximate queries may return a k-th neighbor up to (1 + eps) times farther than the exact one
+APPROXIMATE_KNN_EPS = 0.1
+
+# Distances in the graph are euclidean distances between PCA projections
+KNN_GRAPH_METRIC = 'euclidean'
+
+KNN_GRAPH_INDICES = 'indices'
+KNN_GRAPH_DISTANCES = 'distances'
+
+# Types of the neighbor indices and distances stored in the graph
+KNN_INDEX_DTYPE = np.int32
+KNN_DISTANCE_DTYPE = np.float32
+
+def build_neighbor_index(x, leaf_size=DEFAULT_KDTREE_LEAFSIZE):
+    return sp_spatial.cKDTree(x, leafsize=leaf_size)
+
+def save_neighbor_index(index, filename):
+    with open(filename, 'wb') as f:
+        cPickle.dump(index, f, cPickle.HIGHEST_PROTOCOL)
+
+def load_neighbor_index(filename):
+    with open(filename) as f:
+        return cPickle.load(f)
+
+def query_knn(index, x, k, threads=1, approximate=False):
+    """ Find the k nearest neighbors of each row of x, excluding the row itself.
+    Args: index: Nearest neighbor index (from build_neighbor_index) containing the rows of x
+          x (np.ndarray): Query points
+          k (int): Number of nearest neighbors
+          threads (int): Number of threads used by the query
+          approximate (bool): Allow neighbors up to APPROXIMATE_KNN_EPS farther than the exact ones
+    Returns (np.ndarray, np.ndarray): Neighbor indices and distances, one row per query sorted by distance
+    """
+    eps = APPROXIMATE_KNN_EPS if approximate else 0
+    nn_dist, nn_idx = index.query(x, k=k+1, eps=eps, n_jobs=threads)
+
+    # Remove the self-as-neighbors
+    return (nn_idx[:, 1:].astype(KNN_INDEX_DTYPE),
+            nn_dist[:, 1:].astype(KNN_DISTANCE_DTYPE))
+
+def save_knn_graph(filename, indices, distances):
+    """ Write a kNN graph to an HDF5 file. """
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset(KNN_GRAPH_INDICES, data=indices)
+        f.create_dataset(KNN_GRAPH_DISTANCES, data=distances)
+
+def create_knn_graph(filename, num_rows, k):
+    """ Create an empty kNN graph HDF5 file to be filled in blocks of rows with write_knn_graph_rows. """
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset(KNN_GRAPH_INDICES, shape=(num_rows, k), dtype=KNN_INDEX_DTYPE)
+        f.create_dataset(KNN_GRAPH_DISTANCES, shape=(num_rows, k), dtype=KNN_DISTANCE_DTYPE)
+
+def write_knn_graph_rows(filename, row_start, indices, distances):
+    with h5py.File(filename, 'r+') as f:
+        row_end = row_start + indices.shape[0]
+        f[KNN_GRAPH_INDICES][row_start:row_end, :] = indices
+        f[KNN_GRAPH_DISTANCES][row_start:row_end, :] = distances
+
+def get_knn_graph_dims(filename):
+    """ Returns (int, int): number of rows and of neighbors per row """
+    with h5py.File(filename, 'r') as f:
+        return f[KNN_GRAPH_INDICES].shape
+
+def load_knn_graph(filename, k=None):
+    """ Load the k nearest neighbors of each row of a kNN graph (all neighbors if k is None).
+    Returns (np.ndarray, np.ndarray): Neighbor indices and distances sorted by distance
+    """
+    with h5py.File(filename, 'r') as f:
+        k = f[KNN_GRAPH_INDICES].shape[1] if k is None else k
+        if k > f[KNN_GRAPH_INDICES].shape[1]:
+            raise ValueError("kNN graph has %d neighbors per row, %d were requested" %
+                             (f[KNN_GRAPH_INDICES].shape[1], k))
+        return (f[KNN_GRAPH_INDICES][:, :k], f[KNN_GRAPH_DISTANCES][:, :k])
+
+def knn_graph_to_adjacency(indices):
+    """ Convert neighbor indices to a sparse adjacency matrix of nearest neighbor relations """
+    num_rows, k = indices.shape
+    i = np.repeat(np.arange(num_rows), k)
+    return sp_sparse.coo_matrix((np.ones(len(i)), (i, indices.ravel())), shape=(num_rows, num_rows))
@@ -7,10 +7,14 @@ import cellranger.analysis.io as analysis_io
 import cellranger.analysis.constants as analysis_constants
 import cellranger.h5_constants as h5_constants
 import cellranger.io as cr_io
+import cellranger.matrix as cr_matrix
 import cellranger.analysis.stats as analysis_stats
+from cellranger.logperf import LogPerf
 
 import collections
+from multiprocessing.pool import ThreadPool
 from cellranger.analysis.irlb import irlb
+from cellranger.analysis.block_krylov import block_krylov_svd, get_svd_residuals
 import numpy as np
 import os
 import tables
@@ -21,7 +25,8 @@ import tables
 # value, we throw an exception.
 DEFAULT_RUNPCA_THRESHOLD = 2
 
-from sklearn.utils import sparsefuncs
+# Default convergence tolerance of irlb. Block Krylov iterates until its residuals are at most this.
+IRLB_TOLERANCE = 0.0001
 
 class MatrixRankTooSmallException(Exception):
     pass
@@ -34,7 +39,8 @@ def get_original_columns_used(cols_not_removed, cols_used_after_removal):
     matrix correspond the the columns in the new matrix."""
     return [cols_not_removed[x] for x in cols_used_after_removal]
 
-def run_pca(matrix, pca_features=None, pca_bcs=None, n_pca_components=None, random_state=None, min_count_threshold=0):
+def run_pca(matrix, pca_features=None, pca_bcs=None, n_pca_components=None, random_state=None, min_count_threshold=0,
+            dtype=np.float64, engine=None, threads=1):
     """ Run a PCA on the matrix using the IRLBA matrix factorization algorithm.  Prior to the PCA analysis, the
     matrix is modified so that all barcodes/columns have the same counts, and then the counts are transformed
     by a log2(1+X) operation.
@@ -46,6 +52,9 @@ def run_pca(matrix, pca_features=None, pca_bcs=None, n_pca_components=None, rand
     One can also select to subset number of barcodes to use (e.g. sample columns), but in this case they are simply
     randomly sampled.
 
+    The normalized matrix is never materialized: the dispersion statistics are computed in blocks of barcodes,
+    and the normalization is applied to one block of counts at a time inside the IRLBA matrix products.
+
     Args:
         matrix (CountMatrix): The matrix to perform PCA on.
         pca_features (int): Number of features to subset from matrix and use in PCA. The top pca_features ranked by
@@ -55,6 +64,12 @@ def run_pca(matrix, pca_features=None, pca_bcs=None, n_pca_components=None, rand
         random_state (int): The seed for the RNG
         min_count_threshold (int): The minimum sum of each row/column for that row/column to be passed to PCA
                                    (this filter is prior to any subsetting that occurs).
+        dtype (np.dtype): Type of the normalized values and singular vectors used by IRLBA. np.float32 roughly
+                          halves the memory used by the factorization.
+        engine (str): Matrix factorization algorithm, PCA_ENGINE_IRLB or PCA_ENGINE_BLOCK_KRYLOV.
+                      If None, chosen from the size of the matrix by get_pca_engine. If block Krylov
+                      iteration doesn't converge to the irlb tolerance, irlb is run instead.
+        threads (int): Number of threads used for the matrix products.
     Returns:
         A PCA object
     """
@@ -62,39 +77,49 @@ def run_pca(matrix, pca_features=None, pca_bcs=None, n_pca_components=None, rand
         random_state=analysis_constants.RANDOM_STATE
     np.random.seed(0)
 
+    matrix.tocsc()
+
     # Threshold the rows/columns of matrix, will throw error if an empty matrix results.
-    thresholded_matrix, _, thresholded_features = matrix.select_axes_above_threshold(min_count_threshold)
+    thresholded_bcs, thresholded_features = matrix.get_axes_above_threshold(min_count_threshold)
+    thresholded_bcs_dim = len(thresholded_bcs)
+    thresholded_features_dim = len(thresholded_features)
 
     # If requested, we can subsample some of the barcodes to get a smaller matrix for PCA
-    pca_bc_indices = np.arange(thresholded_matrix.bcs_dim)
+    pca_bc_indices = np.arange(thresholded_bcs_dim)
     if pca_bcs is None:
-        pca_bcs = thresholded_matrix.bcs_dim
-        pca_bc_indices = np.arange(thresholded_matrix.bcs_dim)
-    elif pca_bcs < thresholded_matrix.bcs_dim:
-        pca_bc_indices = np.sort(np.random.choice(np.arange(thresholded_matrix.bcs_dim), size=pca_bcs, replace=False))
-    elif pca_bcs > thresholded_matrix.bcs_dim:
+        pca_bcs = thresholded_bcs_dim
+        pca_bc_indices = np.arange(thresholded_bcs_dim)
+    elif pca_bcs < thresholded_bcs_dim:
+        pca_bc_indices = np.sort(np.random.choice(np.arange(thresholded_bcs_dim), size=pca_bcs, replace=False))
+    elif pca_bcs > thresholded_bcs_dim:
         msg = ("You requested {} barcodes but the matrix after thresholding only "
-                "included {}, so the smaller amount is being used.").format(pca_bcs, thresholded_matrix.bcs_dim)
+                "included {}, so the smaller amount is being used.").format(pca_bcs, thresholded_bcs_dim)
         print(msg)
-        pca_bcs = thresholded_matrix.bcs_dim
-        pca_bc_indices = np.arange(thresholded_matrix.bcs_dim)
+        pca_bcs = thresholded_bcs_dim
+        pca_bc_indices = np.arange(thresholded_bcs_dim)
 
     # If requested, select fewer features to use by selecting the features with highest normalized dispersion
     if pca_features is None:
-        pca_features = thresholded_matrix.features_dim
-    elif pca_features > thresholded_matrix.features_dim:
+        pca_features = thresholded_features_dim
+    elif pca_features > thresholded_features_dim:
         msg = ("You requested {} features but the matrix after thresholding only included {} features,"
-               "so the smaller amount is being used.").format(pca_features, thresholded_matrix.features_dim)
+               "so the smaller amount is being used.").format(pca_features, thresholded_features_dim)
         print(msg)
-        pca_features = thresholded_matrix.features_dim
-    # Calc mean and variance of counts after normalizing
-    # But don't transform to log space, in order to preserve the mean-variance relationship
-    m = analysis_stats.normalize_by_umi(thresholded_matrix)
-    # Get mean and variance of rows
-    (mu, var) = analysis_stats.summarize_columns(m.T)
-    dispersion = analysis_stats.get_normalized_dispersion(mu.squeeze(), var.squeeze())  # TODO set number of bins?
-    #pylint: disable=invalid-unary-operand-type
-    pca_feature_indices = np.argsort(dispersion)[-pca_features:]
+        pca_features = thresholded_features_dim
+
+    with LogPerf('pca_dispersion'):
+        # Calc mean and variance of counts after normalizing
+        # But don't transform to log space, in order to preserve the mean-variance relationship
+        feature_mask = np.zeros(matrix.features_dim, dtype=np.int64)
+        feature_mask[thresholded_features] = 1
+        counts_per_bc = np.asarray(matrix.m.T.dot(feature_mask)).ravel()[thresholded_bcs]
+        scaling_factors = analysis_stats.get_umi_scaling_factors(counts_per_bc)
+        # Get mean and variance of rows
+        (mu, var) = analysis_stats.summarize_rows_streaming(matrix.m, scaling_factors,
+                                                            _get_column_subset(thresholded_bcs, matrix.bcs_dim))
+        dispersion = analysis_stats.get_normalized_dispersion(mu[thresholded_features], var[thresholded_features])  # TODO set number of bins?
+        #pylint: disable=invalid-unary-operand-type
+        pca_feature_indices = np.argsort(dispersion)[-pca_features:]
 
     # Now determine how many components.
     if n_pca_components is None:
@@ -112,19 +137,50 @@ def run_pca(matrix, pca_features=None, pca_bcs=None, n_pca_components=None, rand
     if (likely_matrix_rank * 0.5) <= float(n_pca_components):
         print("Requested number of PCA components is large relative to the matrix size, an exact approach to matrix factorization may be faster.")
 
+    # Get a coordinate map so we know which columns in the old matrix correspond to columns in the new
+    org_cols_used = get_original_columns_used(thresholded_features, pca_feature_indices)
+    # Raw counts of the selected features, shared by the factorization and the projection
+    feature_counts = matrix.m[org_cols_used, :].tocsc()
+
     # Note, after subsetting it is possible some rows/cols in pca_mat have counts below the threshold.
     # However, we are not performing a second thresholding as in practice subsetting is not used and we explain
     # that thresholding occurs prior to subsetting in the doc string.
-    pca_mat = thresholded_matrix.select_barcodes(pca_bc_indices).select_features(pca_feature_indices)
-    (pca_norm_mat, pca_center, pca_scale) = normalize_and_transpose(pca_mat)
-    (_, d, v, _, _) = irlb(pca_norm_mat, n_pca_components, center=pca_center.squeeze(), scale=pca_scale.squeeze(), random_state=random_state)
-
-    # make sure to project the matrix before centering, to avoid densification
-    (full_norm_mat, full_center, full_scale) = normalize_and_transpose(matrix)
-    sparsefuncs.inplace_column_scale(full_norm_mat, 1 / full_scale.squeeze()) # can have some zeros here
-    # Get a coordinate map so we know which columns in the old matrix correspond to columns in the new
-    org_cols_used = get_original_columns_used(thresholded_features, pca_feature_indices)
-    transformed_irlba_matrix = full_norm_mat[:,org_cols_used].dot(v) - (full_center / full_scale)[:,org_cols_used].dot(v)
+    with LogPerf('pca_factorize'):
+        pca_bcs_used = thresholded_bcs[pca_bc_indices]
+        if len(pca_bcs_used) < matrix.bcs_dim:
+            pca_counts = feature_counts[:, pca_bcs_used]
+        else:
+            pca_counts = feature_counts
+        pca_scaling_factors = analysis_stats.get_umi_scaling_factors(cr_matrix.sum_sparse_matrix(pca_counts, axis=0))
+        with NormalizedMatrixOperator(pca_counts, pca_scaling_factors, dtype=dtype, threads=threads) as pca_norm_mat:
+            (pca_center, pca_scale) = pca_norm_mat.summarize_columns()
+
+            if engine is None:
+                engine = get_pca_engine(pca_counts.nnz)
+            if engine == analysis_constants.PCA_ENGINE_BLOCK_KRYLOV:
+                (u, d, v, iters, _) = block_krylov_svd(pca_norm_mat, n_pca_components, center=pca_center, scale=pca_scale,
+                                                       n_iter=analysis_constants.PCA_BLOCK_KRYLOV_N_ITER,
+                                                       max_iter=analysis_constants.PCA_BLOCK_KRYLOV_MAX_ITER,
+                                                       tol=IRLB_TOLERANCE, random_state=random_state, dtype=dtype)
+                max_residual = get_svd_residuals(pca_norm_mat, u, d, v, center=pca_center, scale=pca_scale).max()
+                print("Block Krylov PCA max relative residual after {} iterations: {:.3g} (irlb tolerance: {:.3g})".format(
+                    iters, max_residual, IRLB_TOLERANCE))
+                if max_residual > IRLB_TOLERANCE:
+                    print("Block Krylov PCA did not converge, running irlb instead.")
+                    engine = analysis_constants.PCA_ENGINE_IRLB
+            elif engine != analysis_constants.PCA_ENGINE_IRLB:
+                raise ValueError("Unknown PCA engine: %s" % engine)
+
+            if engine == analysis_constants.PCA_ENGINE_IRLB:
+                (_, d, v, _, _) = irlb(pca_norm_mat, n_pca_components, center=pca_center, scale=pca_scale,
+                                       random_state=random_state, dtype=dtype)
+
+    with LogPerf('pca_project'):
+        # make sure to project the matrix before centering, to avoid densification
+        full_scaling_factors = analysis_stats.get_umi_scaling_factors(matrix.get_counts_per_bc())
+        with NormalizedMatrixOperator(feature_counts, full_scaling_factors, dtype=dtype, threads=threads) as full_norm_mat:
+            (full_center, full_scale) = full_norm_mat.summarize_columns()
+            transformed_irlba_matrix = full_norm_mat.dot(v / full_scale[:, np.newaxis]) - (full_center / full_scale).dot(v)
     irlba_components = np.zeros((n_pca_components, matrix.features_dim))
     irlba_components[:,org_cols_used] = v.T
 
@@ -145,6 +201,104 @@ def run_pca(matrix, pca_features=None, pca_bcs=None, n_pca_components=None, rand
 
     return PCA(transformed_irlba_matrix, irlba_components, variance_explained, full_dispersion, features_selected)
 
+def get_pca_engine(nonzero_entries):
+    """ Choose the matrix factorization algorithm from the number of nonzero entries of the PCA input.
+    Block Krylov iteration converges in far fewer passes over the matrix than IRLBA (about 35 block
+    products instead of 130 vector products for 10 PCs), which pays off once the matrix products
+    dominate the runtime: on 2000 features with 10 PCs it took 2.2s vs 3.3s for irlb at 1.5M nonzeros,
+    4.2s vs 8.1s at 2.9M and 13.9s vs 30.2s at 9.8M, and was on par at 0.5M. """
+    if nonzero_entries >= analysis_constants.PCA_BLOCK_KRYLOV_MIN_NNZ:
+        return analysis_constants.PCA_ENGINE_BLOCK_KRYLOV
+    return analysis_constants.PCA_ENGINE_IRLB
+
+def get_block_krylov_mem_gb(features, pcs):
+    """ Memory of the block Krylov basis and its image under A^T A, at the maximum number of iterations. """
+    block_size = pcs + BLOCK_KRYLOV_OVERSAMPLES
+    return 2 * features * block_size * (analysis_constants.PCA_BLOCK_KRYLOV_MAX_ITER + 1) * 8 / 1e9
+
+def _get_column_subset(col_indices, n_cols):
+    """ Return the sorted column indices, or None if they select every column. """
+    return None if len(col_indices) == n_cols else col_indices
+
+class NormalizedMatrixOperator(object):
+    """ Lazily normalized view of a sparse count matrix that can be passed to irlb in place of
+    the output of normalize_and_transpose.
+
+    Represents log2(1 + m * diag(col_scale)).T for a CSC matrix of counts m. Each product normalizes one
+    block of columns of the counts at a time, so the normalized matrix is never materialized. With
+    threads > 1 the blocks are normalized and multiplied concurrently on a thread pool that is shared
+    with the transposes of the operator; close() (or leaving a with block) terminates it.
+    """
+    def __init__(self, m, col_scale, dtype=np.float64, transposed=False, threads=1, pool=None):
+        self.m = m
+        self.col_scale = col_scale
+        self.dtype = np.dtype(dtype)
+        self.transposed = transposed
+        self.threads = threads
+        self.shape = m.shape if transposed else m.shape[::-1]
+        if pool is None and threads > 1:
+            pool = ThreadPool(threads)
+        self.pool = pool
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def transpose(self):
+        return NormalizedMatrixOperator(self.m, self.col_scale, self.dtype, not self.transposed, self.threads,
+                                        pool=self.pool)
+
+    @property
+    def T(self):
+        return self.transpose()
+
+    def _dot_block(self, x, block_info):
+        (start, end, block) = block_info
+        block = analysis_stats.normalize_block(block, self.col_scale[start:end],
+                                               log_transform=True, dtype=self.dtype)
+        if self.transposed:
+            return start, end, block.dot(x[start:end])
+        return start, end, block.T.dot(x)
+
+    def _iter_block_products(self, x):
+        if self.pool is None:
+            for block in analysis_stats.iter_column_blocks(self.m):
+                yield self._dot_block(x, block)
+            return
+
+        # Use at least one block per thread; scipy's sparse products release the GIL
+        max_nnz = min(analysis_stats.STREAMING_BLOCK_NNZ, 1 + self.m.nnz // self.threads)
+        for product in self.pool.imap_unordered(lambda block: self._dot_block(x, block),
+                                                analysis_stats.iter_column_blocks(self.m, max_nnz=max_nnz)):
+            yield product
+
+    def dot(self, x):
+        x = np.asarray(x, dtype=self.dtype)
+        if self.transposed:
+            out = np.zeros((self.shape[0],) + x.shape[1:], dtype=self.dtype)
+            for _, _, product in self._iter_block_products(x):
+                out += product
+        else:
+            out = np.empty((self.shape[0],) + x.shape[1:], dtype=self.dtype)
+            for start, end, product in self._iter_block_products(x):
+                out[start:end] = product
+        return out
+
+    def summarize_columns(self):
+        """ Compute the centering (mean) and scaling (stdev) of each column, as in normalize_and_transpose. """
+        assert not self.transposed
+        (c, v) = analysis_stats.summarize_rows_streaming(self.m, self.col_scale, log_transform=True)
+        # TODO: Inputs to this function shouldn't have zero variance columns
+        v[np.where(v == 0.0)] = 1.0
+        return (c, np.sqrt(v))
+
 def normalize_and_transpose(matrix):
     matrix.tocsc()
 
@@ -169,6 +323,8 @@ EXTRA_IRLBA_PCS = 20
 # Overhead of the matrix per feature and per barcode
 BYTES_PER_FEATURE = 1e3
 BYTES_PER_BC = 1e3
+# block_krylov_svd default number of extra vectors per block
+BLOCK_KRYLOV_OVERSAMPLES = 10
 
 def get_irlb_mem_gb_from_matrix_dim(nonzero_entries, features, bcs, pcs):
     ''' An approximate model of the memory consumption of PCA preprocessing
@@ -185,6 +341,9 @@ def get_irlb_mem_gb_from_matrix_dim(nonzero_entries, features, bcs, pcs):
         bcs * (pcs + 20) * 8 / 1e9 + \
         analysis_constants.IRLB_BASE_MEM_GB
 
+    if get_pca_engine(nonzero_entries) == analysis_constants.PCA_ENGINE_BLOCK_KRYLOV:
+        irlba_mem_gb += get_block_krylov_mem_gb(features, pcs)
+
     return max(h5_constants.MIN_MEM_GB, round(np.ceil(irlba_mem_gb)))
 
 def save_pca_csv(pca_map, matrix, base_dir):
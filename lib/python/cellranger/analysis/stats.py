@@ -8,13 +8,18 @@ Functions to compute various statistical operations on sparse matrices.
 
 import numpy as np
 import scipy
+import scipy.sparse
 from sklearn.utils import sparsefuncs
 
 
-def normalize_by_umi(matrix):
-    counts_per_bc = matrix.get_counts_per_bc()
+def get_umi_scaling_factors(counts_per_bc):
+    """ Factors that scale each barcode's total count to the median total count. """
     median_counts_per_bc = max(1.0, np.median(counts_per_bc))
-    scaling_factors = median_counts_per_bc / counts_per_bc
+    return median_counts_per_bc / counts_per_bc
+
+
+def normalize_by_umi(matrix):
+    scaling_factors = get_umi_scaling_factors(matrix.get_counts_per_bc())
 
     # Normalize each barcode's total count by median total count
     m = matrix.m.copy().astype(np.float64)
@@ -54,6 +59,101 @@ def summarize_columns(matrix):
     return np.array([mu]), np.array([var])
 
 
+# Maximum number of nonzero entries to normalize at once when streaming over the
+# columns of a sparse matrix
+STREAMING_BLOCK_NNZ = 1 << 22
+
+
+def iter_column_blocks(m, col_indices=None, max_nnz=STREAMING_BLOCK_NNZ):
+    """ Iterate over blocks of consecutive columns of a CSC matrix, bounding the number
+        of nonzero entries in each block.
+
+    Args:
+        m (scipy.sparse.csc_matrix): Matrix to iterate over.
+        col_indices (np.array of int): Columns to visit, in order. All columns if None.
+        max_nnz (int): Target maximum number of nonzero entries per block.
+
+    Yields:
+        (int, int, scipy.sparse.csc_matrix): Start and end offsets into the visited
+            columns, and the block of those columns.
+    """
+    nnz_per_col = np.diff(m.indptr)
+    if col_indices is not None:
+        nnz_per_col = nnz_per_col[col_indices]
+    cum_nnz = np.cumsum(nnz_per_col)
+    n_cols = len(nnz_per_col)
+
+    start = 0
+    while start < n_cols:
+        offset = cum_nnz[start - 1] if start > 0 else 0
+        end = max(start + 1, np.searchsorted(cum_nnz, offset + max_nnz, side='right'))
+        if col_indices is None:
+            # Slice consecutive columns without copying their entries
+            lo, hi = m.indptr[start], m.indptr[end]
+            block = scipy.sparse.csc_matrix((m.data[lo:hi], m.indices[lo:hi], m.indptr[start:end + 1] - lo),
+                                            shape=(m.shape[0], end - start))
+        else:
+            block = m[:, col_indices[start:end]]
+        yield start, end, block
+        start = end
+
+
+def normalize_block(block, col_scale, log_transform=False, dtype=np.float64):
+    """ Scale the columns of a block of counts and optionally apply log2(1+x).
+
+    Args:
+        block (scipy.sparse.csc_matrix): Block of counts.
+        col_scale (np.array of float): Scaling factor for each column of the block.
+        log_transform (bool): Whether to apply log2(1+x) to the scaled values.
+        dtype (np.dtype): Type of the normalized values.
+
+    Returns:
+        scipy.sparse.csc_matrix: Normalized block with the same sparsity pattern.
+    """
+    data = block.data * np.repeat(col_scale, np.diff(block.indptr))
+    if log_transform:
+        data = np.log2(1 + data)
+    return scipy.sparse.csc_matrix((data.astype(dtype, copy=False), block.indices, block.indptr),
+                                   shape=block.shape)
+
+
+def summarize_rows_streaming(m, col_scale, col_indices=None, log_transform=False):
+    """ Calculate mean and variance of each row of m[:, col_indices] after normalizing
+        its columns with normalize_block, without materializing the normalized matrix.
+        Agrees with summarize_columns on the transposed normalized matrix.
+
+    Args:
+        m (scipy.sparse.csc_matrix): Matrix of counts.
+        col_scale (np.array of float): Scaling factor for each visited column.
+        col_indices (np.array of int): Columns to summarize over. All columns if None.
+        log_transform (bool): Whether to apply log2(1+x) to the scaled values.
+
+    Returns:
+        (np.array of float, np.array of float): Mean and variance of each row.
+    """
+    n_rows = m.shape[0]
+    n_cols = m.shape[1] if col_indices is None else len(col_indices)
+
+    # Two passes over the matrix: the squared deviations are accumulated around the
+    # final means, which is more accurate than accumulating sums of squares.
+    sums = np.zeros(n_rows)
+    nnz = np.zeros(n_rows)
+    for start, end, block in iter_column_blocks(m, col_indices):
+        data = normalize_block(block, col_scale[start:end], log_transform).data
+        sums += np.bincount(block.indices, weights=data, minlength=n_rows)
+        nnz += np.bincount(block.indices, minlength=n_rows)
+    mu = sums / n_cols
+
+    sq_devs = np.zeros(n_rows)
+    for start, end, block in iter_column_blocks(m, col_indices):
+        data = normalize_block(block, col_scale[start:end], log_transform).data
+        sq_devs += np.bincount(block.indices, weights=np.square(data - mu[block.indices]),
+                               minlength=n_rows)
+    var = (sq_devs + (n_cols - nnz) * np.square(mu)) / n_cols
+
+    return mu, var
+
+
 def get_normalized_dispersion(mat_mean, mat_var, nbins=20):
     """ Calculates the normalized dispersion.  The dispersion is calculated for each feature
         and then normalized to see how its dispersion compares to samples that had a
@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2019 10X Genomics, Inc. All rights reserved.
+#
+# Build the indices of the installed barcode whitelists, which pipeline stages
+# memory-map instead of parsing the whitelists. Without them, the first stage that
+# needs an index builds it into a per-user cache. Run after installing or updating
+# whitelists:
+#
+#   python -m cellranger.barcodes.build_whitelist_indices
+
+import cellranger.chemistry as cr_chemistry
+
+def main():
+    for index_path in cr_chemistry.build_barcode_whitelist_indices():
+        print index_path
+
+if __name__ == '__main__':
+    main()
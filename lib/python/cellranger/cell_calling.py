@@ -93,12 +93,16 @@ NonAmbientBarcodeResult = namedtuple('NonAmbientBarcodeResult',
 def find_nonambient_barcodes(matrix, orig_cell_bcs,
                              min_umi_frac_of_median=MIN_UMI_FRAC_OF_MEDIAN,
                              min_umis_nonambient=MIN_UMIS,
-                             max_adj_pvalue=MAX_ADJ_PVALUE,):
+                             max_adj_pvalue=MAX_ADJ_PVALUE,
+                             num_procs=1,
+                             sim_cache_dir=None):
     """ Call barcodes as being sufficiently distinct from the ambient profile
 
     Args:
       matrix (CountMatrix): Full expression matrix.
       orig_cell_bcs (iterable of str): Strings of initially-called cell barcodes.
+      num_procs (int): Number of processes for simulating ambient log-likelihoods.
+      sim_cache_dir (str): Directory in which to cache simulated log-likelihoods.
     Returns:
     TBD
     """
@@ -169,7 +173,8 @@ def find_nonambient_barcodes(matrix, orig_cell_bcs,
     obs_loglk = cr_stats.eval_multinomial_loglikelihoods(eval_mat, ambient_profile_p)
 
     # Simulate log likelihoods
-    distinct_ns, sim_loglk = cr_stats.simulate_multinomial_loglikelihoods(ambient_profile_p, umis_per_bc[eval_bcs], num_sims=10000, verbose=True)
+    distinct_ns, sim_loglk = cr_stats.simulate_multinomial_loglikelihoods_parallel(ambient_profile_p, umis_per_bc[eval_bcs], num_sims=10000,
+                                                                                  num_procs=num_procs, cache_dir=sim_cache_dir, verbose=True)
 
     # Compute p-values
     pvalues = cr_stats.compute_ambient_pvalues(umis_per_bc[eval_bcs], obs_loglk, distinct_ns, sim_loglk)
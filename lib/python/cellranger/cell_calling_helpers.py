@@ -46,9 +46,10 @@ def remove_bcs_with_high_umi_corrected_reads(correction_data, matrix):
         and remove them from the CoutMatrix """
 
     bcs_to_remove, reads_lost, removed_bcs_df = ab_utils.detect_aggregate_bcs(correction_data)
-    bcs_to_remove = set(matrix.bc_to_int(bc) for bc in bcs_to_remove)
+    keep = np.ones(matrix.bcs_dim, dtype=bool)
+    keep[matrix.bcs_to_ints(list(bcs_to_remove))] = False
     # make sure filtered_bcs is in deterministic order or any later bootstrap sampling will not be deterministic
-    filtered_bcs = [i for i in xrange(matrix.bcs_dim) if i not in bcs_to_remove]
+    filtered_bcs = np.flatnonzero(keep)
     cleaned_matrix = matrix.select_barcodes(filtered_bcs)
 
     ### report how many aggregates were found, and the fraction of reads those accounted for
@@ -123,7 +124,7 @@ def _call_cells_by_gem_group(gg_matrix, unique_gem_groups, method, gg_recovered_
 
     return gg_filtered_metrics, gg_filtered_bcs
 
-def call_additional_cells(matrix, unique_gem_groups, genomes, filtered_bcs_groups):
+def call_additional_cells(matrix, unique_gem_groups, genomes, filtered_bcs_groups, num_procs=1):
     # Track these for recordkeeping
     eval_bcs_arrays = []
     umis_per_bc_arrays = []
@@ -141,7 +142,7 @@ def call_additional_cells(matrix, unique_gem_groups, genomes, filtered_bcs_group
         gg_bcs = sorted(list(reduce(set.union,
                                     [set(bcs) for group, bcs in filtered_bcs_groups.iteritems() if group[0] == gg])))
 
-        result = cr_cell.find_nonambient_barcodes(gg_matrix, gg_bcs)
+        result = cr_cell.find_nonambient_barcodes(gg_matrix, gg_bcs, num_procs=num_procs)
         if result is None:
             print 'Failed at attempt to call non-ambient barcodes in GEM well %s' % gg
             continue
@@ -7,6 +7,9 @@
 #
 from collections import OrderedDict
 import copy
+import itertools
+import os
+import numpy as np
 import tenkit.constants as tk_constants
 import tenkit.fasta as tk_fasta
 import tenkit.stats as tk_stats
@@ -14,7 +17,6 @@ import cellranger.constants as cr_constants
 import cellranger.fastq as cr_fastq
 import cellranger.utils as cr_utils
 import cellranger.io as cr_io
-import array
 
 class NoInputFastqsException(Exception):
     pass
@@ -521,9 +523,17 @@ def get_si_read_def(chemistry):
 def get_barcode_whitelist(chemistry):
     return chemistry['barcode_whitelist']
 
-def _get_barcode_whitelist_set(chemistry):
-    return cr_utils.load_barcode_whitelist(get_barcode_whitelist(chemistry),
-                                           as_set=True)
+def _get_barcode_whitelist_index(chemistry):
+    return cr_utils.load_barcode_whitelist_index(get_barcode_whitelist(chemistry))
+
+def build_barcode_whitelist_indices():
+    """ Build the indices of the installed whitelists of all defined chemistries.
+    Returns (list of str): Paths of the index directories. """
+    index_paths = []
+    for whitelist in sorted(set(get_barcode_whitelist(chemistry) for chemistry in DEFINED_CHEMISTRIES)):
+        if whitelist is not None and os.path.isfile(cr_utils.get_barcode_whitelist_path(whitelist)):
+            index_paths.append(cr_utils.build_barcode_whitelist_index(whitelist))
+    return index_paths
 
 def get_read_type_map(chemistry, fastq_mode):
     """ Get the mapping of read type to fastq filename for a given chemistry. """
@@ -562,47 +572,122 @@ def get_chemistry_description_from_name(name):
         return get_chemistry(name)['description']
 
 
-def _compute_frac_barcodes_on_whitelist(fastqs, barcode_whitelist_set, reads_interleaved, read_def, tolerate_n=True):
-    """ Compute fraction of observed barcodes on the barcode whitelist """
+def _count_barcodes_on_whitelist(barcodes, whitelist, tolerate_n=True):
+    """ Count the barcodes that are on the whitelist.
+    Args:
+      barcodes (list of str): Barcode sequences.
+      whitelist (BarcodeWhitelistIndex): Whitelist to look them up in.
+      tolerate_n (bool): If a barcode with an N is off the whitelist, check if we can
+                         replace its first N with a valid base & get a whitelist hit.
+                         This makes us robust to N-cycles.
+    Returns:
+      int: Number of barcodes on the whitelist.
+    """
+    on_whitelist = whitelist.contains(barcodes)
+    num_on_whitelist = int(np.count_nonzero(on_whitelist))
+
+    if tolerate_n:
+        misses = [bc for bc, hit in itertools.izip(barcodes, on_whitelist) if not hit and 'N' in bc]
+        if misses:
+            variants = [bc.replace('N', base, 1) for base in 'ACGT' for bc in misses]
+            rescued = whitelist.contains(variants).reshape(4, len(misses)).any(axis=0)
+            num_on_whitelist += int(np.count_nonzero(rescued))
+
+    return num_on_whitelist
+
+def _iter_barcode_read_blocks(fastqs, read_type, reads_interleaved):
+    """ Yield blocks of untrimmed read sequences of one read type, from each FASTQ in turn,
+    up to DETECT_CHEMISTRY_INITIAL_READS reads """
     num_reads = 0
-    barcodes_on_whitelist = 0
-
+    read_def = cr_constants.ReadDef(read_type, 0, None)
     for fastq in fastqs:
-        barcode_reads = cr_fastq.FastqReader({read_def.read_type: fastq},
-                                             read_def,
-                                             reads_interleaved,
-                                             None, None)
-
-        for read in barcode_reads.in_iter:
-            if num_reads == cr_constants.DETECT_CHEMISTRY_INITIAL_READS:
-                break
-
-            _, barcode, _ = read
-
-            num_reads += 1
-            if barcode in barcode_whitelist_set:
-                barcodes_on_whitelist += 1
-            elif tolerate_n and 'N' in barcode:
-
-                # If there's a single N in the barcode, check if
-                # we can can replace the N with a valid base & get
-                # a whitelist hit. This makes us robust to N-cycles.
-                npos = barcode.find("N")
-                a = array.array('c', barcode)
-                for base in ['A', 'C', 'G', 'T']:
-                    a[npos] = base
-                    new_barcode = a.tostring()
-                    if new_barcode in barcode_whitelist_set:
-                        barcodes_on_whitelist += 1
-                        break
-
-        if num_reads == cr_constants.DETECT_CHEMISTRY_INITIAL_READS:
+        reader = cr_fastq.FastqReader({read_type: fastq}, read_def, reads_interleaved, None, None)
+        try:
+            for block in reader.iter_blocks(cr_constants.DETECT_CHEMISTRY_BLOCK_READS):
+                block = block[:cr_constants.DETECT_CHEMISTRY_INITIAL_READS - num_reads]
+                num_reads += len(block)
+                yield [seq for _, seq, _ in block]
+                if num_reads == cr_constants.DETECT_CHEMISTRY_INITIAL_READS:
+                    return
+        finally:
+            reader.close()
+
+def _can_stop_chemistry_detection(hits, reads, done):
+    """ Sequential test for stopping chemistry detection early.
+    Each chemistry's whitelist fraction is bounded by a Hoeffding confidence interval;
+    chemistries whose reads are exhausted have exact fractions. We can stop once the
+    intervals show that no chemistry reaches the minimum fraction, or that the best one
+    does and beats all the others.
+    Args:
+      hits (np.array(int)): Barcodes on each chemistry's whitelist so far.
+      reads (np.array(int)): Reads evaluated for each chemistry so far.
+      done (np.array(bool)): Whether each chemistry's reads are exhausted.
+    Returns:
+      bool
+    """
+    if np.any(~done & (reads < cr_constants.DETECT_CHEMISTRY_EARLY_STOP_MIN_READS)):
+        return False
+
+    n = np.maximum(reads, 1).astype(float)
+    fracs = hits / n
+    half_width = np.sqrt(np.log(2.0 * len(hits) / cr_constants.DETECT_CHEMISTRY_EARLY_STOP_ERROR) / (2.0 * n))
+    half_width[done] = 0
+    lower, upper = fracs - half_width, fracs + half_width
+
+    if np.all(upper < cr_constants.DETECT_CHEMISTRY_MIN_FRAC_WHITELIST):
+        return True
+
+    best = np.argmax(fracs)
+    others_upper = np.delete(upper, best)
+    return lower[best] >= cr_constants.DETECT_CHEMISTRY_MIN_FRAC_WHITELIST and \
+        (len(others_upper) == 0 or lower[best] > others_upper.max())
+
+def _compute_frac_barcodes_on_whitelists(chemistries, fq_spec, early_stop=True):
+    """ Compute the fraction of observed barcodes on the whitelist of each chemistry.
+    Reads are sampled once per barcode FASTQ read type and evaluated against all the
+    chemistries that share them, reading the read types in lock-step.
+    Args:
+      chemistries (list of dict): Candidate chemistries.
+      fq_spec (FastqSpec): For a single sample index/name.
+      early_stop (bool): Stop reading once _can_stop_chemistry_detection says the
+                         outcome is settled, rather than reading DETECT_CHEMISTRY_INITIAL_READS.
+    Returns:
+      list of float: Fraction of barcodes on the whitelist, per chemistry.
+    """
+    # Group chemistries by the reads they take barcodes from
+    groups = OrderedDict()
+    for chem_idx, chemistry in enumerate(chemistries):
+        read_type = get_barcode_read_def(chemistry).read_type
+        fastq_read_type = get_read_type_map(chemistry, fq_spec.fastq_mode)[read_type]
+        key = (tuple(fq_spec.get_fastqs(fastq_read_type)), read_type)
+        groups.setdefault(key, []).append(chem_idx)
+
+    read_slices = [cr_fastq.get_read_def_slice(get_barcode_read_def(chemistry)) for chemistry in chemistries]
+    whitelists = [_get_barcode_whitelist_index(chemistry) for chemistry in chemistries]
+
+    hits = np.zeros(len(chemistries), dtype=int)
+    reads = np.zeros(len(chemistries), dtype=int)
+    done = np.zeros(len(chemistries), dtype=bool)
+    active = [(_iter_barcode_read_blocks(fastqs, read_type, fq_spec.interleaved), chem_inds)
+              for (fastqs, read_type), chem_inds in groups.iteritems()]
+
+    while active:
+        for group in list(active):
+            block_iter, chem_inds = group
+            seqs = next(block_iter, None)
+            if seqs is None:
+                done[chem_inds] = True
+                active.remove(group)
+                continue
+            for chem_idx in chem_inds:
+                barcodes = [seq[read_slices[chem_idx]] for seq in seqs]
+                hits[chem_idx] += _count_barcodes_on_whitelist(barcodes, whitelists[chem_idx])
+                reads[chem_idx] += len(seqs)
+
+        if early_stop and active and _can_stop_chemistry_detection(hits, reads, done):
             break
 
-    if num_reads > 0:
-        return tk_stats.robust_divide(barcodes_on_whitelist, num_reads)
-    else:
-        return 0.0
+    return [tk_stats.robust_divide(h, r) if r > 0 else 0.0 for h, r in itertools.izip(hits, reads)]
 
 def _compute_r1_length(fastqs, reads_interleaved):
     """ Infer the length of R1 """
@@ -670,11 +755,7 @@ def check_whitelist_match(chemistry_name, fq_spec):
 
     print fastqs
 
-    whitelist = _get_barcode_whitelist_set(chemistry)
-    wl_frac = _compute_frac_barcodes_on_whitelist(fastqs,
-                                                  whitelist,
-                                                  reads_interleaved=fq_spec.interleaved,
-                                                  read_def=barcode_read_def)
+    wl_frac, = _compute_frac_barcodes_on_whitelists([chemistry], fq_spec)
 
     if wl_frac >= cr_constants.DETECT_CHEMISTRY_MIN_FRAC_WHITELIST:
         return None
@@ -696,22 +777,15 @@ def infer_sc3p_chemistry(fq_spec):
     best_chem, best_frac = None, float('-inf')
 
     n_fastqs = 0
-
     for chemistry in SC3P_CHEMISTRIES:
         # Get the FASTQs containing the barcode for this chemistry
         barcode_read_def = get_barcode_read_def(chemistry)
         read_type = get_read_type_map(chemistry, fq_spec.fastq_mode)[barcode_read_def.read_type]
+        n_fastqs += len(fq_spec.get_fastqs(read_type))
 
-        fastqs = fq_spec.get_fastqs(read_type)
-        n_fastqs += len(fastqs)
-
-        whitelist = _get_barcode_whitelist_set(chemistry)
-
-        wl_frac = _compute_frac_barcodes_on_whitelist(fastqs,
-                                                      whitelist,
-                                                      reads_interleaved=fq_spec.interleaved,
-                                                      read_def=barcode_read_def)
+    wl_fracs = _compute_frac_barcodes_on_whitelists(SC3P_CHEMISTRIES, fq_spec)
 
+    for chemistry, wl_frac in itertools.izip(SC3P_CHEMISTRIES, wl_fracs):
         if wl_frac > best_frac:
             best_chem, best_frac = chemistry['name'], wl_frac
 
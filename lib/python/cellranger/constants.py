@@ -262,6 +262,8 @@ REFERENCE_STAR_PATH = 'star'
 REFERENCE_FASTA_PATH = 'fasta/genome.fa'
 REFERENCE_GENES_GTF_PATH = 'genes/genes.gtf'
 REFERENCE_GENES_INDEX_PATH = 'pickle/genes.pickle'
+REFERENCE_GENES_BINARY_INDEX_PATH = 'pickle/genes_index'
+REFERENCE_TRANSCRIPTS_TSV_PATH = 'pickle/transcripts.tab'
 REFERENCE_GENOMES_KEY = 'genomes'
 REFERENCE_MEM_GB_KEY = 'mem_gb'
 REFERENCE_NUM_THREADS_KEY = 'threads'
@@ -341,6 +343,12 @@ DETECT_5P_CHEMISTRY_MIN_R1_LEN_PE = 50
 # 26bcumi + 13spacer + 50bp for assembler
 DETECT_VDJ_CHEMISTRY_MIN_R1_LEN_PE = 90
 DETECT_CHEMISTRY_INITIAL_READS = 100000
+# Reads evaluated per step of chemistry detection
+DETECT_CHEMISTRY_BLOCK_READS = 10000
+# Chemistry detection may stop early after this many reads per barcode read type,
+# if every whitelist fraction is within its confidence interval with this error rate
+DETECT_CHEMISTRY_EARLY_STOP_MIN_READS = 10000
+DETECT_CHEMISTRY_EARLY_STOP_ERROR = 1e-6
 
 
 """PIPELINE NAMES"""
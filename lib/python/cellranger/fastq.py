@@ -12,13 +12,15 @@ import numpy as np
 
 import tenkit.constants as tk_constants
 import tenkit.fasta as tk_fasta
-import tenkit.safe_json as tk_safe_json
 import tenkit.seq as tk_seq
 import cellranger.constants as cr_constants
 import cellranger.h5_constants as h5_constants
 import cellranger.utils as cr_utils
 import cellranger.io as cr_io
 
+# Number of barcodes BarcodeCounter buffers before a batch whitelist lookup
+BARCODE_COUNT_BATCH_SIZE = 100000
+
 def get_bamtofastq_defs(read_defs, destination_tags):
     """ Determine which portions of reads need to be retained.
         Args: read_defs - list(ReadDef)
@@ -61,20 +63,16 @@ def get_bamtofastq_defs(read_defs, destination_tags):
 
 
 def infer_barcode_reverse_complement(barcode_whitelist, read_iter):
+    """ Args: barcode_whitelist (BarcodeWhitelistIndex): Whitelist or None
+              read_iter: Iterator of (name, seq, qual) barcode reads
+        Returns: True if the barcodes should be reverse complemented """
     if barcode_whitelist is None:
         return False
-    reg_valid_count = 0
-    rc_valid_count = 0
-    N_bc_count = 0
-    nbc = 0
-    for _, seq, _ in itertools.islice(read_iter, cr_constants.NUM_CHECK_BARCODES_FOR_ORIENTATION):
-        nbc += 1
-        if "N" in seq:
-            N_bc_count += 1
-        if seq in barcode_whitelist:
-            reg_valid_count += 1
-        if tk_seq.get_rev_comp(seq) in barcode_whitelist:
-            rc_valid_count += 1
+    seqs = [seq for _, seq, _ in itertools.islice(read_iter, cr_constants.NUM_CHECK_BARCODES_FOR_ORIENTATION)]
+    nbc = len(seqs)
+    N_bc_count = sum(1 for seq in seqs if "N" in seq)
+    reg_valid_count = int(np.count_nonzero(barcode_whitelist.contains(seqs)))
+    rc_valid_count = int(np.count_nonzero(barcode_whitelist.contains([tk_seq.get_rev_comp(seq) for seq in seqs])))
 
     if reg_valid_count:
         return rc_valid_count >= ((rc_valid_count + reg_valid_count) *
@@ -88,50 +86,74 @@ def infer_barcode_reverse_complement(barcode_whitelist, read_iter):
 class BarcodeCounter:
     def __init__(self, barcode_whitelist, out_counts, gem_groups=None):
         self.barcode_counts = None
-        self.barcode_index = None
         self.out_counts = out_counts
-        self.barcode_seqs = cr_utils.load_barcode_whitelist(barcode_whitelist)
-        if self.barcode_seqs:
-            self.barcode_seqs = cr_utils.format_barcode_seqs(self.barcode_seqs, gem_groups)
-            self.barcode_counts = np.zeros(len(self.barcode_seqs), dtype=np.uint32)
-            self.barcode_index = {bc: index for index, bc in enumerate(self.barcode_seqs)}
+        self.pending_seqs = []
+        self.barcode_index = cr_utils.load_barcode_whitelist_index(barcode_whitelist)
+        if self.barcode_index is not None:
+            # Counts are laid out as the whitelist repeated once per unique gem group
+            self.gem_group_offsets = None
+            num_gem_groups = 1
+            if gem_groups is not None:
+                unique_gem_groups = sorted(set(gem_groups))
+                self.gem_group_offsets = {gg: i * len(self.barcode_index) for i, gg in enumerate(unique_gem_groups)}
+                num_gem_groups = len(unique_gem_groups)
+            self.barcode_counts = np.zeros(num_gem_groups * len(self.barcode_index), dtype=np.uint32)
 
     def count(self, name, seq, qual):
-        if self.barcode_seqs:
-            index = self.barcode_index.get(seq)
-            if index is not None:
-                self.barcode_counts[index] += 1
+        if self.barcode_index is not None:
+            self.pending_seqs.append(seq)
+            if len(self.pending_seqs) >= BARCODE_COUNT_BATCH_SIZE:
+                self.flush()
+
+    def flush(self):
+        """ Look up buffered barcodes in the whitelist index and count them """
+        if not self.pending_seqs:
+            return
+        seqs = self.pending_seqs
+        self.pending_seqs = []
+
+        if self.gem_group_offsets is None:
+            indices = self.barcode_index.get_indices(seqs)
+        else:
+            bcs, ggs = zip(*[cr_utils.split_barcode_seq(seq) for seq in seqs])
+            offsets = np.array([self.gem_group_offsets.get(gg, -1) for gg in ggs], dtype=np.int64)
+            indices = self.barcode_index.get_indices(bcs)
+            indices = np.where((indices >= 0) & (offsets >= 0), indices + offsets, -1)
 
-    def merge(self, gem_group, out_counts):
-        if self.barcode_seqs:
-            with open(out_counts, 'r') as f:
-                barcode_counts = json.load(f)
+        indices = indices[indices >= 0]
+        self.barcode_counts += np.bincount(indices, minlength=len(self.barcode_counts)).astype(np.uint32)
 
-            start = (gem_group-1)*len(barcode_counts)
-            end = gem_group*len(barcode_counts)
-            self.barcode_counts[start:end] += np.array(barcode_counts, dtype=np.uint32)
+    def merge(self, gem_group, out_counts):
+        if self.barcode_index is not None:
+            size, indices, counts = read_sparse_barcode_counts(out_counts)
+            self.barcode_counts[(gem_group-1)*size + indices] += counts
+
+    def get_counts(self):
+        """ Returns the barcode counts as a uint32 array (empty if there is no whitelist) """
+        if self.barcode_index is not None:
+            self.flush()
+            return self.barcode_counts
+        else:
+            return np.zeros(0, dtype=np.uint32)
 
     def to_json(self):
-        if self.barcode_seqs:
-            return list(self.barcode_counts)
-        else:
-            return []
+        return self.get_counts().tolist()
 
     def close(self):
-        if self.barcode_seqs:
-            with open(self.out_counts, 'w') as f:
-                tk_safe_json.dump_numpy(self.to_json(), f)
+        if self.barcode_index is not None:
+            write_sparse_barcode_counts(self.out_counts, self.get_counts())
 
     @staticmethod
     def merge_by(counter_files, keys, barcode_whitelist, gem_groups):
         """ Merge BarcodeCounters by a key.
+        Chunk files are summed into one count array per key as they are read.
         Args:
           counter_files (list of str): Filenames of BarcodeCounter outputs
           keys (list of str): Keys to group by
-          barcode_whitelist (list of str): Same as BarcodeCounter constructor
+          barcode_whitelist (str): Same as BarcodeCounter constructor
           gem_groups (list of int): Same as BarcodeCounter constructor
         Returns:
-          dict of str:dict: Keys are the group keys and dicts are serialized BarcodeCounters
+          dict of str:np.array(uint32): Keys are the group keys and arrays are merged barcode counts
         """
         distinct_keys = sorted(list(set(keys)))
         groups = {}
@@ -139,7 +161,36 @@ class BarcodeCounter:
             groups[key] = BarcodeCounter(barcode_whitelist, None, gem_groups)
         for key, filename, gg in zip(keys, counter_files, gem_groups):
             groups[key].merge(gg, filename)
-        return {key: group.to_json() for key, group in groups.iteritems()}
+        return {key: group.get_counts() for key, group in groups.iteritems()}
+
+def write_sparse_barcode_counts(filename, counts):
+    """ Write a barcode count array as its nonzero (index, count) pairs.
+    Args:
+      filename (str): Output .npz filename
+      counts (np.array(uint32)): Counts indexed by barcode
+    """
+    indices = np.flatnonzero(counts).astype(np.uint32)
+    with open(filename, 'wb') as f:
+        np.savez(f, size=np.array(len(counts), dtype=np.uint64),
+                 indices=indices, counts=counts[indices].astype(np.uint32))
+
+def read_sparse_barcode_counts(filename):
+    """ Read a file written by write_sparse_barcode_counts.
+    Returns:
+      (int, np.array(uint32), np.array(uint32)): Length of the count array, and the
+                                                 indices and values of its nonzero entries
+    """
+    with np.load(filename) as data:
+        return int(data['size']), data['indices'], data['counts']
+
+def write_barcode_counts_json(counts_by_key, filename):
+    """ Write merged barcode counts in the JSON format read by annotate_reads.
+    Args:
+      counts_by_key (dict of str:np.array): Output of BarcodeCounter.merge_by
+      filename (str): Output JSON filename
+    """
+    with open(filename, 'w') as f:
+        json.dump({key: counts.tolist() for key, counts in counts_by_key.iteritems()}, f)
 
 def extract_read_maybe_paired(read_tuple, read_def, reads_interleaved, r1_length=None, r2_length=None):
     """ Args: read_tuple: (name, read, qual)
@@ -155,6 +206,16 @@ def extract_read_maybe_paired(read_tuple, read_def, reads_interleaved, r1_length
     else:
         name, seq, qual = read_tuple
 
+    read_slice = get_read_def_slice(read_def, r1_length, r2_length)
+
+    return (name, seq[read_slice], qual[read_slice])
+
+def get_read_def_slice(read_def, r1_length=None, r2_length=None):
+    """ Get the slice of a read sequence selected by a read def, after hard trimming.
+        Args: read_def: ReadDef object
+              r1_length (int): Hard trim on 3' end of input R1
+              r2_length (int): Hard trim on 3' end of input R2
+        Returns: slice """
     # Apply hard trimming on input
     hard_end = sys.maxint
     if read_def.read_type == 'R1' and r1_length is not None:
@@ -165,17 +226,56 @@ def extract_read_maybe_paired(read_tuple, read_def, reads_interleaved, r1_length
     # Extract interval requested by the read def
     if read_def.length is not None:
         end = min(hard_end, read_def.offset + read_def.length)
-        read_slice = slice(read_def.offset, end)
+        return slice(read_def.offset, end)
     else:
-        read_slice = slice(read_def.offset, hard_end)
-
-    return (name, seq[read_slice], qual[read_slice])
+        return slice(read_def.offset, hard_end)
 
 def get_read_generator_fastq(fastq_open_file, read_def, reads_interleaved, r1_length=None, r2_length=None):
     read_iter = tk_fasta.read_generator_fastq(fastq_open_file, paired_end=reads_interleaved and read_def.read_type in ['R1', 'R2'])
     for read_tuple in read_iter:
         yield extract_read_maybe_paired(read_tuple, read_def, reads_interleaved, r1_length, r2_length)
 
+def read_fastq_blocks(fastq_file, block_size, paired_end=False):
+    """ Iterate over a fastq file in blocks of records.
+        Yields the same records as tk_fasta.read_generator_fastq, but parses a block
+        of lines at a time with list slicing instead of line by line.
+        Args: fastq_file: open fastq file
+              block_size (int): number of records (or pairs, if paired_end) per block
+              paired_end (bool): file is interleaved; yield 6-tuples of both reads
+        Yields: list of (name, seq, qual) or (name1, seq1, qual1, name2, seq2, qual2) """
+    lines_per_record = 8 if paired_end else 4
+    while True:
+        lines = list(itertools.islice(fastq_file, block_size * lines_per_record))
+
+        # Drop an incomplete trailing record
+        num_lines = lines_per_record * (len(lines) / lines_per_record)
+        if num_lines == 0:
+            return
+
+        names1 = [line.strip()[1:] for line in lines[0:num_lines:lines_per_record]]
+        seqs1 = [line.strip() for line in lines[1:num_lines:lines_per_record]]
+        quals1 = [line.strip() for line in lines[3:num_lines:lines_per_record]]
+        if paired_end:
+            names2 = [line.strip()[1:] for line in lines[4:num_lines:lines_per_record]]
+            seqs2 = [line.strip() for line in lines[5:num_lines:lines_per_record]]
+            quals2 = [line.strip() for line in lines[7:num_lines:lines_per_record]]
+            yield zip(names1, seqs1, quals1, names2, seqs2, quals2)
+        else:
+            yield zip(names1, seqs1, quals1)
+
+def get_read_block_generator_fastq(fastq_open_file, read_def, reads_interleaved, block_size,
+                                   r1_length=None, r2_length=None):
+    """ Blocked equivalent of get_read_generator_fastq.
+        Yields: list of (name, seq, qual) """
+    paired_end = reads_interleaved and read_def.read_type in ['R1', 'R2']
+    read_slice = get_read_def_slice(read_def, r1_length, r2_length)
+
+    for block in read_fastq_blocks(fastq_open_file, block_size, paired_end=paired_end):
+        if paired_end and read_def.read_type == 'R2':
+            yield [(r[3], r[4][read_slice], r[5][read_slice]) for r in block]
+        else:
+            yield [(r[0], r[1][read_slice], r[2][read_slice]) for r in block]
+
 def get_feature_generator_fastq(files, extractor, interleaved, read_types, r1_length=None, r2_length=None):
     '''Extract feature barcodes from FASTQs.
 
@@ -192,10 +292,6 @@ def get_feature_generator_fastq(files, extractor, interleaved, read_types, r1_le
     assert len(files) == 2
     assert 'R1' in read_types or 'R2' in read_types
 
-    # Apply hard trimming on input
-    r1_hard_end = sys.maxint if r1_length is None else r1_length
-    r2_hard_end = sys.maxint if r2_length is None else r2_length
-
     if interleaved:
         f = files[0]
         assert f
@@ -207,6 +303,50 @@ def get_feature_generator_fastq(files, extractor, interleaved, read_types, r1_le
         r2_iter = tk_fasta.read_generator_fastq(files[1], paired_end=False) if 'R2' in read_types else iter([])
         pair_iter = itertools.izip_longest(r1_iter, r2_iter)
 
+    return itertools.imap(get_feature_match_func(extractor, read_types, r1_length, r2_length),
+                          pair_iter)
+
+def get_feature_pair_block_generator_fastq(files, interleaved, read_types, block_size):
+    '''Blocked read pairs for feature barcode extraction.
+
+    Args:
+       files (list of File): FASTQ file handles for R1, R2
+       interleaved (bool): Are R1,R2 interleaved in a single file
+       read_types (list of str): List of read types (e.g. R1,R2) we need to inspect
+       block_size (int): Number of read pairs per block
+    Returns:
+       list of ((name, seq, qual), (name, seq, qual)): Yields blocks of R1, R2 records;
+           a record is None if its read type is not inspected.
+'''
+    assert len(files) == 2
+    assert 'R1' in read_types or 'R2' in read_types
+
+    if interleaved:
+        f = files[0]
+        assert f
+        for block in read_fastq_blocks(f, block_size, paired_end=True):
+            yield [(x[0:3], x[3:6]) for x in block]
+    else:
+        r1_iter = read_fastq_blocks(files[0], block_size) if 'R1' in read_types else iter([])
+        r2_iter = read_fastq_blocks(files[1], block_size) if 'R2' in read_types else iter([])
+        for r1_block, r2_block in itertools.izip_longest(r1_iter, r2_iter, fillvalue=[]):
+            yield list(itertools.izip_longest(r1_block, r2_block))
+
+def get_feature_match_func(extractor, read_types, r1_length=None, r2_length=None):
+    '''Get a function that extracts feature barcodes from an (R1, R2) pair of fastq records.
+
+    Args:
+       extractor (FeatureExtractor): Extracts feature barcodes
+       read_types (list of str): List of read types (e.g. R1,R2) we need to inspect
+       r1_length (int): Length to hard-trim R1 to
+       r2_length (int): Length to hard-trim R2 to
+    Returns:
+       function: Maps a pair of (name, seq, qual) records to a FeatureMatchResult
+'''
+    # Apply hard trimming on input
+    r1_hard_end = sys.maxint if r1_length is None else r1_length
+    r2_hard_end = sys.maxint if r2_length is None else r2_length
+
     if read_types == ['R1']:
         match_func = lambda x: extractor.extract_single_end(x[0][1][0:r1_hard_end], # seq
                                                             x[0][2][0:r1_hard_end], # qual
@@ -223,7 +363,7 @@ def get_feature_generator_fastq(files, extractor, interleaved, read_types, r1_le
                                                             x[1][1][0:r2_hard_end], # seq
                                                             x[1][2][0:r2_hard_end]) # qual
 
-    return itertools.imap(match_func, pair_iter)
+    return match_func
 
 
 def get_fastq_from_read_type(fastq_dict, read_def, reads_interleaved):
@@ -260,6 +400,9 @@ class FastqReader:
         self.in_fastq = None
         self.in_iter = iter([])
         self.read_def = read_def
+        self.reads_interleaved = reads_interleaved
+        self.r1_length = r1_length
+        self.r2_length = r2_length
 
         if in_filenames:
             in_filename = get_fastq_from_read_type(in_filenames,
@@ -280,6 +423,14 @@ class FastqReader:
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+    def iter_blocks(self, block_size):
+        """ Iterate over the extracted reads in blocks. Use instead of in_iter, not with it.
+            Yields: list of (name, seq, qual) """
+        if self.in_fastq is None:
+            return iter([])
+        return get_read_block_generator_fastq(self.in_fastq, self.read_def, self.reads_interleaved,
+                                              block_size, self.r1_length, self.r2_length)
+
     def close(self):
         if self.in_fastq:
             self.in_fastq.close()
@@ -297,9 +448,11 @@ class FastqFeatureReader:
 
         self.in_fastqs = None
         self.in_iter = iter([])
+        self.reads_interleaved = reads_interleaved
 
         # Relevant read types
         read_types = extractor.get_read_types()
+        self.read_types = read_types
 
         if in_filenames:
             in_filenames = get_fastqs_from_feature_ref(in_filenames,
@@ -320,6 +473,15 @@ class FastqFeatureReader:
                                                            read_types=read_types,
                                                            r1_length=r1_length,
                                                            r2_length=r2_length)
+
+    def iter_pair_blocks(self, block_size):
+        ''' Iterate over blocks of unprocessed (R1, R2) records. Use instead of in_iter, not with it.
+            Pass each pair to get_feature_match_func to extract feature barcodes. '''
+        if self.in_fastqs is None:
+            return iter([])
+        return get_feature_pair_block_generator_fastq(self.in_fastqs, self.reads_interleaved,
+                                                      self.read_types, block_size)
+
     def close(self):
         if self.in_fastqs:
             for f in self.in_fastqs:
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2019 10X Genomics, Inc. All rights reserved.
+#
+
+"""
+Storage profiles for the per-row datasets of molecule info and matrix HDF5 files.
+
+A profile selects the compression filter and the size of each HDF5 chunk. Reading
+gzip-compressed files is dominated by decompression, so files that are only read back
+by later stages use a fast filter while files delivered to users keep gzip.
+"""
+
+from collections import namedtuple
+import os
+import time
+import h5py
+import numpy as np
+
+# compression -- h5py filter name, or None for uncompressed.
+# shuffle     -- Apply the byte shuffle filter. None keeps the writer's default.
+# chunk_bytes -- Target size of one HDF5 chunk; the number of elements per chunk is derived
+#                from each column's dtype. None keeps the writer's default chunk length.
+StorageProfile = namedtuple('StorageProfile', ['compression', 'shuffle', 'chunk_bytes'])
+
+STORAGE_PROFILE_GZIP = 'gzip'
+STORAGE_PROFILE_LZF = 'lzf'
+STORAGE_PROFILE_UNCOMPRESSED = 'uncompressed'
+
+STORAGE_PROFILES = {
+    # Smallest files; the layout of existing outputs is unchanged
+    STORAGE_PROFILE_GZIP: StorageProfile(compression='gzip', shuffle=None, chunk_bytes=None),
+    # Much faster to write and faster to read than gzip, for larger files.
+    # Chunks fit in the default 1 MiB h5py chunk cache.
+    STORAGE_PROFILE_LZF: StorageProfile(compression='lzf', shuffle=False, chunk_bytes=1 << 18),
+    # Fastest, for short-lived files on local disk
+    STORAGE_PROFILE_UNCOMPRESSED: StorageProfile(compression=None, shuffle=False, chunk_bytes=1 << 20),
+}
+
+# Files that are pipeline outputs
+DELIVERABLE_STORAGE_PROFILE = STORAGE_PROFILE_GZIP
+
+# Files only read by later stages of the same pipeline
+SCRATCH_STORAGE_PROFILE = STORAGE_PROFILE_LZF
+
+def get_storage_profile(name):
+    """ Look up a storage profile by name (DELIVERABLE_STORAGE_PROFILE if None). """
+    if name is None:
+        name = DELIVERABLE_STORAGE_PROFILE
+    if name not in STORAGE_PROFILES:
+        raise ValueError('Unknown HDF5 storage profile: %s' % name)
+    return STORAGE_PROFILES[name]
+
+def get_dataset_kwargs(profile_name, dtype, chunk_len, shuffle=False):
+    """ Keyword arguments to h5py create_dataset for a chunked 1-d dataset.
+
+    Args:
+        profile_name (str): Storage profile name, or None for the default.
+        dtype (np.dtype): Type of the dataset.
+        chunk_len (int): Elements per chunk when the profile doesn't set chunk_bytes.
+        shuffle (bool): Byte shuffle when the profile doesn't set shuffle.
+    """
+    profile = get_storage_profile(profile_name)
+    if profile.chunk_bytes is not None:
+        chunk_len = max(1, profile.chunk_bytes // np.dtype(dtype).itemsize)
+    return {
+        'compression': profile.compression,
+        'shuffle': shuffle if profile.shuffle is None else profile.shuffle,
+        'chunks': (chunk_len,),
+    }
+
+def benchmark_storage_profiles(filename, dataset_names, out_dir, chunk_len, shuffle=False,
+                               profile_names=None):
+    """ Rewrite 1-d datasets of an HDF5 file with each storage profile, and time
+    writing them and reading them back.
+
+    Args:
+        filename (str): HDF5 file to read the datasets from, e.g. a molecule info file.
+        dataset_names (list of str): Paths of the datasets within the file.
+        out_dir (str): Directory for the rewritten files.
+        chunk_len (int): Default elements per chunk, as passed to get_dataset_kwargs.
+        shuffle (bool): Default shuffle, as passed to get_dataset_kwargs.
+        profile_names (list of str): Profiles to compare (all of them if None).
+
+    Returns:
+        list of dict: Per profile, the seconds taken to write and read all datasets
+                      and the size of the rewritten file in bytes.
+    """
+    if profile_names is None:
+        profile_names = sorted(STORAGE_PROFILES.keys())
+
+    results = []
+    for profile_name in profile_names:
+        out_filename = os.path.join(out_dir, 'storage_profile_%s.h5' % profile_name)
+        write_sec, read_sec = 0.0, 0.0
+        with h5py.File(filename, 'r') as in_f, h5py.File(out_filename, 'w') as out_f:
+            for name in dataset_names:
+                values = in_f[name][:]
+                start = time.time()
+                out_f.create_dataset(name, data=values, maxshape=(None,),
+                                     **get_dataset_kwargs(profile_name, values.dtype, chunk_len, shuffle))
+                out_f.flush()
+                write_sec += time.time() - start
+
+        with h5py.File(out_filename, 'r') as f:
+            for name in dataset_names:
+                start = time.time()
+                f[name][:]
+                read_sec += time.time() - start
+
+        results.append({
+            'profile': profile_name,
+            'write_sec': write_sec,
+            'read_sec': read_sec,
+            'bytes': os.path.getsize(out_filename),
+        })
+    return results
@@ -16,19 +16,28 @@ import tables
 import scipy.sparse as sp_sparse
 import tenkit.safe_json as tk_safe_json
 import cellranger.h5_constants as h5_constants
+import cellranger.h5_storage as cr_h5_storage
 import cellranger.rna.library as rna_library
 from cellranger.feature_ref import FeatureReference, FeatureDef, GENOME_FEATURE_TAG
 import cellranger.utils as cr_utils
 import cellranger.io as cr_io
 import cellranger.sparse as cr_sparse
-import cellranger.bisect as cr_bisect
 
 HDF5_COMPRESSION = 'gzip'
-# Number of elements per chunk. Here, 1 MiB / (12 bytes)
+# Number of elements per chunk, unless the storage profile sets a chunk size. Here, 1 MiB / (12 bytes)
 HDF5_CHUNK_SIZE = 80000
 
 DEFAULT_DATA_DTYPE = 'int32'
 
+# Initial number of (feature, barcode, value) triplets in a CountMatrixBuilder
+DEFAULT_BUILDER_CAPACITY = 1 << 20
+
+# Number of barcodes (columns) merged at a time by merge_matrices_h5
+MERGE_BLOCK_BCS = 1 << 16
+
+# Maximum number of nonzero entries read at a time by LazyCountMatrix.load
+LAZY_LOAD_BLOCK_NNZ = 1 << 22
+
 
 # some helper functions from stats
 def sum_sparse_matrix(matrix, axis=0):
@@ -116,11 +125,10 @@ class CountMatrixView(object):
         return view
 
     def select_barcodes_by_seq(self, barcode_seqs):
-        return self.select_barcodes([self.matrix.bc_to_int(bc) for bc in barcode_seqs])
+        return self.select_barcodes(self.matrix._bcs_to_indices(barcode_seqs))
 
     def select_barcodes_by_gem_group(self, gem_group):
-        return self.select_barcodes_by_seq(
-            [bc for bc in self.matrix.bcs if gem_group == cr_utils.split_barcode_seq(bc)[1]])
+        return self.select_barcodes(np.flatnonzero(self.matrix._get_bc_gem_groups() == (gem_group or 0)))
 
     def _update_feature_ref(self):
         """Make the feature reference consistent with the feature mask"""
@@ -173,7 +181,7 @@ class CountMatrixView(object):
             return []
         sliced_bc_ints = np.flatnonzero(self.bc_mask)
         orig_bc_ints = sliced_bc_ints[np.asarray(bc_ints)]
-        return [self.matrix.bcs[i] for i in orig_bc_ints]
+        return self.matrix.ints_to_bcs(orig_bc_ints)
 
     def int_to_feature_id(self, i):
         return self.feature_ref.feature_defs[i].id
@@ -191,23 +199,85 @@ class CountMatrixView(object):
 
 class CountMatrix(object):
     #pylint: disable=too-many-public-methods
-    def __init__(self, feature_ref, bcs, matrix):
+    def __init__(self, feature_ref, bcs, matrix, bc_keys=None):
+        """
+        Args:
+          feature_ref (FeatureReference): Features (rows).
+          bcs (iterable of str): Barcodes (columns). Ignored if bc_keys is given.
+          matrix: Sparse matrix of counts.
+          bc_keys (np.array(uint64)): Barcodes packed by cr_utils.pack_gem_group_barcodes.
+        """
         # Features (genes, CRISPR gRNAs, antibody barcodes, etc.)
         self.feature_ref = feature_ref
         self.features_dim = len(feature_ref.feature_defs)
         self.feature_ids_map = { f.id: f.index for f in feature_ref.feature_defs }
-
-        # Cell barcodes
-        bcs = np.array(bcs, dtype='S', copy=False)
-        bcs.flags.writeable = False
-        self.bcs = bcs
-        self.bcs_dim, = self.bcs.shape
-        bcs_idx = np.argsort(self.bcs).astype(np.int32)
-        bcs_idx.flags.writeable = False
-        self.bcs_idx = bcs_idx
+        self._feature_ids = None
+        self._feature_ids_idx = None
+
+        # Cell barcodes. They are stored as packed keys when every barcode can be packed,
+        # and only unpacked to strings when the bcs attribute is used.
+        self._bcs = None
+        if bc_keys is None:
+            bcs = np.array(bcs, dtype='S', copy=False)
+            bc_keys = cr_utils.pack_gem_group_barcodes(bcs)
+            if not np.all(bc_keys):
+                bc_keys = None
+                bcs.flags.writeable = False
+                self._bcs = bcs
+        if bc_keys is not None:
+            bc_keys.flags.writeable = False
+        self._bc_keys = bc_keys
+        self.bcs_dim = len(bc_keys) if bc_keys is not None else len(self._bcs)
+        self._bcs_idx = None
 
         self.m = matrix
 
+    @property
+    def bcs(self):
+        '''Barcode sequences as an array of str.'''
+        if self._bcs is None:
+            bcs = cr_utils.unpack_gem_group_barcodes(self._bc_keys)
+            bcs.flags.writeable = False
+            self._bcs = bcs
+        return self._bcs
+
+    @property
+    def bcs_idx(self):
+        '''Order that sorts the barcodes, by packed key if they're packed.'''
+        if self._bcs_idx is None:
+            values = self._bc_keys if self._bc_keys is not None else self._bcs
+            bcs_idx = np.argsort(values)
+            if self.bcs_dim < np.iinfo(np.int32).max:
+                bcs_idx = bcs_idx.astype(np.int32)
+            bcs_idx.flags.writeable = False
+            self._bcs_idx = bcs_idx
+        return self._bcs_idx
+
+    def _with_bcs(self, feature_ref, matrix, bc_indices=None):
+        '''New CountMatrix with this matrix's barcodes, or the subset of them at bc_indices.'''
+        if self._bc_keys is not None:
+            bc_keys = self._bc_keys if bc_indices is None else self._bc_keys[bc_indices]
+            return CountMatrix(feature_ref=feature_ref, bcs=None, matrix=matrix, bc_keys=bc_keys)
+        bcs = self._bcs if bc_indices is None else self._bcs[bc_indices]
+        return CountMatrix(feature_ref=feature_ref, bcs=bcs, matrix=matrix)
+
+    def _bcs_to_indices(self, bcs):
+        '''Index of each barcode, in the order given.
+        Raises KeyError if a barcode isn't in the matrix.'''
+        if self._bc_keys is None:
+            return _lookup_sorted(self._bcs, self.bcs_idx, bcs, 'barcode')
+        bcs = np.asarray(bcs if isinstance(bcs, (list, np.ndarray)) else list(bcs), dtype='S')
+        found, matched = _search_sorted(self._bc_keys, self.bcs_idx, cr_utils.pack_gem_group_barcodes(bcs))
+        if not np.all(matched):
+            raise KeyError("Specified barcode not found in matrix: %s" % bcs[np.flatnonzero(~matched)[0]])
+        return found
+
+    def _get_bc_gem_groups(self):
+        '''Gem group of each barcode, 0 for barcodes without one.'''
+        if self._bc_keys is not None:
+            return cr_utils.get_packed_gem_groups(self._bc_keys)
+        return np.array([cr_utils.split_barcode_seq(bc)[1] or 0 for bc in self._bcs], dtype=np.int64)
+
     def get_shape(self):
         """Return the shape of the sliced matrix"""
         return self.m.shape
@@ -371,7 +441,10 @@ class CountMatrix(object):
         return self.feature_ids_map[feature_id]
 
     def feature_ids_to_ints(self, feature_ids):
-        return sorted([self.feature_id_to_int(fid) for fid in feature_ids])
+        if self._feature_ids is None:
+            self._feature_ids = np.array([f.id for f in self.feature_ref.feature_defs])
+            self._feature_ids_idx = np.argsort(self._feature_ids)
+        return np.sort(_lookup_sorted(self._feature_ids, self._feature_ids_idx, feature_ids, 'feature ID'))
 
     def feature_id_to_name(self, feature_id):
         idx = self.feature_id_to_int(feature_id)
@@ -384,19 +457,19 @@ class CountMatrix(object):
         return self.feature_ref.feature_defs[i].name
 
     def bc_to_int(self, bc):
-        j = cr_bisect.bisect_left(self.bcs_idx, bc, self.bcs)
-        if j >= self.bcs_dim or self.bcs[j] != bc:
-            raise KeyError("Specified barcode not found in matrix: %s" % bc)
-        return j
+        return int(self._bcs_to_indices([bc])[0])
 
     def bcs_to_ints(self, bcs):
-        return sorted([self.bc_to_int(bc) for bc in bcs])
+        return np.sort(self._bcs_to_indices(bcs))
 
     def int_to_bc(self, j):
-        return self.bcs[j]
+        return self.ints_to_bcs([j])[0]
 
     def ints_to_bcs(self, jj):
-        return [self.int_to_bc(j) for j in jj]
+        jj = np.asarray(jj, dtype=np.int64)
+        if self._bcs is not None:
+            return list(self._bcs[jj])
+        return list(cr_utils.unpack_gem_group_barcodes(self._bc_keys[jj]))
 
     def add(self, feature_id, bc, value=1):
         '''Add a count.'''
@@ -410,6 +483,7 @@ class CountMatrix(object):
     def merge(self, other):
         '''Merge this matrix with another CountMatrix'''
         assert self.features_dim == other.features_dim
+        assert self.bcs_dim == other.bcs_dim
         self.m += other.m
 
     def save_dense_csv(self, filename):
@@ -419,8 +493,9 @@ class CountMatrix(object):
                                 columns=self.bcs)
         dense_cm.to_csv(filename, index=True, header=True)
 
-    def save_h5_file(self, filename, extra_attrs={}, sw_version=None):
-        '''Save this matrix to an HDF5 file, optionally with SW version'''
+    def save_h5_file(self, filename, extra_attrs={}, sw_version=None, storage_profile=None):
+        '''Save this matrix to an HDF5 file, optionally with SW version and
+        a storage profile from cellranger.h5_storage'''
         with h5.File(filename, 'w') as f:
             f.attrs[h5_constants.H5_FILETYPE_KEY] = MATRIX_H5_FILETYPE
             f.attrs[MATRIX_H5_VERSION_KEY] = MATRIX_H5_VERSION
@@ -433,10 +508,10 @@ class CountMatrix(object):
                 cr_io.set_hdf5_attr(f, k, v)
 
             group = f.create_group(MATRIX)
-            self.save_h5_group(group)
+            self.save_h5_group(group, storage_profile=storage_profile)
 
 
-    def save_h5_group(self, group):
+    def save_h5_group(self, group, storage_profile=None):
         '''Save this matrix to an HDF5 (h5py) group.'''
         self.tocsc()
 
@@ -450,10 +525,9 @@ class CountMatrix(object):
         for attr, dtype in h5_constants.H5_MATRIX_ATTRS.iteritems():
             arr = np.array(getattr(self.m, attr), dtype=dtype)
             group.create_dataset(attr, data=arr,
-                                 chunks=(HDF5_CHUNK_SIZE,),
                                  maxshape=(None,),
-                                 compression=HDF5_COMPRESSION,
-                                 shuffle=True)
+                                 **cr_h5_storage.get_dataset_kwargs(storage_profile, dtype,
+                                                                    HDF5_CHUNK_SIZE, shuffle=True))
 
     @staticmethod
     def load_dims(group):
@@ -549,7 +623,7 @@ class CountMatrix(object):
     def load(cls, group):
         '''Load from an HDF5 group.'''
         feature_ref = CountMatrix.load_feature_ref_from_h5_group(group)
-        bcs = cls.load_bcs_from_h5_group(group)
+        bcs = cls._load_bcs_array_from_h5_group(group)
 
         shape = group[h5_constants.H5_MATRIX_SHAPE_ATTR][:]
         data = group[h5_constants.H5_MATRIX_DATA_ATTR][:]
@@ -570,6 +644,12 @@ class CountMatrix(object):
             return list(group[h5_constants.H5_BCS_ATTR][:])
         return []
 
+    @staticmethod
+    def _load_bcs_array_from_h5_group(group):
+        if group[h5_constants.H5_BCS_ATTR].shape is not None:
+            return group[h5_constants.H5_BCS_ATTR][:]
+        return np.zeros(0, dtype='S1')
+
     @staticmethod
     def load_bcs_from_h5(filename):
         '''Load just the barcode sequences from an HDF5 group. '''
@@ -666,20 +746,35 @@ class CountMatrix(object):
                 New count matrix, non-zero bc indices, feat indices
         '''
 
-        new_mat = copy.deepcopy(self)
+        nonzero_bcs, nonzero_features = self.get_axes_above_threshold(threshold)
 
-        nonzero_bcs = np.flatnonzero(new_mat.get_counts_per_bc() > threshold)
+        new_mat = copy.deepcopy(self)
         if self.bcs_dim > len(nonzero_bcs):
             new_mat = new_mat.select_barcodes(nonzero_bcs)
-
-        nonzero_features = np.flatnonzero(new_mat.get_counts_per_feature() > threshold)
         if new_mat.features_dim > len(nonzero_features):
             new_mat = new_mat.select_features(nonzero_features)
 
+        return new_mat, nonzero_bcs, nonzero_features
+
+    def get_axes_above_threshold(self, threshold=0):
+        '''Find the axes selected by select_axes_above_threshold without copying the matrix.
+        Barcodes are thresholded first and features are then thresholded on their counts
+        over the selected barcodes.
+
+        Returns:
+            (np.array of int, np.array of int): non-zero bc indices, feat indices
+        '''
+        nonzero_bcs = np.flatnonzero(self.get_counts_per_bc() > threshold)
+
+        bc_mask = np.zeros(self.bcs_dim, dtype=np.int64)
+        bc_mask[nonzero_bcs] = 1
+        counts_per_feature = np.asarray(self.m.dot(bc_mask)).ravel()
+        nonzero_features = np.flatnonzero(counts_per_feature > threshold)
+
         if len(nonzero_bcs) == 0 or len(nonzero_features) == 0:
             raise NullAxisMatrixError()
 
-        return new_mat, nonzero_bcs, nonzero_features
+        return nonzero_bcs, nonzero_features
 
     def select_nonzero_axes(self):
         '''Select axes with nonzero sums.
@@ -692,16 +787,14 @@ class CountMatrix(object):
 
     def select_barcodes(self, indices):
         '''Select a subset of barcodes and return the resulting CountMatrix.'''
-        return CountMatrix(feature_ref=self.feature_ref,
-                           bcs=[self.bcs[i] for i in indices],
-                           matrix=self.m[:, indices])
+        indices = np.asarray(indices, dtype=np.int64)
+        return self._with_bcs(self.feature_ref, self.m[:, indices], bc_indices=indices)
 
     def select_barcodes_by_seq(self, barcode_seqs):
-        return self.select_barcodes([self.bc_to_int(bc) for bc in barcode_seqs])
+        return self.select_barcodes(self._bcs_to_indices(barcode_seqs))
 
     def select_barcodes_by_gem_group(self, gem_group):
-        return self.select_barcodes_by_seq(
-            [bc for bc in self.bcs if gem_group == cr_utils.split_barcode_seq(bc)[1]])
+        return self.select_barcodes(np.flatnonzero(self._get_bc_gem_groups() == (gem_group or 0)))
 
     def select_features(self, indices):
         '''Select a subset of features and return the resulting matrix.
@@ -721,9 +814,7 @@ class CountMatrix(object):
                                        all_tag_keys =self.feature_ref.all_tag_keys,
                                        target_features = self.feature_ref.target_features)
 
-        return CountMatrix(feature_ref=feature_ref,
-                           bcs=self.bcs,
-                           matrix=self.m[indices, :])
+        return self._with_bcs(feature_ref, self.m[indices, :])
 
     def select_features_by_ids(self, feature_ids):
         return self.select_features(self.feature_ids_to_ints(feature_ids))
@@ -803,7 +894,8 @@ class CountMatrix(object):
             subset by list of barcodes
             subset by library_type
         """
-        subselect_matrix = copy.deepcopy(self)
+        # Selections never modify the matrix they are taken from
+        subselect_matrix = self
 
         if library_type is not None:
             assert library_type in rna_library.RECOGNIZED_FEATURE_TYPES, "library_type not recognized"
@@ -903,24 +995,34 @@ class CountMatrix(object):
             return CountMatrix._get_format_version_from_handle(f)
 
 
+    @staticmethod
+    def _check_h5_handle(f):
+        '''Validate an open matrix HDF5 file and return its format version'''
+        if h5_constants.H5_FILETYPE_KEY not in f.attrs or \
+           f.attrs[h5_constants.H5_FILETYPE_KEY] != MATRIX_H5_FILETYPE:
+            raise ValueError('HDF5 file is not a valid matrix HDF5 file.')
+        version = CountMatrix._get_format_version_from_handle(f)
+        if version > MATRIX_H5_VERSION:
+            raise ValueError('Matrix HDF5 file format version (%d) is a newer version that is not supported by this version of the software.' % version)
+        if version == MATRIX_H5_VERSION and MATRIX not in f.keys():
+            raise ValueError('Could not find the "matrix" group inside the matrix HDF5 file.')
+        return version
+
     @staticmethod
     def load_h5_file(filename):
         with h5.File(filename, 'r') as f:
-            if h5_constants.H5_FILETYPE_KEY not in f.attrs or \
-               f.attrs[h5_constants.H5_FILETYPE_KEY] != MATRIX_H5_FILETYPE:
-                raise ValueError('HDF5 file is not a valid matrix HDF5 file.')
-            version = CountMatrix._get_format_version_from_handle(f)
-            if version > MATRIX_H5_VERSION:
-                raise ValueError('Matrix HDF5 file format version (%d) is a newer version that is not supported by this version of the software.' % version)
+            version = CountMatrix._check_h5_handle(f)
             if version < MATRIX_H5_VERSION:
                 #raise ValueError('Matrix HDF5 file format version (%d) is an older version that is no longer supported.' % version)
                 return CountMatrix.from_legacy_v1_h5(f)
 
-            if MATRIX not in f.keys():
-                raise ValueError('Could not find the "matrix" group inside the matrix HDF5 file.')
-
             return CountMatrix.load(f[MATRIX])
 
+    @staticmethod
+    def load_h5_file_lazy(filename):
+        '''Open a matrix HDF5 file without loading the matrix. See LazyCountMatrix.'''
+        return LazyCountMatrix(filename)
+
     @staticmethod
     def count_cells_from_h5(filename):
         # NOTE - this double-counts doublets.
@@ -951,6 +1053,263 @@ class CountMatrix(object):
     def h5_path(base_path):
         return os.path.join(base_path, "hdf5", "matrices.hdf5")
 
+def _search_sorted(values, sorted_idx, queries):
+    '''Find the index of each query in values, given the argsort of values.
+    Returns the indices and whether each query was found.'''
+    if len(values) == 0 or len(queries) == 0:
+        return np.zeros(len(queries), dtype=np.int64), np.zeros(len(queries), dtype=bool)
+    pos = np.minimum(np.searchsorted(values, queries, sorter=sorted_idx), len(values) - 1)
+    found = sorted_idx[pos].astype(np.int64)
+    return found, values[found] == queries
+
+def _lookup_sorted(values, sorted_idx, queries, what):
+    '''Find the index of each query in values, given the argsort of values.
+    Raises KeyError if a query isn't present.'''
+    queries = np.asarray(queries if isinstance(queries, (list, np.ndarray)) else list(queries))
+    found, matched = _search_sorted(values, sorted_idx, queries)
+    if not np.all(matched):
+        raise KeyError("Specified %s not found in matrix: %s" % (what, queries[np.flatnonzero(~matched)[0]]))
+    return found
+
+class LazyCountMatrix(object):
+    """Matrix HDF5 file handle that reads indptr once and loads only the selected
+    barcode columns and feature rows.
+
+    The select_* methods mirror those of CountMatrix and return a new handle with a
+    narrower selection; load() reads the selection into a CountMatrix. Barcode and
+    feature ID lookups are done with sorted index arrays. Indices passed to the
+    select_* methods are relative to the current selection, as for CountMatrix.
+    """
+    def __init__(self, filename):
+        with h5.File(filename, 'r') as f:
+            if CountMatrix._check_h5_handle(f) < MATRIX_H5_VERSION:
+                raise ValueError('Lazy loading is not supported for matrix HDF5 files of format version 1.')
+            group = f[MATRIX]
+            self.file_shape = tuple(group[h5_constants.H5_MATRIX_SHAPE_ATTR][:])
+            self.indptr = group[h5_constants.H5_MATRIX_INDPTR_ATTR][:]
+            self.file_feature_ref = CountMatrix.load_feature_ref_from_h5_group(group)
+
+        self.filename = filename
+        self.feature_indices = np.arange(self.file_shape[0])
+        self.bc_indices = np.arange(self.file_shape[1])
+
+        self.file_feature_ids = np.array([f.id for f in self.file_feature_ref.feature_defs], dtype='S')
+        self.file_feature_ids_idx = np.argsort(self.file_feature_ids)
+        self.file_feature_types = np.array([f.feature_type for f in self.file_feature_ref.feature_defs], dtype='S')
+
+        # Barcodes are only read when a barcode selection or load needs them
+        self._file_bcs = None
+        self._file_bcs_idx = None
+
+    def _copy(self, feature_indices=None, bc_indices=None):
+        '''Return a handle on the same file with another selection'''
+        other = copy.copy(self)
+        if feature_indices is not None:
+            other.feature_indices = feature_indices
+        if bc_indices is not None:
+            other.bc_indices = bc_indices
+        return other
+
+    def _load_bcs(self):
+        if self._file_bcs is None:
+            with h5.File(self.filename, 'r') as f:
+                self._file_bcs = f[MATRIX][h5_constants.H5_BCS_ATTR][:]
+            self._file_bcs_idx = np.argsort(self._file_bcs)
+        return self._file_bcs, self._file_bcs_idx
+
+    @property
+    def features_dim(self):
+        return len(self.feature_indices)
+
+    @property
+    def bcs_dim(self):
+        return len(self.bc_indices)
+
+    @property
+    def bcs(self):
+        return self._load_bcs()[0][self.bc_indices]
+
+    def get_shape(self):
+        """Return the shape of the selected matrix"""
+        return (self.features_dim, self.bcs_dim)
+
+    @staticmethod
+    def _to_selection(file_indices, selected_file_indices, file_dim, what):
+        '''Convert indices in the file to positions within a selection'''
+        positions = np.full(file_dim, -1, dtype=np.int64)
+        positions[selected_file_indices] = np.arange(len(selected_file_indices))
+        result = positions[file_indices]
+        if np.any(result < 0):
+            raise KeyError("Specified %s not found in the selected matrix" % what)
+        return result
+
+    def _bcs_to_selection(self, bcs):
+        file_bcs, file_bcs_idx = self._load_bcs()
+        file_indices = _lookup_sorted(file_bcs, file_bcs_idx, bcs, 'barcode')
+        return LazyCountMatrix._to_selection(file_indices, self.bc_indices, self.file_shape[1], 'barcode')
+
+    def bcs_to_ints(self, bcs):
+        return np.sort(self._bcs_to_selection(bcs))
+
+    def feature_ids_to_ints(self, feature_ids):
+        file_indices = _lookup_sorted(self.file_feature_ids, self.file_feature_ids_idx, feature_ids, 'feature ID')
+        return np.sort(LazyCountMatrix._to_selection(file_indices, self.feature_indices, self.file_shape[0], 'feature ID'))
+
+    def select_barcodes(self, indices):
+        '''Select a subset of barcodes and return the resulting handle.'''
+        return self._copy(bc_indices=self.bc_indices[np.asarray(indices, dtype=np.int64)])
+
+    def select_barcodes_by_seq(self, barcode_seqs):
+        return self.select_barcodes(self._bcs_to_selection(barcode_seqs))
+
+    def select_barcodes_by_gem_group(self, gem_group):
+        return self.select_barcodes(np.flatnonzero(
+            [gem_group == cr_utils.split_barcode_seq(bc)[1] for bc in self.bcs]))
+
+    def select_features(self, indices):
+        '''Select a subset of features and return the resulting handle.'''
+        return self._copy(feature_indices=self.feature_indices[np.asarray(indices, dtype=np.int64)])
+
+    def select_features_by_ids(self, feature_ids):
+        return self.select_features(self.feature_ids_to_ints(feature_ids))
+
+    def select_features_by_type(self, feature_type):
+        '''Select the subset of features with a particular feature type (e.g. "Gene Expression")'''
+        return self.select_features(np.flatnonzero(self.file_feature_types[self.feature_indices] == feature_type))
+
+    def select_features_by_genome(self, genome):
+        '''Select the subset of gene-expression features for genes in a specific genome'''
+        feature_defs = self.file_feature_ref.feature_defs
+        return self.select_features([i for i, j in enumerate(self.feature_indices)
+                                     if feature_defs[j].feature_type == rna_library.DEFAULT_LIBRARY_TYPE and
+                                     feature_defs[j].tags['genome'] == genome])
+
+    def get_feature_ref(self):
+        '''Return the FeatureReference of the selected features, re-indexed as by CountMatrix.select_features'''
+        old_feature_defs = [self.file_feature_ref.feature_defs[i] for i in self.feature_indices]
+        feature_defs = [FeatureDef(index=i, id=fd.id, name=fd.name, feature_type=fd.feature_type, tags=fd.tags)
+                        for (i, fd) in enumerate(old_feature_defs)]
+        return FeatureReference(feature_defs=feature_defs,
+                                all_tag_keys=self.file_feature_ref.all_tag_keys,
+                                target_features=self.file_feature_ref.target_features)
+
+    def _iter_column_blocks(self, cols):
+        '''Split sorted, distinct columns into ranges of consecutive columns
+        with at most LAZY_LOAD_BLOCK_NNZ entries (or a single column).'''
+        run_breaks = np.flatnonzero(np.diff(cols) != 1) + 1
+        for run in np.split(cols, run_breaks):
+            if len(run) == 0:
+                continue
+            start, run_end = run[0], run[-1] + 1
+            while start < run_end:
+                end = np.searchsorted(self.indptr, self.indptr[start] + LAZY_LOAD_BLOCK_NNZ, side='right') - 1
+                end = max(start + 1, min(end, run_end))
+                yield start, end
+                start = end
+
+    def load(self):
+        '''Read the selected barcode columns and feature rows into a CountMatrix.'''
+        num_features = self.file_shape[0]
+        all_features = self.features_dim == num_features and \
+                       np.array_equal(self.feature_indices, np.arange(num_features))
+        row_map = np.full(num_features, -1, dtype=np.int64)
+        row_map[self.feature_indices] = np.arange(self.features_dim)
+
+        cols = np.unique(self.bc_indices)
+        data, indices, col_nnz = [], [], []
+        with h5.File(self.filename, 'r') as f:
+            group = f[MATRIX]
+            data_ds = group[h5_constants.H5_MATRIX_DATA_ATTR]
+            indices_ds = group[h5_constants.H5_MATRIX_INDICES_ATTR]
+            for start, end in self._iter_column_blocks(cols):
+                block_data = data_ds[self.indptr[start]:self.indptr[end]]
+                block_rows = indices_ds[self.indptr[start]:self.indptr[end]]
+                block_nnz = np.diff(self.indptr[start:(end+1)])
+                if not all_features:
+                    rows = row_map[block_rows]
+                    keep = rows >= 0
+                    block_col = np.repeat(np.arange(end - start), block_nnz)
+                    block_data, block_rows = block_data[keep], rows[keep]
+                    block_nnz = np.bincount(block_col[keep], minlength=end - start)
+                data.append(block_data)
+                indices.append(block_rows)
+                col_nnz.append(block_nnz)
+
+        dtype = h5_constants.H5_MATRIX_ATTRS[h5_constants.H5_MATRIX_DATA_ATTR]
+        indptr = np.zeros(len(cols) + 1, dtype=np.int64)
+        if len(col_nnz) > 0:
+            np.cumsum(np.concatenate(col_nnz), out=indptr[1:])
+        matrix = sp_sparse.csc_matrix((np.concatenate(data) if data else np.zeros(0, dtype=dtype),
+                                       np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64),
+                                       indptr),
+                                      shape=(self.features_dim, len(cols)))
+
+        # Restore the order (and any repeats) of the selected barcodes
+        if not np.array_equal(cols, self.bc_indices):
+            matrix = matrix[:, np.searchsorted(cols, self.bc_indices)]
+        matrix.sort_indices()
+
+        return CountMatrix(feature_ref=self.get_feature_ref(), bcs=self.bcs, matrix=matrix)
+
+class CountMatrixBuilder(object):
+    '''Accumulates counts into a CountMatrix as COO triplets of integer
+    (feature, barcode) indices. Each distinct barcode is only looked up once,
+    and duplicate entries are combined when the buffer fills and on build().'''
+    def __init__(self, feature_ref, bcs, dtype=DEFAULT_DATA_DTYPE, capacity=DEFAULT_BUILDER_CAPACITY):
+        empty = sp_sparse.csc_matrix((len(feature_ref.feature_defs), len(bcs)), dtype=dtype)
+        self.matrix = CountMatrix(feature_ref=feature_ref, bcs=bcs, matrix=empty)
+        self.bc_ints = {}
+
+        self.rows = np.empty(capacity, dtype=np.int32)
+        self.cols = np.empty(capacity, dtype=np.int32)
+        self.values = np.empty(capacity, dtype=dtype)
+        self.num_entries = 0
+
+    def add(self, feature_id, bc, value=1):
+        '''Add a count.'''
+        j = self.bc_ints.get(bc)
+        if j is None:
+            j = self.bc_ints[bc] = self.matrix.bc_to_int(bc)
+        self.add_int(self.matrix.feature_id_to_int(feature_id), j, value)
+
+    def add_int(self, i, j, value=1):
+        '''Add a count by feature and barcode index.'''
+        if self.num_entries == len(self.rows):
+            self._compact()
+        n = self.num_entries
+        self.rows[n] = i
+        self.cols[n] = j
+        self.values[n] = value
+        self.num_entries += 1
+
+    def _compact(self):
+        '''Combine duplicate entries, growing the buffers if that doesn't free enough space.'''
+        m = self._to_coo()
+        m.sum_duplicates()
+        n = m.nnz
+        self.rows[:n] = m.row
+        self.cols[:n] = m.col
+        self.values[:n] = m.data
+        self.num_entries = n
+
+        if n > len(self.rows) / 2:
+            new_len = 2 * len(self.rows)
+            self.rows = np.resize(self.rows, new_len)
+            self.cols = np.resize(self.cols, new_len)
+            self.values = np.resize(self.values, new_len)
+
+    def _to_coo(self):
+        n = self.num_entries
+        return sp_sparse.coo_matrix((self.values[:n], (self.rows[:n], self.cols[:n])),
+                                    shape=self.matrix.get_shape(), dtype=self.values.dtype)
+
+    def build(self):
+        '''Return the accumulated counts as a CSC CountMatrix.'''
+        m = self._to_coo().tocsc()
+        m.sum_duplicates()
+        self.matrix.m = m
+        return self.matrix
+
 def merge_matrices(h5_filenames):
     matrix = None
     for h5_filename in h5_filenames:
@@ -963,6 +1322,73 @@ def merge_matrices(h5_filenames):
         matrix.tocsc()
     return matrix
 
+def merge_matrices_h5(h5_filenames, out_filename, extra_attrs={}, sw_version=None, storage_profile=None):
+    '''Sum matrix HDF5 files that share features and barcodes into a new matrix HDF5 file.
+    Columns are merged in blocks of barcodes, so at most one block of every
+    input is held in memory instead of whole matrices.'''
+    if len(h5_filenames) == 0:
+        raise ValueError('No matrix HDF5 files to merge.')
+
+    in_files = []
+    try:
+        for fn in h5_filenames:
+            in_files.append(h5.File(fn, 'r'))
+        _merge_matrix_h5_groups([f[MATRIX] for f in in_files], out_filename, extra_attrs, sw_version, storage_profile)
+    finally:
+        for in_file in in_files:
+            in_file.close()
+
+def _merge_matrix_h5_groups(in_groups, out_filename, extra_attrs, sw_version, storage_profile):
+    shape = in_groups[0][h5_constants.H5_MATRIX_SHAPE_ATTR][:]
+    for group in in_groups[1:]:
+        assert np.array_equal(group[h5_constants.H5_MATRIX_SHAPE_ATTR][:], shape)
+    num_features, num_bcs = shape
+
+    with h5.File(out_filename, 'w') as f:
+        f.attrs[h5_constants.H5_FILETYPE_KEY] = MATRIX_H5_FILETYPE
+        f.attrs[MATRIX_H5_VERSION_KEY] = MATRIX_H5_VERSION
+        if sw_version:
+            f.attrs[SOFTWARE_H5_VERSION_KEY] = sw_version
+        for (k,v) in extra_attrs.iteritems():
+            cr_io.set_hdf5_attr(f, k, v)
+
+        group = f.create_group(MATRIX)
+        group.copy(in_groups[0][h5_constants.H5_FEATURE_REF_ATTR], h5_constants.H5_FEATURE_REF_ATTR)
+        group.copy(in_groups[0][h5_constants.H5_BCS_ATTR], h5_constants.H5_BCS_ATTR)
+
+        out_ds = {}
+        for attr, dtype in h5_constants.H5_MATRIX_ATTRS.iteritems():
+            out_ds[attr] = group.create_dataset(attr, (0,), dtype=dtype,
+                                                maxshape=(None,),
+                                                **cr_h5_storage.get_dataset_kwargs(storage_profile, dtype,
+                                                                                   HDF5_CHUNK_SIZE, shuffle=True))
+
+        def append(attr, values):
+            ds = out_ds[attr]
+            start = len(ds)
+            ds.resize((start + len(values),))
+            ds[start:] = values
+
+        append(h5_constants.H5_MATRIX_SHAPE_ATTR, shape)
+        append(h5_constants.H5_MATRIX_INDPTR_ATTR, [0])
+        nnz = 0
+        for block_start in xrange(0, num_bcs, MERGE_BLOCK_BCS):
+            block_end = min(num_bcs, block_start + MERGE_BLOCK_BCS)
+            rows, cols, values = [], [], []
+            for in_group in in_groups:
+                indptr = in_group[h5_constants.H5_MATRIX_INDPTR_ATTR][block_start:block_end+1]
+                rows.append(in_group[h5_constants.H5_MATRIX_INDICES_ATTR][indptr[0]:indptr[-1]])
+                values.append(in_group[h5_constants.H5_MATRIX_DATA_ATTR][indptr[0]:indptr[-1]])
+                cols.append(np.repeat(np.arange(block_end - block_start), np.diff(indptr)))
+
+            block = sp_sparse.coo_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                                         shape=(num_features, block_end - block_start)).tocsc()
+            block.sum_duplicates()
+            append(h5_constants.H5_MATRIX_DATA_ATTR, block.data)
+            append(h5_constants.H5_MATRIX_INDICES_ATTR, block.indices)
+            append(h5_constants.H5_MATRIX_INDPTR_ATTR, nnz + block.indptr[1:])
+            nnz += block.nnz
+
 def concatenate_mtx(mtx_list, out_mtx):
     if len(mtx_list) == 0:
         return
@@ -18,6 +18,7 @@ from cellranger.rna.library import LIBRARY_TYPE
 import cellranger.rna.library as rna_library
 import cellranger.utils as cr_utils
 import cellranger.h5_constants as h5_constants
+import cellranger.h5_storage as cr_h5_storage
 import cellranger.io as cr_io
 import tenkit.seq as tk_seq
 
@@ -33,6 +34,9 @@ METRICS_GROUP_NAME = 'metrics'
 # cell-associated)
 BARCODE_INFO_GROUP_NAME = 'barcode_info'
 
+# Group that stores the first row of each (gem_group, barcode_idx) run
+BARCODE_ROW_INDEX_GROUP_NAME = 'barcode_row_index'
+
 BARCODE_IDX_COL_NAME = 'barcode_idx'
 LIBRARY_IDX_COL_NAME = 'library_idx'
 FEATURE_IDX_COL_NAME = 'feature_idx'
@@ -69,10 +73,22 @@ GG_RECOVERED_CELLS_METRIC = 'recovered_cells'
 GG_FORCE_CELLS_METRIC = 'force_cells'
 
 HDF5_COMPRESSION = 'gzip'
-# Number of elements per HDF5 chunk;
+# Number of elements per HDF5 chunk, unless the storage profile sets a chunk size;
 #   here, 1 MiB/(32 bytes per element)
 HDF5_CHUNK_SIZE = 32768
 
+# Number of rows read at a time when scanning the chunk key columns
+#   for the barcode row index (a multiple of HDF5_CHUNK_SIZE)
+CHUNK_KEY_SCAN_BLOCK_SIZE = 1 << 22
+
+# Number of rows copied at a time when concatenating molecule info files
+#   (rounded to a multiple of each column's HDF5 chunk length, so every write fills whole chunks)
+CONCATENATE_BLOCK_SIZE = 32 * HDF5_CHUNK_SIZE
+
+# Number of reads to buffer before aggregating molecules and writing them out
+#   (about 12 bytes per read, so ~50 MB)
+MOLECULE_READ_BUFFER_SIZE = 1 << 22
+
 # Per-barcode metadata. Sparse (not every barcode is listed)
 BarcodeInfo = namedtuple('BarcodeInfo', [
     # Array-ized list of (barcode_idx, library_idx, genome_idx)
@@ -87,6 +103,20 @@ BARCODE_INFO_DTYPES = {
     'genomes': 'str',
 }
 
+# Rows are sorted by (gem_group, barcode_idx), so each distinct pair occupies
+# the rows [row_start[i], row_start[i+1]), with the last run ending at nrows.
+BarcodeRowIndex = namedtuple('BarcodeRowIndex', [
+    'gem_group',
+    'barcode_idx',
+    'row_start',
+])
+
+BARCODE_ROW_INDEX_DTYPES = {
+    'gem_group': MOLECULE_INFO_COLUMNS['gem_group'],
+    BARCODE_IDX_COL_NAME: MOLECULE_INFO_COLUMNS[BARCODE_IDX_COL_NAME],
+    'row_start': np.uint64,
+}
+
 
 class MoleculeCounter:
     """ Streams a list of tuples w/named elements to or from an h5 file """
@@ -99,6 +129,7 @@ class MoleculeCounter:
         self.ref_columns = OrderedDict()
         self.library_info = None
         self.feature_reference = None
+        self.storage_profile = None
 
     def get_barcode_whitelist(self):
         return self.get_metric(BC_WHITELIST_METRIC)
@@ -129,12 +160,12 @@ class MoleculeCounter:
             return mem_gb
 
     @staticmethod
-    def build_barcode_info(filtered_barcodes_by_genome, library_info, barcodes):
+    def build_barcode_info(filtered_barcodes_by_genome, library_info, barcode_index):
         """Generate numpy arrays for per-barcode info
         Args:
           filtered_barcodes_by_genome (dict of str:list(str)): Keys are genomes, values are lists of filtered barcode strings.
           library_info (list of dict): Per-library metadata.
-          barcodes (list of str): All barcode sequences (e.g. ['ACGT', ...]
+          barcode_index (BarcodeWhitelistIndex): Index of all barcode sequences
         Returns:
           BarcodeInfo object
         """
@@ -146,17 +177,15 @@ class MoleculeCounter:
         for lib_idx, lib in enumerate(library_info):
             libraries_for_gem_group[lib['gem_group']].append(lib_idx)
 
-        # Map a barcode sequence to its index into the MoleculeCounter
-        #  'barcodes' array
-        bc_seq_to_idx = {bc: i for i, bc in enumerate(barcodes)}
-
         # Populate the "pass filter" array of tuples
         pf_tuples = []
         for genome, bcs in filtered_barcodes_by_genome.iteritems():
             genome_idx = genome_to_idx[genome]
             for bc_str in bcs:
                 seq, gg = cr_utils.split_barcode_seq(bc_str)
-                barcode_idx = bc_seq_to_idx[seq]
+                # Index into the MoleculeCounter 'barcodes' array
+                barcode_idx = barcode_index.get_index(seq)
+                assert barcode_idx is not None
 
                 library_inds = libraries_for_gem_group[gg]
                 for library_idx in library_inds:
@@ -259,7 +288,7 @@ class MoleculeCounter:
 
     @staticmethod
     def open(filename, mode, feature_ref=None, barcodes=None, library_info=None,
-             barcode_info=None):
+             barcode_info=None, storage_profile=None):
         """Open a molecule info object.
 
         Args:
@@ -269,6 +298,7 @@ class MoleculeCounter:
           barcodes (list of str): All possible barcode sequences. Required when mode is 'w'.
           library_info (list of dict): Library metadata. Required when mode is 'w'.
           barcode_info (BarcodeInfo): Per-barcode metadata.
+          storage_profile (str): HDF5 storage profile (see cellranger.h5_storage) when mode is 'w'.
         Returns:
           MoleculeInfo: A new object
         """
@@ -290,6 +320,9 @@ class MoleculeCounter:
                 raise ValueError(
                     'Barcode info must be specified when opening a molecule info object for writing')
 
+            mc.storage_profile = storage_profile
+            profile = cr_h5_storage.get_storage_profile(storage_profile)
+
             mc.h5 = h5py.File(filename, 'w')
             cr_io.set_hdf5_attr(mc.h5, FILE_VERSION_KEY, CURR_FILE_VERSION)
             cr_io.set_hdf5_attr(
@@ -307,7 +340,7 @@ class MoleculeCounter:
             max_barcode_len = np.max(map(len, barcodes))
             barcode_dtype = np.dtype('S%d' % max_barcode_len)
             mc.h5.create_dataset('barcodes', data=np.fromiter(
-                barcodes, barcode_dtype, count=len(barcodes)), compression=HDF5_COMPRESSION)
+                barcodes, barcode_dtype, count=len(barcodes)), compression=profile.compression)
 
             # Write library info
             lib_info_json = json.dumps(library_info, indent=4, sort_keys=True)
@@ -323,8 +356,8 @@ class MoleculeCounter:
                 mc.columns[name] = mc.h5.create_dataset(name, (0,),
                                                         maxshape=(None,),
                                                         dtype=col_type,
-                                                        compression=HDF5_COMPRESSION,
-                                                        chunks=(HDF5_CHUNK_SIZE,))
+                                                        **cr_h5_storage.get_dataset_kwargs(
+                                                            storage_profile, col_type, HDF5_CHUNK_SIZE))
 
         elif mode == 'r':
             mc.h5 = h5py.File(filename, 'r')
@@ -350,7 +383,8 @@ class MoleculeCounter:
                     mc.feature_reference = FeatureReference.from_hdf5(
                         mc.h5[key])
                 elif key == METRICS_GROUP_NAME \
-                        or key == BARCODE_INFO_GROUP_NAME:
+                        or key == BARCODE_INFO_GROUP_NAME \
+                        or key == BARCODE_ROW_INDEX_GROUP_NAME:
                     pass
                 else:
                     raise AttributeError("Unrecognized dataset key: %s" % key)
@@ -440,6 +474,72 @@ class MoleculeCounter:
     def get_library_info(self):
         return json.loads(self.h5['library_info'][0])
 
+    @staticmethod
+    def merge_barcode_row_indices(indices, num_rows):
+        """Concatenate the barcode row indices of consecutive blocks of rows.
+        Args:
+          indices (list of BarcodeRowIndex): Index of each block, with rows numbered within the block.
+          num_rows (list of int): Number of rows in each block.
+        Returns:
+          BarcodeRowIndex"""
+        offsets = np.cumsum([0] + list(num_rows[:-1])).astype(np.uint64)
+        row_index = BarcodeRowIndex(*[np.concatenate([getattr(index, name) for index in indices]).astype(
+            BARCODE_ROW_INDEX_DTYPES[name]) for name in BarcodeRowIndex._fields])
+        row_index.row_start[:] += np.repeat(offsets, [len(index.row_start) for index in indices])
+
+        # A barcode that spans two blocks starts only once
+        is_new = np.ones(len(row_index.row_start), dtype=bool)
+        is_new[1:] = (row_index.gem_group[1:] != row_index.gem_group[:-1]) | \
+                     (row_index.barcode_idx[1:] != row_index.barcode_idx[:-1])
+        return BarcodeRowIndex(*[x[is_new] for x in row_index])
+
+    def scan_barcode_row_index(self):
+        """Build the barcode row index by scanning the chunk key columns in blocks.
+        Returns:
+          BarcodeRowIndex"""
+        num_rows = self.nrows()
+        indices, block_lens = [], []
+        for start in xrange(0, num_rows, CHUNK_KEY_SCAN_BLOCK_SIZE):
+            end = min(num_rows, start + CHUNK_KEY_SCAN_BLOCK_SIZE)
+            gem_group = self.get_column_lazy('gem_group')[start:end]
+            barcode_idx = self.get_column_lazy(BARCODE_IDX_COL_NAME)[start:end]
+            is_new = np.ones(len(gem_group), dtype=bool)
+            is_new[1:] = (gem_group[1:] != gem_group[:-1]) | (barcode_idx[1:] != barcode_idx[:-1])
+            row_start = np.flatnonzero(is_new)
+            indices.append(BarcodeRowIndex(gem_group[row_start], barcode_idx[row_start], row_start))
+            block_lens.append(end - start)
+
+        if len(indices) == 0:
+            return BarcodeRowIndex(*[np.zeros(0, dtype=BARCODE_ROW_INDEX_DTYPES[name])
+                                     for name in BarcodeRowIndex._fields])
+        return MoleculeCounter.merge_barcode_row_indices(indices, block_lens)
+
+    def set_barcode_row_index(self, row_index):
+        if BARCODE_ROW_INDEX_GROUP_NAME in self.h5:
+            del self.h5[BARCODE_ROW_INDEX_GROUP_NAME]
+        group = self.h5.create_group(BARCODE_ROW_INDEX_GROUP_NAME)
+        for name in BarcodeRowIndex._fields:
+            group.create_dataset(name, data=getattr(row_index, name),
+                                 dtype=BARCODE_ROW_INDEX_DTYPES[name],
+                                 compression=cr_h5_storage.get_storage_profile(self.storage_profile).compression)
+
+    def get_barcode_row_index(self):
+        """Load the barcode row index.
+        Returns:
+          BarcodeRowIndex: None if the file was written without one."""
+        if BARCODE_ROW_INDEX_GROUP_NAME not in self.h5:
+            return None
+        group = self.h5[BARCODE_ROW_INDEX_GROUP_NAME]
+        return BarcodeRowIndex(*[group[name][:] for name in BarcodeRowIndex._fields])
+
+    def get_chunk_key_starts(self):
+        """First row of each run of a chunk key, from the barcode row index if
+        the file has one and from a scan of the chunk key columns otherwise."""
+        row_index = self.get_barcode_row_index()
+        if row_index is None:
+            row_index = self.scan_barcode_row_index()
+        return row_index.row_start.astype(np.int64)
+
     def __enter__(self):
         return self
 
@@ -451,6 +551,8 @@ class MoleculeCounter:
         self.h5.close()
 
     def save(self):
+        if BARCODE_ROW_INDEX_GROUP_NAME not in self.h5:
+            self.set_barcode_row_index(self.scan_barcode_row_index())
         self.h5.close()
 
     @staticmethod
@@ -482,18 +584,21 @@ class MoleculeCounter:
         )
 
     @staticmethod
-    def concatenate(out_filename, in_filenames, metrics=None):
-        """Concatenate MoleculeCounter HDF5 files
+    def concatenate(out_filename, in_filenames, metrics=None, storage_profile=None):
+        """Concatenate MoleculeCounter HDF5 files.
+        The per-molecule columns are streamed in blocks of CONCATENATE_BLOCK_SIZE rows
+        into preallocated datasets, so memory usage doesn't grow with the number of molecules.
         Args:
           out_filename (str): Output HDF5 filename
           in_filenames (list of str): Input HDF5 filenames
           metrics (dict): Metrics to write
+          storage_profile (str): HDF5 storage profile of the output
         """
         # Load reference info from first file
-        first_mc = MoleculeCounter.open(in_filenames[0], 'r')
-        feature_ref = first_mc.get_feature_ref()
-        barcodes = first_mc.get_barcodes()
-        library_info = first_mc.get_library_info()
+        with MoleculeCounter.open(in_filenames[0], 'r') as first_mc:
+            feature_ref = first_mc.get_feature_ref()
+            barcodes = first_mc.get_barcodes()
+            library_info = first_mc.get_library_info()
 
         feature_ids = [f.id for f in feature_ref.feature_defs]
 
@@ -509,8 +614,10 @@ class MoleculeCounter:
                                       feature_ref=feature_ref,
                                       barcodes=barcodes,
                                       library_info=library_info,
-                                      barcode_info=merged_bc_info)
+                                      barcode_info=merged_bc_info,
+                                      storage_profile=storage_profile)
 
+        row_indices, num_rows = [], []
         for filename in in_filenames:
             with MoleculeCounter.open(filename, mode='r') as in_mc:
                 # Assert that these data are compatible
@@ -523,21 +630,48 @@ class MoleculeCounter:
                 if metrics is None:
                     metrics = in_mc.get_all_metrics()
 
-                # Concatenate per-molecule datasets
-                for name, ds in in_mc.columns.iteritems():
-                    out_mc.append_column(name, ds[:])
+                row_index = in_mc.get_barcode_row_index()
+                row_indices.append(row_index if row_index is not None else in_mc.scan_barcode_row_index())
+                num_rows.append(in_mc.nrows())
 
+        # Concatenate per-molecule datasets, one column at a time
+        for name, ds in out_mc.columns.iteritems():
+            ds.resize((sum(num_rows),))
+            block_size = ds.chunks[0] * max(1, CONCATENATE_BLOCK_SIZE // ds.chunks[0])
+            start = 0
+            for values in MoleculeCounter.iter_column_blocks(in_filenames, name, block_size):
+                ds[start:(start + len(values))] = values
+                start += len(values)
+
+        out_mc.set_barcode_row_index(MoleculeCounter.merge_barcode_row_indices(row_indices, num_rows))
         out_mc.set_all_metrics(metrics)
         out_mc.save()
 
-    def find_last_occurrence_of_chunk_key(self, from_row):
-        num_rows = self.nrows()
-        initial_chunk_key = self.get_chunk_key(from_row)
-        for i in xrange(from_row, num_rows):
-            chunk_key = self.get_chunk_key(i)
-            if chunk_key != initial_chunk_key:
-                return i - 1
-        return num_rows - 1
+    @staticmethod
+    def iter_column_blocks(filenames, col_name, block_size):
+        """Iterate over a column of several MoleculeCounter HDF5 files, as if they were concatenated.
+        Args:
+          filenames (list of str): Input HDF5 filenames
+          col_name (str): Column to read
+          block_size (int): Number of rows per block
+        Yields:
+          np.array: Blocks of exactly block_size rows, except for the last one
+        """
+        pending, pending_len = [], 0
+        for filename in filenames:
+            with MoleculeCounter.open(filename, 'r') as mc:
+                ds = mc.get_column_lazy(col_name)
+                start = 0
+                while start < len(ds):
+                    end = min(len(ds), start + block_size - pending_len)
+                    pending.append(ds[start:end])
+                    pending_len += end - start
+                    start = end
+                    if pending_len == block_size:
+                        yield np.concatenate(pending)
+                        pending, pending_len = [], 0
+        if pending_len > 0:
+            yield np.concatenate(pending)
 
     def bisect(self, query, key_func):
         return MoleculeCounter.bisect_static(self.nrows(), query, key_func)
@@ -548,32 +682,18 @@ class MoleculeCounter:
         Takes a key function, where key_func(i) = the value to compare to at index i."""
         lo = 0
         hi = num_rows
-        exists = True
-        while True:
+        while lo < hi:
             i = (hi + lo) / 2
-            curr = key_func(i)
-            if curr == query:
-                break
-            elif hi - lo <= 1:
-                # non-matching case
-                exists = False
-                break
-            elif curr < query:
-                lo = i
+            if key_func(i) < query:
+                lo = i + 1
             else:
                 hi = i
 
-        if exists:
-            # backtrack to first occurrence
-            for j in xrange(i, -1, -1):
-                curr = key_func(j)
-                if curr != query:
-                    return j + 1
+        if lo < num_rows and key_func(lo) == query:
+            return lo
+        # non-matching case
         return 0
 
-    def get_chunks_from_partition(self, values, key_func):
-        return MoleculeCounter.get_chunks_from_partition_static(self.nrows(), values, key_func)
-
     @staticmethod
     def get_chunks_from_partition_static(num_rows, values, key_func):
         """ Get chunks by partitioning on the specified values."""
@@ -589,12 +709,17 @@ class MoleculeCounter:
         """ Get chunks, optionally preserving boundaries defined by get_chunk_key().
             Yields (chunk_start, chunk_len) which are closed intervals """
         num_rows = self.nrows()
+        if preserve_boundaries:
+            # Last row of each chunk key
+            key_ends = np.append(self.get_chunk_key_starts()[1:], num_rows) - 1
         chunk_start, chunk_end = 0, 0
         while chunk_end < (num_rows - 1):
             target_chunk_end = min(
                 num_rows - 1, chunk_start + target_chunk_len - 1)
-            chunk_end = self.find_last_occurrence_of_chunk_key(
-                target_chunk_end) if preserve_boundaries else target_chunk_end
+            if preserve_boundaries:
+                chunk_end = int(key_ends[np.searchsorted(key_ends, target_chunk_end)])
+            else:
+                chunk_end = target_chunk_end
             chunk_len = 1 + chunk_end - chunk_start
             yield (chunk_start, chunk_len)
             chunk_start = 1 + chunk_end
@@ -941,3 +1066,91 @@ class MoleculeCounter:
             out_mc.set_all_metrics(v2_metrics)
 
         return
+
+
+class MoleculeReadBuffer(object):
+    """ Accumulates per-read (umi, library_idx, feature_idx) triples for whole
+    barcodes and writes them to a MoleculeCounter as molecules in large blocks.
+
+    Reads must be added barcode by barcode, in MoleculeCounter sort order.
+    Molecules are sorted by (gem_group, barcode_idx, feature_idx, library_idx, umi). """
+
+    def __init__(self, capacity=MOLECULE_READ_BUFFER_SIZE):
+        self.capacity = capacity
+        self.umi = np.empty(capacity, dtype=MOLECULE_INFO_COLUMNS['umi'])
+        self.library_idx = np.empty(capacity, dtype=MOLECULE_INFO_COLUMNS[LIBRARY_IDX_COL_NAME])
+        self.feature_idx = np.empty(capacity, dtype=MOLECULE_INFO_COLUMNS[FEATURE_IDX_COL_NAME])
+        self.num_reads = 0
+
+        # Barcode of each run of reads, and the read offset at which it starts
+        self.bc_gem_groups = []
+        self.bc_idxs = []
+        self.bc_starts = []
+
+    def __len__(self):
+        return self.num_reads
+
+    def is_full(self):
+        return self.num_reads >= self.capacity
+
+    def start_barcode(self, gem_group, barcode_idx):
+        """ Begin a new barcode; subsequent reads are assigned to it. """
+        self.bc_gem_groups.append(gem_group)
+        self.bc_idxs.append(barcode_idx)
+        self.bc_starts.append(self.num_reads)
+
+    def add_read(self, umi, library_idx, feature_idx):
+        if self.num_reads == len(self.umi):
+            # A single barcode can exceed the capacity, so grow rather than flush
+            new_len = 2 * len(self.umi)
+            self.umi = np.resize(self.umi, new_len)
+            self.library_idx = np.resize(self.library_idx, new_len)
+            self.feature_idx = np.resize(self.feature_idx, new_len)
+        i = self.num_reads
+        self.umi[i] = umi
+        self.library_idx[i] = library_idx
+        self.feature_idx[i] = feature_idx
+        self.num_reads += 1
+
+    def aggregate(self):
+        """ Collapse buffered reads into molecules.
+        Returns:
+          dict of str:np.array: Molecule columns keyed by MOLECULE_INFO_COLUMNS name
+        """
+        n = self.num_reads
+        umi = self.umi[:n]
+        library_idx = self.library_idx[:n]
+        feature_idx = self.feature_idx[:n]
+
+        # Barcode ordinal of each read (barcodes are already in sort order)
+        bc_lens = np.diff(np.append(np.array(self.bc_starts, dtype=np.int64), n))
+        read_bc = np.repeat(np.arange(len(bc_lens)), bc_lens)
+
+        order = np.lexsort((umi, library_idx, feature_idx, read_bc))
+        keys = (read_bc[order], feature_idx[order], library_idx[order], umi[order])
+
+        # Run-length reduce identical (barcode, feature, library, umi) keys
+        mol_starts = np.flatnonzero(np.logical_or.reduce(
+            tuple(np.concatenate(([True], key[1:] != key[:-1])) for key in keys)))
+        counts = np.diff(np.append(mol_starts, n))
+        mol_bc = keys[0][mol_starts]
+
+        return OrderedDict([
+            ('gem_group', np.array(self.bc_gem_groups, dtype=MOLECULE_INFO_COLUMNS['gem_group'])[mol_bc]),
+            (BARCODE_IDX_COL_NAME, np.array(self.bc_idxs, dtype=MOLECULE_INFO_COLUMNS[BARCODE_IDX_COL_NAME])[mol_bc]),
+            (FEATURE_IDX_COL_NAME, keys[1][mol_starts]),
+            (LIBRARY_IDX_COL_NAME, keys[2][mol_starts]),
+            ('umi', keys[3][mol_starts]),
+            (COUNT_COL_NAME, counts.astype(MOLECULE_INFO_COLUMNS[COUNT_COL_NAME])),
+        ])
+
+    def flush(self, mc):
+        """ Append the buffered molecules to a MoleculeCounter and reset the buffer.
+        Must only be called between barcodes. """
+        if self.num_reads > 0:
+            for name, values in self.aggregate().iteritems():
+                mc.append_column(name, values)
+        self.num_reads = 0
+        self.bc_gem_groups = []
+        self.bc_idxs = []
+        self.bc_starts = []
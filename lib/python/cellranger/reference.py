@@ -8,6 +8,7 @@ import csv
 import itertools
 import json
 import math
+import mmap
 import numpy as np
 import os
 import subprocess
@@ -21,9 +22,49 @@ import cellranger.constants as cr_constants
 import cellranger.h5_constants as h5_constants
 import cellranger.io as cr_io
 
+# Number of GTF lines parsed and validated together
+GTF_BLOCK_LINES = 100000
+
+# Matches a single 'key "value"' GTF attribute
+GTF_PROPERTY_RE = re.compile(r'(\S+?)\s*"(.*?)"')
+
+# Matches the start of each non-comment GTF line that is missing columns or has an invalid strand
+GTF_INVALID_ROW_RE = re.compile(r'^(?!#|\r?$|(?:[^\t\n]*\t){6}(?:%s)\t[^\t\n]*\t[^\t\n]*$)' %
+                                '|'.join(re.escape(strand) for strand in cr_constants.STRANDS), re.M)
+
+# Captures chrom, start, end, strand and attributes of GTF exon lines
+GTF_EXON_ROW_RE = re.compile(r'^(?!#)([^\t\n]*)\t[^\t\n]*\texon\t([^\t\n]*)\t([^\t\n]*)\t[^\t\n]*\t([^\t\n]*)\t[^\t\n]*\t([^\n]*)$', re.M)
+
 class GtfParser(object):
     GTF_ERROR_TXT = 'Please fix your GTF and start again.'
 
+    def check_gtf_row(self, i, row, properties):
+        """ Exit with an error message if a non-comment GTF row is invalid.
+        Args:
+          i (int): 0-based line number.
+          row (list of str): Tab-separated fields.
+          properties (dict): Parsed attributes. Only checked for exon rows.
+        """
+        if len(row) != 9:
+            sys.exit("Invalid number of columns in GTF line %d: %s\n\n%s" % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
+
+        strand = row[6]
+        if strand not in cr_constants.STRANDS:
+            sys.exit('Invalid strand in GTF line %d: %s\n\n%s' % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
+
+        annotation = row[2]
+        if annotation == 'exon':
+            if 'transcript_id' not in properties:
+                sys.exit("Property 'transcript_id' not found in GTF line %d: %s\n\n%s" % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
+            if ';' in properties['transcript_id']:
+                sys.exit("Property 'transcript_id' has invalid character ';' in GTF line %d: %s\n\n%s" % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
+            if re.search(r'\s', properties['transcript_id']) is not None:
+                sys.exit("Property 'transcript_id' has invalid whitespace character in GTF line %d: %s\n\n%s" % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
+            if 'gene_id' not in properties:
+                sys.exit("Property 'gene_id' not found in GTF line %d: %s\n\n%s" % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
+            if ';' in properties['gene_id']:
+                sys.exit("Property 'gene_id' has invalid character ';' in GTF line %d: %s\n\n%s" % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
+
     def gtf_reader_iter(self, filename):
         with open(filename, 'r') as f:
             reader = csv.reader(f, delimiter='\t')
@@ -34,58 +75,90 @@ class GtfParser(object):
                     yield row, True, None
                     continue
 
-                if len(row) != 9:
-                    sys.exit("Invalid number of columns in GTF line %d: %s\n\n%s" % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
-
-                strand = row[6]
-                if strand not in cr_constants.STRANDS:
-                    sys.exit('Invalid strand in GTF line %d: %s\n\n%s' % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
-
-                annotation = row[2]
-                properties = self.get_properties_dict(row[8])
-                if annotation == 'exon':
-                    if 'transcript_id' not in properties:
-                        sys.exit("Property 'transcript_id' not found in GTF line %d: %s\n\n%s" % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
-                    if ';' in properties['transcript_id']:
-                        sys.exit("Property 'transcript_id' has invalid character ';' in GTF line %d: %s\n\n%s" % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
-                    if re.search(r'\s', properties['transcript_id']) is not None:
-                        sys.exit("Property 'transcript_id' has invalid whitespace character in GTF line %d: %s\n\n%s" % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
-                    if 'gene_id' not in properties:
-                        sys.exit("Property 'gene_id' not found in GTF line %d: %s\n\n%s" % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
-                    if ';' in properties['gene_id']:
-                        sys.exit("Property 'gene_id' has invalid character ';' in GTF line %d: %s\n\n%s" % (i+1, '\t'.join(row), self.GTF_ERROR_TXT))
+                properties = self.get_properties_dict(row[8]) if len(row) == 9 else None
+                self.check_gtf_row(i, row, properties)
 
                 yield row, False, properties
 
-    def load_gtf(self, in_gtf_fn, fasta_parser=None):
-        transcripts = {}
-        gene_to_transcripts = collections.OrderedDict()
+    def gtf_exon_iter(self, filename, block_lines=GTF_BLOCK_LINES):
+        """ Parse the exons of a GTF, reading and validating it in blocks of lines.
+        Every row is checked as in gtf_reader_iter, but each block is first checked as a
+        whole with a regex and attributes are only parsed for exon rows. Blocks that fail
+        are re-parsed row by row, reporting the first invalid row.
 
-        for row, is_comment, properties in self.gtf_reader_iter(in_gtf_fn):
-            if is_comment:
-                continue
+        Yields:
+          (chrom, start, end, strand, transcript_id, gene_id, gene_name) with a 0-based,
+          half-open [start, end).
+        """
+        whitespace_re = re.compile(r'\s')
+        with open(filename, 'r') as f:
+            first_line = 0
+            while True:
+                lines = list(itertools.islice(f, block_lines))
+                if not lines:
+                    break
+                block = ''.join(lines)
+
+                valid = GTF_INVALID_ROW_RE.search(block) is None
+
+                exons = []
+                for chrom, start, end, strand, properties_str in GTF_EXON_ROW_RE.findall(block):
+                    properties = dict(GTF_PROPERTY_RE.findall(properties_str))
+                    transcript_id = properties.get('transcript_id')
+                    gene_id = properties.get('gene_id')
+                    if transcript_id is None or gene_id is None:
+                        valid = False
+                        break
+                    exons.append((chrom, int(start) - 1, int(end), strand,
+                                  transcript_id, gene_id, properties.get('gene_name', gene_id)))
+
+                # Check the IDs of all exons in the block at once
+                if valid and exons:
+                    transcript_ids = ''.join(exon[4] for exon in exons)
+                    gene_ids = ''.join(exon[5] for exon in exons)
+                    valid = ';' not in transcript_ids and ';' not in gene_ids and \
+                            whitespace_re.search(transcript_ids) is None
+
+                if not valid:
+                    exons = []
+                    for i, line in enumerate(lines, first_line):
+                        row = line.rstrip('\r\n').split('\t')
+                        if row == [''] or row[0].startswith('#'):
+                            continue
+                        properties = self.get_properties_dict(row[8]) if len(row) == 9 else None
+                        self.check_gtf_row(i, row, properties)
+                        if row[2] == 'exon':
+                            gene_id = properties['gene_id']
+                            exons.append((row[0], int(row[3]) - 1, int(row[4]), row[6],
+                                          properties['transcript_id'], gene_id, properties.get('gene_name', gene_id)))
 
-            chrom, _, annotation, start, end, _, strand, _, _ = row
+                first_line += len(lines)
 
-            if annotation != "exon":
-                continue
+                for exon in exons:
+                    yield exon
 
-            start = int(start) - 1
-            end = int(end)
-            length = abs(end - start)
-            transcript_id = properties['transcript_id']
-            gene_id = properties['gene_id']
-            gene_name = properties.get('gene_name', gene_id)
-            gene = cr_constants.Gene(gene_id, gene_name, None, None, None)
+    def load_gtf(self, in_gtf_fn, fasta_parser=None):
+        transcripts = {}
+        gene_to_transcripts = collections.OrderedDict()
+        gene_tuples = {}
 
-            if transcript_id not in transcripts:
-                transcripts[transcript_id] = cr_constants.Transcript(gene, None, None, [])
+        for chrom, start, end, strand, transcript_id, gene_id, gene_name in self.gtf_exon_iter(in_gtf_fn):
+            length = abs(end - start)
 
-            if gene not in gene_to_transcripts:
+            gene_key = (gene_id, gene_name)
+            gene = gene_tuples.get(gene_key)
+            if gene is None:
+                gene = cr_constants.Gene(gene_id, gene_name, None, None, None)
+                gene_tuples[gene_key] = gene
                 gene_to_transcripts[gene] = set()
 
-            assert transcripts[transcript_id].gene == gene
-            transcripts[transcript_id].intervals.append(cr_constants.Interval(chrom, start, end, length, strand))
+            transcript = transcripts.get(transcript_id)
+            if transcript is None:
+                transcript = cr_constants.Transcript(gene, None, None, [])
+                transcripts[transcript_id] = transcript
+
+            assert transcript.gene == gene
+            transcript.intervals.append(cr_constants.Interval(chrom, start, end, length, strand))
             gene_to_transcripts[gene].add(transcript_id)
 
         # Transcript length and GC content
@@ -132,8 +205,7 @@ class GtfParser(object):
             return properties_str
 
         properties = collections.OrderedDict()
-        pattern = re.compile(r'(\S+?)\s*"(.*?)"')
-        for m in re.finditer(pattern, properties_str):
+        for m in GTF_PROPERTY_RE.finditer(properties_str):
             key = m.group(1)
             value = m.group(2)
             properties[key] = value
@@ -220,7 +292,9 @@ class ReferenceBuilder(GtfParser):
         print "Writing genes index file into reference folder (may take over 10 minutes for a 3Gb genome)..."
         new_gene_index = os.path.join(self.out_dir, cr_constants.REFERENCE_GENES_INDEX_PATH)
         os.mkdir(os.path.dirname(new_gene_index))
-        self.write_genome_gene_index(new_gene_index, new_gene_gtf, new_genome_fasta)
+        self.write_genome_gene_index(new_gene_index, new_gene_gtf, new_genome_fasta,
+                                     os.path.join(self.out_dir, cr_constants.REFERENCE_GENES_BINARY_INDEX_PATH),
+                                     os.path.join(self.out_dir, cr_constants.REFERENCE_TRANSCRIPTS_TSV_PATH))
         print "...done\n"
 
         print "Writing genome metadata JSON file into reference folder..."
@@ -336,10 +410,18 @@ class ReferenceBuilder(GtfParser):
                 if len(bad_premrna_rows) > 0:
                     print "WARNING: {} transcript entries were not capable of being converted to pre-mRNA entries".format(len(bad_premrna_rows))
 
-    def write_genome_gene_index(self, out_pickle_fn, in_gtf_fn, in_fasta_fn):
+    def write_genome_gene_index(self, out_pickle_fn, in_gtf_fn, in_fasta_fn,
+                                out_binary_index_dir=None, out_transcripts_tsv_fn=None):
         gene_index = GeneIndex(in_gtf_fn, in_fasta_fn)
+        # The pickle is kept for older tools that read it
         gene_index.save_pickle(out_pickle_fn)
 
+        binary_index = BinaryGeneIndex.from_gene_index(gene_index)
+        if out_binary_index_dir is not None:
+            binary_index.save(out_binary_index_dir)
+        if out_transcripts_tsv_fn is not None:
+            binary_index.write_transcript_tsv(out_transcripts_tsv_fn)
+
 class FastaParser:
     def __init__(self, in_fasta_fn):
         self.chroms = self.load_fasta(in_fasta_fn)
@@ -400,6 +482,70 @@ class FastaParser:
         else:
             return 0
 
+class IndexedFastaParser(object):
+    """ FASTA reader backed by a samtools faidx index and a memory map of the file.
+    Has the same interface as FastaParser but pages sequence in on demand instead of
+    loading the whole genome into memory. Requires uniform line lengths within each
+    sequence, as samtools faidx does. """
+    def __init__(self, in_fasta_fn, in_fai_fn=None):
+        if in_fai_fn is None:
+            in_fai_fn = in_fasta_fn + '.fai'
+
+        # chrom -> (length, byte offset, bases per line, bytes per line)
+        self.index = collections.OrderedDict()
+        with open(in_fai_fn, 'r') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                self.index[fields[0]] = tuple(int(x) for x in fields[1:5])
+
+        self._file = open(in_fasta_fn, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def _get_raw_sequence(self, chrom, start, end):
+        """ Get the bytes spanning [start,end) of chrom, including line breaks.
+        The interval is clipped to the chromosome, as slicing a sequence string would be. """
+        length, offset, line_bases, line_width = self.index[chrom]
+        start, end = max(0, min(start, length)), max(0, min(end, length))
+        if start >= end:
+            return ''
+        start_byte = offset + (start // line_bases) * line_width + start % line_bases
+        end_byte = offset + (end // line_bases) * line_width + end % line_bases
+        return self._mmap[start_byte:end_byte]
+
+    def is_valid_interval(self, chrom, start, end):
+        """ Determine whether the half-open interval [start,end) is within the bounds of chrom """
+        return chrom in self.index and start >= 0 and end <= self.index[chrom][0]
+
+    def get_sequence(self, chrom, start, end, strand=cr_constants.FORWARD_STRAND):
+        """ Get genomic sequence for the half-open interval [start,end) """
+        seq = ''.join(self._get_raw_sequence(chrom, start, end).split())
+        if strand == cr_constants.FORWARD_STRAND:
+            return seq
+        elif strand == cr_constants.REVERSE_STRAND:
+            return tk_seq.get_rev_comp(seq)
+        else:
+            raise Exception("Invalid strand: %s" % strand)
+
+    def get_transcript_gc_content(self, transcript_obj):
+        gc, length = 0, 0
+        for interval in transcript_obj.intervals:
+            if interval.chrom not in self.index:
+                continue
+
+            # Line breaks never count towards GC
+            seq = self._get_raw_sequence(interval.chrom, interval.start, interval.end)
+            gc += seq.count('G') + seq.count('C') + seq.count('g') + seq.count('c')
+            length += interval.length
+
+        if length > 0:
+            return float(gc) / float(length)
+        else:
+            return 0
+
 # NOTE: these stub classes are necessary to maintain backwards compatibility with old refdata (1.2 or older)
 class IntervalTree(object):
     pass
@@ -425,9 +571,15 @@ class GeneIndex(GtfParser):
         self.in_gtf_fn = in_gtf_fn
         self.in_fasta_fn = in_fasta_fn
 
-        fasta_parser = FastaParser(self.in_fasta_fn)
+        # Use the faidx index when there is one, rather than loading the genome into memory
+        if os.path.exists(self.in_fasta_fn + '.fai'):
+            fasta_parser = IndexedFastaParser(self.in_fasta_fn)
+        else:
+            fasta_parser = FastaParser(self.in_fasta_fn)
 
         self.transcripts, self.genes = self.load_gtf(self.in_gtf_fn, fasta_parser=fasta_parser)
+        if isinstance(fasta_parser, IndexedFastaParser):
+            fasta_parser.close()
         self.gene_ids_map = {gene.id: i for i, gene in enumerate(self.genes)}
 
     def save_pickle(self, out_pickle_fn):
@@ -487,6 +639,217 @@ class GeneIndex(GtfParser):
         self.transcripts = txs
         self.gene_ids_map = {gene.id: i for i, gene in enumerate(self.genes)}
 
+class BinaryGeneIndex(object):
+    """ Columnar, memory-mappable version of a GeneIndex.
+
+    Gene and transcript fields are stored as fixed-width string tables and numeric
+    arrays in a directory of .npy files. Arrays are memory-mapped on first access, so
+    loading the index is cheap and callers only page in the columns they use. The
+    Gene and Transcript tuples of GeneIndex are rebuilt on demand.
+    """
+    # Columns, grouped by the table they describe. Intervals are stored as ragged
+    # arrays indexed by the per-gene or per-transcript offsets.
+    GENE_COLUMNS = ['gene_ids', 'gene_names', 'gene_lengths', 'gene_gc_contents',
+                    'gene_interval_offsets', 'gene_interval_chroms',
+                    'gene_interval_starts', 'gene_interval_ends']
+    TRANSCRIPT_COLUMNS = ['transcript_ids', 'transcript_genes', 'transcript_lengths',
+                          'transcript_gc_contents', 'transcript_interval_offsets',
+                          'transcript_interval_chroms', 'transcript_interval_starts',
+                          'transcript_interval_ends', 'transcript_interval_strands']
+    COLUMNS = ['chroms'] + GENE_COLUMNS + TRANSCRIPT_COLUMNS
+
+    def __init__(self, dirname=None, arrays=None):
+        """ Open an index directory, or wrap in-memory arrays keyed by column name """
+        self.dirname = dirname
+        self._arrays = dict(arrays) if arrays is not None else {}
+        self._genes = None
+        self._transcripts = None
+        self._gene_ids_map = None
+        self._transcript_ids_map = None
+
+    def _get(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.dirname, name + '.npy'), mmap_mode='r')
+        return self._arrays[name]
+
+    @staticmethod
+    def _string_array(strs):
+        return np.array(strs, dtype='S%d' % max([1] + [len(s) for s in strs]))
+
+    @staticmethod
+    def _interval_arrays(intervals_by_row, chrom_to_idx):
+        offsets = np.zeros(len(intervals_by_row) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(intervals) for intervals in intervals_by_row])
+        flat = list(itertools.chain.from_iterable(intervals_by_row))
+        chroms = np.array([chrom_to_idx[iv.chrom] for iv in flat], dtype=np.int32)
+        starts = np.array([iv.start for iv in flat], dtype=np.int64)
+        ends = np.array([iv.end for iv in flat], dtype=np.int64)
+        strands = BinaryGeneIndex._string_array([iv.strand or '' for iv in flat])
+        return offsets, chroms, starts, ends, strands
+
+    @staticmethod
+    def from_gene_index(gene_index):
+        """ Convert a GeneIndex into columnar arrays.
+        Transcripts are grouped by gene, in gene order. """
+        genes = gene_index.genes
+        gene_to_idx = {gene.id: i for i, gene in enumerate(genes)}
+
+        transcripts_by_gene = [[] for _ in genes]
+        for transcript_id, transcript in gene_index.transcripts.iteritems():
+            transcripts_by_gene[gene_to_idx[transcript.gene.id]].append((transcript_id, transcript))
+        transcripts = list(itertools.chain.from_iterable(transcripts_by_gene))
+
+        chroms = sorted(set(iv.chrom for _, tx in transcripts for iv in tx.intervals) |
+                        set(iv.chrom for gene in genes for iv in gene.intervals))
+        chrom_to_idx = {chrom: i for i, chrom in enumerate(chroms)}
+
+        arrays = {'chroms': BinaryGeneIndex._string_array(chroms)}
+
+        arrays['gene_ids'] = BinaryGeneIndex._string_array([gene.id for gene in genes])
+        arrays['gene_names'] = BinaryGeneIndex._string_array([gene.name for gene in genes])
+        arrays['gene_lengths'] = np.array([gene.length for gene in genes], dtype=np.float64)
+        arrays['gene_gc_contents'] = np.array([gene.gc_content for gene in genes], dtype=np.float64)
+        offsets, iv_chroms, starts, ends, _ = BinaryGeneIndex._interval_arrays(
+            [gene.intervals for gene in genes], chrom_to_idx)
+        arrays['gene_interval_offsets'] = offsets
+        arrays['gene_interval_chroms'] = iv_chroms
+        arrays['gene_interval_starts'] = starts
+        arrays['gene_interval_ends'] = ends
+
+        arrays['transcript_ids'] = BinaryGeneIndex._string_array([tx_id for tx_id, _ in transcripts])
+        arrays['transcript_genes'] = np.array([gene_to_idx[tx.gene.id] for _, tx in transcripts], dtype=np.int32)
+        arrays['transcript_lengths'] = np.array([tx.length for _, tx in transcripts], dtype=np.int64)
+        arrays['transcript_gc_contents'] = np.array([tx.gc_content for _, tx in transcripts], dtype=np.float64)
+        offsets, iv_chroms, starts, ends, strands = BinaryGeneIndex._interval_arrays(
+            [tx.intervals for _, tx in transcripts], chrom_to_idx)
+        arrays['transcript_interval_offsets'] = offsets
+        arrays['transcript_interval_chroms'] = iv_chroms
+        arrays['transcript_interval_starts'] = starts
+        arrays['transcript_interval_ends'] = ends
+        arrays['transcript_interval_strands'] = strands
+
+        return BinaryGeneIndex(arrays=arrays)
+
+    def save(self, out_dirname):
+        if not os.path.exists(out_dirname):
+            os.makedirs(out_dirname)
+        for name in BinaryGeneIndex.COLUMNS:
+            np.save(os.path.join(out_dirname, name + '.npy'), self._get(name))
+
+    @staticmethod
+    def load(in_dirname):
+        return BinaryGeneIndex(dirname=in_dirname)
+
+    def write_transcript_tsv(self, out_path):
+        """ Write the transcript table consumed by annotate_reads.
+        Transcripts are grouped by gene in gene order, which must match the order
+        used in FeatureReference construction. """
+        gene_ids = self._get('gene_ids')
+        gene_names = self._get('gene_names')
+        with open(out_path, 'w') as writer:
+            writer.write('\t'.join(["transcript_id", "gene_id", "gene_name", "transcript_length"]))
+            for transcript_id, gene_idx, length in itertools.izip(self._get('transcript_ids'),
+                                                                  self._get('transcript_genes'),
+                                                                  self._get('transcript_lengths')):
+                writer.write('\n' + '\t'.join([transcript_id, gene_ids[gene_idx], gene_names[gene_idx], str(length)]))
+
+    def _get_intervals(self, prefix, row, with_strand):
+        offsets = self._get(prefix + '_interval_offsets')
+        start, end = offsets[row], offsets[row + 1]
+        chroms = self._get('chroms')
+        strands = self._get(prefix + '_interval_strands')[start:end] if with_strand else [None] * (end - start)
+        intervals = []
+        for chrom_idx, iv_start, iv_end, strand in itertools.izip(self._get(prefix + '_interval_chroms')[start:end],
+                                                                 self._get(prefix + '_interval_starts')[start:end],
+                                                                 self._get(prefix + '_interval_ends')[start:end],
+                                                                 strands):
+            intervals.append(cr_constants.Interval(chroms[chrom_idx], int(iv_start), int(iv_end),
+                                                   int(iv_end - iv_start), strand))
+        return intervals
+
+    @property
+    def genes(self):
+        if self._genes is None:
+            self._genes = [cr_constants.Gene(gene_id, name, length, gc_content,
+                                             self._get_intervals('gene', i, False))
+                           for i, (gene_id, name, length, gc_content) in enumerate(itertools.izip(
+                                   self._get('gene_ids'), self._get('gene_names'),
+                                   self._get('gene_lengths'), self._get('gene_gc_contents')))]
+        return self._genes
+
+    @property
+    def transcripts(self):
+        if self._transcripts is None:
+            genes = self.genes
+            self._transcripts = {}
+            for i, (transcript_id, gene_idx, length, gc_content) in enumerate(itertools.izip(
+                    self._get('transcript_ids'), self._get('transcript_genes'),
+                    self._get('transcript_lengths'), self._get('transcript_gc_contents'))):
+                self._transcripts[transcript_id] = cr_constants.Transcript(
+                    genes[gene_idx], int(length), gc_content, self._get_intervals('transcript', i, True))
+        return self._transcripts
+
+    @property
+    def gene_ids_map(self):
+        if self._gene_ids_map is None:
+            self._gene_ids_map = {gene_id: i for i, gene_id in enumerate(self._get('gene_ids'))}
+        return self._gene_ids_map
+
+    def _transcript_id_to_int(self, transcript):
+        if self._transcript_ids_map is None:
+            self._transcript_ids_map = {tx_id: i for i, tx_id in enumerate(self._get('transcript_ids'))}
+        return self._transcript_ids_map.get(transcript)
+
+    def get_transcript_length(self, transcript):
+        i = self._transcript_id_to_int(transcript)
+        return int(self._get('transcript_lengths')[i]) if i is not None else None
+
+    def get_transcript_gc_content(self, transcript):
+        i = self._transcript_id_to_int(transcript)
+        return self._get('transcript_gc_contents')[i] if i is not None else None
+
+    def get_gene_from_transcript(self, transcript):
+        i = self._transcript_id_to_int(transcript)
+        return self.get_gene_by_int(self._get('transcript_genes')[i]) if i is not None else None
+
+    def gene_id_to_int(self, gene_id):
+        return self.gene_ids_map.get(gene_id)
+
+    def get_gene_by_int(self, gene_idx):
+        if self._genes is not None:
+            return self._genes[gene_idx]
+        return cr_constants.Gene(self._get('gene_ids')[gene_idx], self._get('gene_names')[gene_idx],
+                                 self._get('gene_lengths')[gene_idx], self._get('gene_gc_contents')[gene_idx],
+                                 self._get_intervals('gene', gene_idx, False))
+
+    def get_genes(self):
+        return self.genes
+
+    def get_gene(self, gene_id):
+        return self.get_gene_by_int(self.gene_id_to_int(gene_id))
+
+    def get_gene_lengths(self):
+        return list(self._get('gene_lengths'))
+
+    def get_gene_gc_contents(self):
+        return list(self._get('gene_gc_contents'))
+
+    def get_gene_names(self):
+        return list(self._get('gene_names'))
+
+    def get_gene_ids(self):
+        return list(self._get('gene_ids'))
+
+
+def load_gene_index(reference_path):
+    """ Load the gene index of a reference.
+    Uses the binary index if the reference has one, else the pickled GeneIndex
+    written by older versions. """
+    binary_index_path = os.path.join(reference_path, cr_constants.REFERENCE_GENES_BINARY_INDEX_PATH)
+    if os.path.isdir(binary_index_path):
+        return BinaryGeneIndex.load(binary_index_path)
+    return GeneIndex.load_pickle(os.path.join(reference_path, cr_constants.REFERENCE_GENES_INDEX_PATH))
+
 class STAR:
     def __init__(self, reference_star_path):
         self.reference_star_path = reference_star_path
@@ -5,6 +5,7 @@
 
 from collections import namedtuple, OrderedDict
 from cellranger import csv_utils
+import itertools
 import re
 import os
 import cellranger.io as cr_io
@@ -60,6 +61,12 @@ class FeatureExtractor(object):
         self.patterns = FeatureExtractor._compile(feature_ref.feature_defs,
                                                   use_feature_types)
 
+        # Precompiled span finders, grouped by read type in pattern iteration order
+        self.matchers = {}
+        for ((entry_read, _), entry) in self.patterns.iteritems():
+            matcher = compile_pattern_matcher(entry.regex_string, entry.regex)
+            self.matchers.setdefault(entry_read, []).append((matcher, entry))
+
     @classmethod
     def _compile(cls, feature_defs, use_feature_types=None):
         '''Prepare for feature barcode extraction.
@@ -141,14 +148,10 @@ class FeatureExtractor(object):
         matches = []
         any_whitelist_hits = False
 
-        for ((entry_read, _), entry) in self.patterns.iteritems():
-            if entry_read != read_type:
-                continue
-
+        for matcher, entry in self.matchers.get(read_type, []):
             # Extract potential barcode sequences
-            regex_match = re.search(entry.regex, seq)
-            if regex_match is not None:
-                span = regex_match.span(1)
+            span = matcher(seq)
+            if span is not None:
                 bc = seq[span[0]:span[1]]
                 bc_qual = qual[span[0]:span[1]]
 
@@ -248,15 +251,14 @@ def from_transcriptome_and_csv(gene_ref_path, feature_def_filename, target_featu
     genomes = cr_utils.get_reference_genomes(gene_ref_path)
 
     if gene_ref_path is not None:
-        gene_idx_filename = cr_utils.get_reference_genes_index(gene_ref_path)
-        gene_index = cr_reference.GeneIndex.load_pickle(gene_idx_filename)
+        gene_index = cr_reference.load_gene_index(gene_ref_path)
 
         # Stuff relevant fields of Gene tuple into FeatureDef
-        for gene in gene_index.genes:
-            genome = cr_utils.get_genome_from_str(gene.id, genomes)
+        for gene_id, gene_name in itertools.izip(gene_index.get_gene_ids(), gene_index.get_gene_names()):
+            genome = cr_utils.get_genome_from_str(gene_id, genomes)
             fd = FeatureDef(index=len(feature_defs),
-                            id=gene.id,
-                            name=gene.name,
+                            id=gene_id,
+                            name=gene_name,
                             feature_type=rna_library.GENE_EXPRESSION_LIBRARY_TYPE,
                             tags={GENOME_FEATURE_TAG: genome, })
             feature_defs.append(fd)
@@ -354,6 +356,77 @@ def compile_pattern(pattern_str, length):
     return regex_str, regex
 
 
+def compile_pattern_matcher(regex_str, regex):
+    '''Build a function that finds the feature barcode span of a compiled pattern.
+
+    Patterns anchored at either end put the barcode at a fixed offset, and
+    unanchored patterns with a constant sequence on one side reduce to a
+    substring search. Both are much cheaper than running the regex.
+    Other patterns fall back to the regex.
+
+    Args:
+        regex_str (str): Regex string from compile_pattern.
+        regex: Compiled regex from compile_pattern.
+
+    Returns:
+        function (str) -> (int, int): Returns the span of the barcode in a sequence,
+            or None if the pattern does not match. Equivalent to re.search(regex, seq).span(1).
+    '''
+    parts = re.match(r'^(\^?)([ACGT.]*)\(\.\{(\d+),\d+\}\)([ACGT.]*)(\$?)$', regex_str)
+
+    def regex_matcher(seq):
+        regex_match = regex.search(seq)
+        return regex_match.span(1) if regex_match is not None else None
+
+    if parts is None:
+        return regex_matcher
+
+    anchor_start, prefix, bc_len, suffix, anchor_end = parts.groups()
+    bc_len = int(bc_len)
+    pattern_len = len(prefix) + bc_len + len(suffix)
+
+    # Constant bases to check, relative to the start of the pattern
+    fixed_bases = [(i, base) for i, base in enumerate(prefix) if base != '.'] + \
+                  [(len(prefix) + bc_len + i, base) for i, base in enumerate(suffix) if base != '.']
+
+    if anchor_start or anchor_end:
+        def fixed_offset_matcher(seq):
+            if anchor_end:
+                start = len(seq) - pattern_len
+                if start < 0 or (anchor_start and start != 0):
+                    return None
+            else:
+                start = 0
+                if len(seq) < pattern_len:
+                    return None
+            for i, base in fixed_bases:
+                if seq[start + i] != base:
+                    return None
+            bc_start = start + len(prefix)
+            return (bc_start, bc_start + bc_len)
+        return fixed_offset_matcher
+
+    if not prefix and suffix and '.' not in suffix:
+        # Leftmost occurrence of the suffix with room for the barcode before it
+        def suffix_matcher(seq):
+            idx = seq.find(suffix, bc_len)
+            if idx < 0:
+                return None
+            return (idx - bc_len, idx)
+        return suffix_matcher
+
+    if prefix and not suffix and '.' not in prefix:
+        # Only the leftmost occurrence of the prefix can leave room for the barcode
+        def prefix_matcher(seq):
+            idx = seq.find(prefix)
+            if idx < 0 or idx + pattern_len > len(seq):
+                return None
+            return (idx + len(prefix), idx + pattern_len)
+        return prefix_matcher
+
+    return regex_matcher
+
+
 def get_required_csv_columns():
     '''Get a list of required CSV columns. '''
     return [col for col in (BASE_FEATURE_FIELDS + REQUIRED_TAGS)]
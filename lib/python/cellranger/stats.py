@@ -3,9 +3,14 @@
 # Copyright (c) 2015 10X Genomics, Inc. All rights reserved.
 #
 import array
+import hashlib
+import itertools
+import multiprocessing
 import numpy as np
+import os
+import scipy.sparse as sp_sparse
+import scipy.special as sp_special
 import scipy.stats as sp_stats
-import sys
 import cellranger.constants as cr_constants
 import tenkit.constants as tk_constants
 import tenkit.seq as tk_seq
@@ -15,6 +20,9 @@ import sklearn.mixture as sk_mix
 
 from cellranger.metrics import BarcodeFilterResults
 
+# Number of multinomial simulations run together (vectorized) in one block
+MULTINOMIAL_SIMS_PER_BLOCK = 250
+
 def to_col_vec(a):
     """ Convert a 1-d array to a column vector """
     return np.reshape(a, (len(a), 1))
@@ -221,96 +229,145 @@ def est_background_profile_bottom(matrix, bottom_frac):
 
     return (nz_feat, bg_profile_p)
 
-def eval_multinomial_loglikelihoods(matrix, profile_p, max_mem_gb=0.1):
+def eval_multinomial_loglikelihoods(matrix, profile_p):
     """Compute the multinomial log PMF for many barcodes
+       Works directly on the nonzero entries, so the cost scales with the number of
+       nonzeros rather than features x barcodes.
     Args:
       matrix (scipy.sparse.csc_matrix): Matrix of UMI counts (feature x barcode)
       profile_p (np.ndarray(float)): Multinomial probability vector
-      max_mem_gb (float): Try to bound memory usage.
     Returns:
       log_likelihoods (np.ndarray(float)): Log-likelihood for each barcode
     """
-    gb_per_bc = float(matrix.shape[0] * matrix.dtype.itemsize) / (1024**3)
-    bcs_per_chunk = max(1, int(round(max_mem_gb/gb_per_bc)))
+    matrix = sp_sparse.csc_matrix(matrix)
+    matrix.sum_duplicates()
     num_bcs = matrix.shape[1]
 
-    loglk = np.zeros(num_bcs)
+    counts = matrix.data.astype(float)
+    nz_bcs = np.repeat(np.arange(num_bcs), np.diff(matrix.indptr))
+    with np.errstate(divide='ignore'):
+        log_profile_p = np.log(profile_p)
+
+    n = np.bincount(nz_bcs, weights=counts, minlength=num_bcs)
+    sum_gammaln = np.bincount(nz_bcs, weights=sp_special.gammaln(counts + 1), minlength=num_bcs)
+    sum_log_p = np.bincount(nz_bcs, weights=counts * log_profile_p[matrix.indices], minlength=num_bcs)
+
+    return sp_special.gammaln(n + 1) - sum_gammaln + sum_log_p
+
+def multinomial_logpmf_rows(counts, n, log_p):
+    """Multinomial log PMF of each row of a dense count matrix
+    Args:
+      counts (np.ndarray(int)): Matrix of counts (sample x feature)
+      n (int): Multinomial N (sum of each row)
+      log_p (np.ndarray(float)): Log of the multinomial probability vector
+    Returns:
+      log_likelihoods (np.ndarray(float)): Log PMF of each row
+    """
+    return sp_special.gammaln(n + 1) - sp_special.gammaln(counts + 1).sum(axis=1) + counts.dot(log_p)
+
+def _simulate_multinomial_loglikelihoods_block(block_args):
+    """Run a block of simulations for simulate_multinomial_loglikelihoods_parallel.
+    All simulations in the block advance together, one feature draw per step.
+    Args:
+      block_args (tuple): (profile_p, distinct_n, num_sims, jump, seed)
+    Returns:
+      log_likelihoods (np.ndarray(float)): len(distinct_n) x num_sims matrix
+    """
+    profile_p, distinct_n, num_sims, jump, seed = block_args
+    rng = np.random.RandomState(seed)
+    log_profile_p = np.log(profile_p)
+    sims = np.arange(num_sims)
+
+    loglk = np.zeros((len(distinct_n), num_sims), dtype=float)
+
+    counts = rng.multinomial(distinct_n[0], profile_p, size=num_sims)
+    curr_loglk = multinomial_logpmf_rows(counts, distinct_n[0], log_profile_p)
+    loglk[0] = curr_loglk
+
+    for i in xrange(1, len(distinct_n)):
+        step = distinct_n[i] - distinct_n[i-1]
+        if step >= jump:
+            # Instead of iterating for each n, sample the intermediate ns all at once
+            counts += rng.multinomial(step, profile_p, size=num_sims)
+            curr_loglk = multinomial_logpmf_rows(counts, distinct_n[i], log_profile_p)
+            assert not np.any(np.isnan(curr_loglk))
+        else:
+            # Iteratively sample between the two distinct values of n
+            sampled_features = rng.choice(len(profile_p), size=(step, num_sims), p=profile_p, replace=True)
+            for n, j in itertools.izip(xrange(distinct_n[i-1]+1, distinct_n[i]+1), sampled_features):
+                counts[sims, j] += 1
+                curr_loglk += log_profile_p[j] + np.log(float(n) / counts[sims, j])
+
+        loglk[i] = curr_loglk
 
-    for chunk_start in xrange(0, num_bcs, bcs_per_chunk):
-        chunk = slice(chunk_start, chunk_start+bcs_per_chunk)
-        matrix_chunk = matrix[:,chunk].transpose().toarray()
-        n = matrix_chunk.sum(1)
-        loglk[chunk] = sp_stats.multinomial.logpmf(matrix_chunk, n, p=profile_p)
     return loglk
 
-def simulate_multinomial_loglikelihoods(profile_p, umis_per_bc,
-                                        num_sims=1000, jump=1000,
-                                        n_sample_feature_block=1000000, verbose=False):
+def get_multinomial_sim_cache_path(cache_dir, profile_p, distinct_n, num_sims, jump, seed):
+    """Path of the cached simulations for an ambient profile and N grid"""
+    key = hashlib.sha1()
+    key.update(np.ascontiguousarray(profile_p, dtype=float).tobytes())
+    key.update(np.ascontiguousarray(distinct_n, dtype=np.int64).tobytes())
+    key.update(repr((num_sims, jump, seed, MULTINOMIAL_SIMS_PER_BLOCK)))
+    return os.path.join(cache_dir, 'multinomial_sims_%s.npy' % key.hexdigest())
+
+def simulate_multinomial_loglikelihoods_parallel(profile_p, umis_per_bc,
+                                                 num_sims=1000, jump=1000,
+                                                 num_procs=1, seed=0, cache_dir=None, verbose=False):
     """Simulate draws from a multinomial distribution for various values of N.
 
        Uses the approximation from Lun et al. ( https://www.biorxiv.org/content/biorxiv/early/2018/04/04/234872.full.pdf )
+       The simulations are split into blocks that are vectorized across simulations and optionally run on
+       a process pool. Block b is seeded with seed + b, so results do not depend on num_procs.
 
     Args:
       profile_p (np.ndarray(float)): Probability of observing each feature.
       umis_per_bc (np.ndarray(int)): UMI counts per barcode (multinomial N).
       num_sims (int): Number of simulations per distinct N value.
       jump (int): Vectorize the sampling if the gap between two distinct Ns exceeds this.
-      n_sample_feature_block (int): Vectorize this many feature samplings at a time.
+      num_procs (int): Number of processes to run blocks of simulations on.
+      seed (int): Base random seed.
+      cache_dir (str): If not None, reuse simulations cached here for the same
+        profile, distinct Ns and parameters, and cache new ones.
     Returns:
       (distinct_ns (np.ndarray(int)), log_likelihoods (np.ndarray(float)):
       distinct_ns is an array containing the distinct N values that were simulated.
       log_likelihoods is a len(distinct_ns) x num_sims matrix containing the
         simulated log likelihoods.
     """
-    np.random.seed(0)
-
     distinct_n = np.flatnonzero(np.bincount(umis_per_bc))
 
-    loglk = np.zeros((len(distinct_n), num_sims), dtype=float)
-    num_all_n = np.max(distinct_n) - np.min(distinct_n)
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = get_multinomial_sim_cache_path(cache_dir, profile_p, distinct_n, num_sims, jump, seed)
+        if os.path.exists(cache_path):
+            if verbose:
+                print 'Loading cached simulations from %s' % cache_path
+            return distinct_n, np.load(cache_path)
+
     if verbose:
         print 'Number of distinct N supplied: %d' % len(distinct_n)
-        print 'Range of N: %d' % num_all_n
+        print 'Range of N: %d' % (np.max(distinct_n) - np.min(distinct_n))
         print 'Number of features: %d' % len(profile_p)
 
-    sampled_features = np.random.choice(len(profile_p), size=n_sample_feature_block, p=profile_p, replace=True)
-    k = 0
-
-    log_profile_p = np.log(profile_p)
-
-    for sim_idx in xrange(num_sims):
-        if verbose and sim_idx % 100 == 99:
-            sys.stdout.write('.')
-            sys.stdout.flush()
-        curr_counts = np.ravel(sp_stats.multinomial.rvs(distinct_n[0], profile_p, size=1))
-
-        curr_loglk = sp_stats.multinomial.logpmf(curr_counts, distinct_n[0], p=profile_p)
-
-        loglk[0, sim_idx] = curr_loglk
-
-        for i in xrange(1, len(distinct_n)):
-            step = distinct_n[i] - distinct_n[i-1]
-            if step >= jump:
-                # Instead of iterating for each n, sample the intermediate ns all at once
-                curr_counts += np.ravel(sp_stats.multinomial.rvs(step, profile_p, size=1))
-                curr_loglk = sp_stats.multinomial.logpmf(curr_counts, distinct_n[i], p=profile_p)
-                assert not np.isnan(curr_loglk)
-            else:
-                # Iteratively sample between the two distinct values of n
-                for n in xrange(distinct_n[i-1]+1, distinct_n[i]+1):
-                    j = sampled_features[k]
-                    k += 1
-                    if k >= n_sample_feature_block:
-                        # Amortize this operation
-                        sampled_features = np.random.choice(len(profile_p), size=n_sample_feature_block, p=profile_p, replace=True)
-                        k = 0
-                    curr_counts[j] += 1
-                    curr_loglk += log_profile_p[j] + np.log(float(n)/curr_counts[j])
-
-            loglk[i, sim_idx] = curr_loglk
-
-    if verbose:
-        sys.stdout.write('\n')
+    block_args = []
+    for block_idx, block_start in enumerate(xrange(0, num_sims, MULTINOMIAL_SIMS_PER_BLOCK)):
+        block_sims = min(MULTINOMIAL_SIMS_PER_BLOCK, num_sims - block_start)
+        block_args.append((profile_p, distinct_n, block_sims, jump, seed + block_idx))
+
+    if num_procs > 1:
+        pool = multiprocessing.Pool(num_procs)
+        try:
+            blocks = pool.map(_simulate_multinomial_loglikelihoods_block, block_args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        blocks = map(_simulate_multinomial_loglikelihoods_block, block_args)
+
+    loglk = np.concatenate(blocks, axis=1)
+
+    if cache_path is not None:
+        np.save(cache_path, loglk)
 
     return distinct_n, loglk
 
@@ -208,6 +208,84 @@ def construct_all_subsamplings(molecule_info_h5,
     return subsamplings
 
 
+def get_mol_cell_indices(mol_gem_group, mol_barcode_idx, barcodes, cell_bc_to_int):
+    """Map each molecule to the integer index of its cell-associated barcode.
+
+    Barcode strings are only formatted once per distinct (gem_group, barcode_idx)
+    pair in the chunk rather than once per molecule.
+
+    Args:
+        mol_gem_group (np.array of int): gem group of each molecule
+        mol_barcode_idx (np.array of int): barcode index of each molecule
+        barcodes (np.array of str): barcode sequences from the MoleculeCounter
+        cell_bc_to_int (dict of str to int): cell-associated barcode to cell index
+    Returns:
+        np.array of int: cell index of each molecule, -1 if not cell-associated
+    """
+    if len(mol_barcode_idx) == 0:
+        return np.zeros(0, dtype=np.int64)
+    max_bc_idx = np.int64(len(barcodes))
+    mol_keys = mol_gem_group.astype(np.int64) * max_bc_idx + mol_barcode_idx.astype(np.int64)
+    uniq_keys, mol_uniq_idx = np.unique(mol_keys, return_inverse=True)
+    uniq_cell_idx = np.fromiter(
+        (cell_bc_to_int.get(cr_utils.format_barcode_seq(barcodes[key % max_bc_idx], key // max_bc_idx), -1)
+         for key in uniq_keys),
+        dtype=np.int64, count=len(uniq_keys))
+    return uniq_cell_idx[mol_uniq_idx]
+
+
+def tally_subsampled_molecules(read_pairs, mol_cell_idx, mol_genome_idx, mol_feature_idx, cell_in_genome):
+    """Tally per-cell and per-genome counts for one subsampling task.
+
+    All tallies are computed with bincount over flattened (genome, cell) keys,
+    so the cost is a handful of passes over the molecule arrays.
+
+    Args:
+        read_pairs (np.array of int): subsampled read pairs per molecule
+        mol_cell_idx (np.array of int): cell index per molecule (-1 for non-cells),
+            from get_mol_cell_indices
+        mol_genome_idx (np.array of int): genome index per molecule
+        mol_feature_idx (np.array of int): feature index per molecule
+        cell_in_genome (np.array of bool): (n_genomes, n_cells) mask of which cells
+            are cell-associated for each genome
+    Returns:
+        dict: 'umis_per_bc', 'read_pairs_per_bc', 'features_det_per_bc' of shape
+            (n_genomes, n_cells), and 'read_pairs', 'umis' of shape (n_genomes,)
+    """
+    n_genomes, n_cells = cell_in_genome.shape
+    n_keys = n_genomes * n_cells
+    is_umi = read_pairs > 0
+
+    # Tally numbers for duplicate fraction (all barcodes, not just cells)
+    read_pairs_per_genome = np.bincount(mol_genome_idx, weights=read_pairs, minlength=n_genomes)
+    umis_per_genome = np.bincount(mol_genome_idx[is_umi], minlength=n_genomes)
+
+    # Tally UMIs, read pairs and features detected per (genome, cell)
+    is_cell = mol_cell_idx >= 0
+    mol_key = mol_genome_idx[is_cell].astype(np.int64) * n_cells + mol_cell_idx[is_cell]
+    cell_read_pairs = read_pairs[is_cell]
+    cell_is_umi = is_umi[is_cell]
+
+    read_pairs_per_bc = np.bincount(mol_key, weights=cell_read_pairs, minlength=n_keys)
+    umis_per_bc = np.bincount(mol_key[cell_is_umi], minlength=n_keys)
+
+    umi_key = mol_key[cell_is_umi]
+    umi_feature = mol_feature_idx[is_cell][cell_is_umi].astype(np.int64)
+    n_features = umi_feature.max() + 1 if len(umi_feature) > 0 else 1
+    key_feature = np.unique(umi_key * n_features + umi_feature)
+    features_det_per_bc = np.bincount(key_feature // n_features, minlength=n_keys)
+
+    # Only report barcodes that are cell-associated for the given genome
+    shape = (n_genomes, n_cells)
+    return {
+        'umis_per_bc': umis_per_bc.reshape(shape) * cell_in_genome,
+        'read_pairs_per_bc': read_pairs_per_bc.reshape(shape) * cell_in_genome,
+        'features_det_per_bc': features_det_per_bc.reshape(shape) * cell_in_genome,
+        'read_pairs': read_pairs_per_genome,
+        'umis': umis_per_genome,
+    }
+
+
 def run_subsampling(molecule_info_h5, subsample_info, filtered_barcodes_csv, feature_indices,
                     chunk_start, chunk_len):
     """
@@ -270,6 +348,12 @@ def run_subsampling(molecule_info_h5, subsample_info, filtered_barcodes_csv, fea
         lib_type_idx = lib_idx_to_lib_type_idx[lib_idx]
         lib_type_genome_any_reads[lib_type_idx, genome_idx] = True
 
+    # Map each molecule to a cell index (or -1) once, instead of per task
+    cell_in_genome = np.zeros((len(genomes), len(cell_bcs)), dtype=np.bool)
+    for genome_idx, genome in enumerate(genomes):
+        cell_in_genome[genome_idx, [cell_bc_to_int[bc] for bc in cell_bcs_by_genome[genome]]] = True
+    mol_cell_idx = get_mol_cell_indices(mol_gem_group, mol_barcode_idx, barcodes, cell_bc_to_int)
+
     # Run each subsampling task on this chunk of data
     n_tasks = len(subsample_info)
     n_genomes = len(genomes)
@@ -294,31 +378,13 @@ def run_subsampling(molecule_info_h5, subsample_info, filtered_barcodes_csv, fea
         # Subsampled read pairs per molecule
         new_read_pairs = np.random.binomial(mol_read_pairs, mol_rate)
 
-        # Compute tallies for each barcode
-        group_keys = (mol_gem_group, mol_barcode_idx)
-        group_values = (mol_feature_idx, mol_genome_idx, new_read_pairs)
-        for (gg, bc_idx), (feature_idx, genome_idx, read_pairs) in \
-                cr_utils.numpy_groupby(group_values, group_keys):
-
-            barcode = cr_utils.format_barcode_seq(barcodes[bc_idx], gg)
-
-            cell_idx = cell_bc_to_int.get(barcode)
-
-            for this_genome_idx in xrange(len(genomes)):
-                umis = np.flatnonzero((read_pairs > 0) & (genome_idx == this_genome_idx))
-                this_genome_read_pairs = np.sum(read_pairs[genome_idx == this_genome_idx])
-
-                # Tally UMIs and median features detected
-                if barcode in cell_bcs_by_genome[genomes[this_genome_idx]]:
-                    # This is a cell-associated barcode for this genome
-                    umis_per_bc[task_idx, this_genome_idx, cell_idx] = len(umis)
-                    read_pairs_per_bc[task_idx, this_genome_idx, cell_idx] = this_genome_read_pairs
-                    features_det_per_bc[task_idx, this_genome_idx, cell_idx] = np.count_nonzero(
-                        np.bincount(feature_idx[umis]))
-
-                # Tally numbers for duplicate fraction
-                read_pairs_per_task[task_idx, this_genome_idx] += this_genome_read_pairs
-                umis_per_task[task_idx, this_genome_idx] += len(umis)
+        tallies = tally_subsampled_molecules(new_read_pairs, mol_cell_idx, mol_genome_idx,
+                                             mol_feature_idx, cell_in_genome)
+        umis_per_bc[task_idx] = tallies['umis_per_bc']
+        read_pairs_per_bc[task_idx] = tallies['read_pairs_per_bc']
+        features_det_per_bc[task_idx] = tallies['features_det_per_bc']
+        read_pairs_per_task[task_idx] = tallies['read_pairs']
+        umis_per_task[task_idx] = tallies['umis']
 
     data = {
         'umis_per_bc': umis_per_bc,
@@ -5,12 +5,15 @@
 import collections
 import csv
 import h5py
+import hashlib
 import itertools
 import json
 import numpy as np
 import os
 import random
 import re
+import shutil
+import tempfile
 import tenkit.bam as tk_bam
 import tenkit.fasta as tk_fasta
 import tenkit.log_subprocess as tk_subproc
@@ -54,6 +57,10 @@ def get_reference_genes_index(reference_path):
     return os.path.join(reference_path, cr_constants.REFERENCE_GENES_INDEX_PATH)
 
 
+def get_reference_transcripts_tsv(reference_path):
+    return os.path.join(reference_path, cr_constants.REFERENCE_TRANSCRIPTS_TSV_PATH)
+
+
 def get_reference_gtf_path(reference_path):
     return os.path.join(reference_path, cr_constants.REFERENCE_GENES_GTF_PATH)
 
@@ -87,6 +94,50 @@ def barcode_sort_key_no_umi(read):
     return gg, bc
 
 
+def barcode_qname_sort_key(read):
+    """ Sort by barcode_sort_key, maintaining qname ordering within each key """
+    return barcode_sort_key(read), read.qname
+
+
+# Packed sort keys. Barcodes are 2-bit packed and followed by their length,
+# UMIs are packed 3 bits per base in ASCII order (N sorts between G and T),
+# so that comparing the packed integers matches comparing the strings.
+SORT_KEY_MAX_BC_LEN = 21
+SORT_KEY_MAX_UMI_LEN = 16
+SORT_KEY_UMI_NUCS = {nuc: i + 1 for i, nuc in enumerate('ACGNT')}
+
+
+def barcode_sort_key_ints(read):
+    """ Pack barcode_sort_key(read) into a pair of integers that sort the same way.
+    Returns (gem_group << 48 | 2-bit barcode << 5 | barcode length,
+             library_idx << 48 | 3-bit raw UMI).
+    Raises ValueError if the barcode or UMI cannot be packed. """
+    gg, bc, library_idx, umi = barcode_sort_key(read)
+
+    bc_key = 0
+    if bc is not None:
+        if len(bc) > SORT_KEY_MAX_BC_LEN or any(nuc not in tk_seq.NUCS_INVERSE for nuc in bc):
+            raise ValueError('Cannot pack barcode %s into a sort key' % bc)
+        bc_key = compress_seq(bc) << 2 * (SORT_KEY_MAX_BC_LEN - len(bc))
+        bc_key = ((gg or 0) << 48) | (bc_key << 5) | len(bc)
+
+    umi_key = 0
+    if umi is not None:
+        if len(umi) > SORT_KEY_MAX_UMI_LEN or any(nuc not in SORT_KEY_UMI_NUCS for nuc in umi):
+            raise ValueError('Cannot pack UMI %s into a sort key' % umi)
+        for nuc in umi:
+            umi_key = (umi_key << 3) | SORT_KEY_UMI_NUCS[nuc]
+        umi_key = umi_key << 3 * (SORT_KEY_MAX_UMI_LEN - len(umi))
+    umi_key = ((library_idx or 0) << 48) | umi_key
+
+    return bc_key, umi_key
+
+
+def get_sort_keys_path(bam_path):
+    """ Path of the packed sort keys (see barcode_sort_key_ints) stored alongside a BAM """
+    return os.path.splitext(bam_path)[0] + '_sort_keys.npy'
+
+
 def pos_sort_key(read):
     return read.tid, read.pos
 
@@ -488,23 +539,27 @@ def load_barcode_whitelist(filename, as_set=False):
     return load_barcode_tsv(path, as_set)
 
 
-def load_barcode_translate_map(bc_whitelist):
-    """
-    Guide BC to Cell BC translate.
-
-    If the barcode whitelist needs to translate, return the mapping dictionary,
-    else, return None.
-    """
+def get_barcode_translate_path(bc_whitelist):
+    """ Path of the translation file for a whitelist name, or None if it has none """
     if bc_whitelist is None:
         return None
 
-    file_path = None
     for extension in ['.txt', '.txt.gz']:
         file_ext = os.path.join(
             cr_constants.BARCODE_WHITELIST_TRANSLATE_PATH, bc_whitelist + extension)
         if os.path.exists(file_ext):
-            file_path = file_ext
-            break
+            return file_ext
+    return None
+
+
+def load_barcode_translate_map(bc_whitelist):
+    """
+    Guide BC to Cell BC translate.
+
+    If the barcode whitelist needs to translate, return the mapping dictionary,
+    else, return None.
+    """
+    file_path = get_barcode_translate_path(bc_whitelist)
 
     if file_path is None:
         return None
@@ -518,6 +573,476 @@ def load_barcode_translate_map(bc_whitelist):
         return translate_map
 
 
+# Longest barcode that fits in a uint64 key with its 2-bit sentinel
+MAX_PACKED_BARCODE_LEN = 31
+
+# 2-bit codes of each byte; bytes other than ACGT are invalid
+_NUC_CODES = np.full(256, 0xff, dtype=np.uint8)
+for _code, _nuc in enumerate('ACGT'):
+    _NUC_CODES[ord(_nuc)] = _code
+_NUC_CODES_DICT = {nuc: code for code, nuc in enumerate('ACGT')}
+
+# Arrays stored in a whitelist index directory
+BARCODE_INDEX_ARRAYS = ['keys', 'indices', 'keys_by_index', 'translate_keys']
+
+# Environment variable overriding the directory where whitelist indices are cached
+BARCODE_INDEX_CACHE_ENV = 'CELLRANGER_BARCODE_INDEX_CACHE'
+
+
+def _barcode_chars(barcodes):
+    """ Bytes of each sequence as a 2-d uint8 array, and the length of each sequence """
+    barcodes = np.ascontiguousarray(barcodes, dtype='S')
+    width = barcodes.dtype.itemsize
+    chars = barcodes.view(np.uint8).reshape(len(barcodes), width)
+    return chars, np.count_nonzero(chars, axis=1)
+
+
+def _pack_chars(chars, lengths):
+    """ Pack the first lengths[i] bytes of each row of chars; 0 where they can't be packed """
+    width = min(chars.shape[1], MAX_PACKED_BARCODE_LEN)
+    # One contiguous row of codes per position
+    codes = np.ascontiguousarray(_NUC_CODES[chars[:, 0:width]].T)
+    keys = np.ones(len(chars), dtype=np.uint64)
+    valid = (lengths > 0) & (lengths <= MAX_PACKED_BARCODE_LEN)
+    for pos in xrange(width):
+        in_seq = pos < lengths
+        valid &= ~in_seq | (codes[pos] < 4)
+        keys[in_seq] = (keys[in_seq] << np.uint64(2)) | codes[pos][in_seq]
+
+    keys[~valid] = 0
+    return keys
+
+
+def pack_barcodes(barcodes):
+    """ Pack DNA sequences into 2-bit uint64 keys, vectorized.
+    A leading 1 bit is prepended to each key so that sequences of different lengths
+    never collide. Sequences that are empty, too long, or contain bases other than ACGT
+    get the key 0, which is never a valid key.
+
+    Args:
+      barcodes (iterable of str): Sequences to pack.
+    Returns:
+      np.array(uint64): One key per sequence.
+    """
+    barcodes = np.asarray(barcodes, dtype='S')
+    if barcodes.size == 0:
+        return np.zeros(0, dtype=np.uint64)
+    return _pack_chars(*_barcode_chars(barcodes))
+
+
+def pack_barcode(barcode):
+    """ Scalar version of pack_barcodes; returns a python int """
+    if not 0 < len(barcode) <= MAX_PACKED_BARCODE_LEN:
+        return 0
+    key = 1
+    for nuc in barcode:
+        code = _NUC_CODES_DICT.get(nuc)
+        if code is None:
+            return 0
+        key = (key << 2) | code
+    return key
+
+
+def _unpack_chars(keys):
+    """ Bytes of the sequence of each key as a 2-d uint8 array, and the length of each sequence """
+    # The position of the sentinel bit gives the sequence length
+    msb = np.zeros(len(keys), dtype=np.uint64)
+    remaining = keys.copy()
+    for shift in (32, 16, 8, 4, 2, 1):
+        has_bits = (remaining >> np.uint64(shift)) != 0
+        remaining = np.where(has_bits, remaining >> np.uint64(shift), remaining)
+        msb += has_bits * np.uint64(shift)
+    lengths = (msb // np.uint64(2)).astype(np.int64)
+
+    width = max(1, int(lengths.max()))
+    nucs = np.fromstring('ACGT', dtype=np.uint8)
+    chars = np.zeros((len(keys), width), dtype=np.uint8)
+    for pos in xrange(width):
+        in_seq = pos < lengths
+        shift = np.maximum(lengths - pos - 1, 0).astype(np.uint64) * np.uint64(2)
+        codes = ((keys >> shift) & np.uint64(3)).astype(np.intp)
+        chars[:, pos] = np.where(in_seq, nucs[codes], 0)
+    return chars, lengths
+
+
+def unpack_barcodes(keys):
+    """ Unpack 2-bit keys produced by pack_barcodes into sequences.
+
+    Args:
+      keys (np.array(uint64)): Valid (nonzero) keys.
+    Returns:
+      np.array(str): One sequence per key.
+    """
+    keys = np.asarray(keys, dtype=np.uint64)
+    if keys.size == 0:
+        return np.zeros(0, dtype='S1')
+
+    chars, _ = _unpack_chars(keys)
+    return np.ascontiguousarray(chars).view('S%d' % chars.shape[1]).ravel()
+
+
+# Barcodes with a gem group suffix (SEQ-GEMGROUP) are packed with the gem group in the
+# bits above the packed sequence. Gem group 0 stands for a barcode without a suffix.
+PACKED_GEM_GROUP_SHIFT = 48
+MAX_PACKED_GEM_GROUP = (1 << (64 - PACKED_GEM_GROUP_SHIFT)) - 1
+MAX_PACKED_GEM_GROUP_DIGITS = len(str(MAX_PACKED_GEM_GROUP))
+MAX_PACKED_GEM_GROUP_BARCODE_LEN = (PACKED_GEM_GROUP_SHIFT - 1) // 2
+_PACKED_SEQ_MASK = np.uint64((1 << PACKED_GEM_GROUP_SHIFT) - 1)
+
+
+def pack_gem_group_barcodes(barcodes):
+    """ Pack barcodes, optionally with a gem group suffix, into uint64 keys, vectorized.
+    Barcodes that can't be unpacked back to the same string (e.g. a gem group with a
+    leading zero, or a sequence longer than MAX_PACKED_GEM_GROUP_BARCODE_LEN) get the key 0.
+
+    Args:
+      barcodes (iterable of str): Barcodes as formatted by format_barcode_seq.
+    Returns:
+      np.array(uint64): One key per barcode.
+    """
+    barcodes = np.asarray(barcodes, dtype='S')
+    if barcodes.size == 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    chars, lengths = _barcode_chars(barcodes)
+    rows = np.arange(len(chars))
+    is_dash = chars == ord('-')
+    has_gem_group = is_dash.any(axis=1)
+    seq_lengths = np.where(has_gem_group, is_dash.argmax(axis=1), lengths)
+
+    # Gem group digits follow the dash, without a leading zero
+    gem_group_lengths = np.where(has_gem_group, lengths - seq_lengths - 1, 0)
+    valid = (seq_lengths <= MAX_PACKED_GEM_GROUP_BARCODE_LEN) & \
+            (gem_group_lengths <= MAX_PACKED_GEM_GROUP_DIGITS) & \
+            (~has_gem_group | (gem_group_lengths > 0))
+    gem_groups = np.zeros(len(chars), dtype=np.uint64)
+    for digit in xrange(MAX_PACKED_GEM_GROUP_DIGITS):
+        in_gem_group = digit < gem_group_lengths
+        values = chars[rows, np.minimum(seq_lengths + 1 + digit, chars.shape[1] - 1)].astype(np.int64) - ord('0')
+        valid &= ~in_gem_group | ((values >= (1 if digit == 0 else 0)) & (values <= 9))
+        gem_groups = np.where(in_gem_group, gem_groups * np.uint64(10) + np.maximum(values, 0).astype(np.uint64),
+                              gem_groups)
+    valid &= gem_groups <= MAX_PACKED_GEM_GROUP
+
+    keys = _pack_chars(chars, seq_lengths)
+    valid &= keys != 0
+    keys |= gem_groups << np.uint64(PACKED_GEM_GROUP_SHIFT)
+    keys[~valid] = 0
+    return keys
+
+
+def unpack_gem_group_barcodes(keys):
+    """ Unpack keys produced by pack_gem_group_barcodes into barcodes.
+
+    Args:
+      keys (np.array(uint64)): Valid (nonzero) keys.
+    Returns:
+      np.array(str): One barcode per key.
+    """
+    keys = np.asarray(keys, dtype=np.uint64)
+    if keys.size == 0:
+        return np.zeros(0, dtype='S1')
+
+    seq_chars, seq_lengths = _unpack_chars(keys & _PACKED_SEQ_MASK)
+    gem_groups = get_packed_gem_groups(keys)
+    num_digits = np.zeros(len(keys), dtype=np.int64)
+    for digit in xrange(MAX_PACKED_GEM_GROUP_DIGITS):
+        num_digits += gem_groups >= 10 ** digit
+
+    rows = np.arange(len(keys))
+    chars = np.zeros((len(keys), seq_chars.shape[1] + 1 + int(num_digits.max())), dtype=np.uint8)
+    chars[:, 0:seq_chars.shape[1]] = seq_chars
+    has_gem_group = np.flatnonzero(num_digits)
+    chars[has_gem_group, seq_lengths[has_gem_group]] = ord('-')
+    for digit in xrange(int(num_digits.max())):
+        in_gem_group = np.flatnonzero(digit < num_digits)
+        place = 10 ** (num_digits[in_gem_group] - 1 - digit)
+        chars[rows[in_gem_group], seq_lengths[in_gem_group] + 1 + digit] = \
+            ord('0') + (gem_groups[in_gem_group] // place) % 10
+
+    return np.ascontiguousarray(chars).view('S%d' % chars.shape[1]).ravel()
+
+
+def get_packed_gem_groups(keys):
+    """ Gem group of each key produced by pack_gem_group_barcodes, 0 where there's none """
+    return (np.asarray(keys, dtype=np.uint64) >> np.uint64(PACKED_GEM_GROUP_SHIFT)).astype(np.int64)
+
+
+class BarcodeWhitelistIndex(object):
+    """ Barcode whitelist stored as sorted 2-bit packed keys.
+    Supports vectorized lookups of barcodes to their whitelist indices and, where the
+    whitelist has a translation (e.g. feature barcoding), translation of barcodes.
+    The arrays are typically memory-mapped from an index directory so that processes
+    reading the same whitelist share its pages. """
+
+    def __init__(self, keys, indices, keys_by_index, translate_keys=None):
+        """
+        Args:
+          keys (np.array(uint64)): Sorted packed barcodes.
+          indices (np.array(uint32)): Whitelist index of each sorted key.
+          keys_by_index (np.array(uint64)): Packed barcodes in whitelist order.
+          translate_keys (np.array(uint64)): Packed translated barcode of each sorted key,
+                                             0 where there is no translation. May be None.
+        """
+        self.keys = keys
+        self.indices = indices
+        self.keys_by_index = keys_by_index
+        self.translate_keys = translate_keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, barcode):
+        return self.get_index(barcode) is not None
+
+    @staticmethod
+    def build(barcodes, translate_map=None):
+        """ Build an index from whitelist sequences.
+        Args:
+          barcodes (list of str): Whitelist sequences in whitelist order.
+          translate_map (dict of str:str): Optional barcode translation.
+        Returns:
+          BarcodeWhitelistIndex
+        """
+        keys_by_index = pack_barcodes(barcodes)
+        if len(keys_by_index) > 0 and not np.all(keys_by_index):
+            bad = np.flatnonzero(keys_by_index == 0)[0]
+            raise ValueError('Barcode whitelist entry cannot be indexed: %s' % barcodes[bad])
+
+        order = np.argsort(keys_by_index, kind='mergesort')
+        keys = keys_by_index[order]
+        if np.any(keys[1:] == keys[:-1]):
+            raise Exception('Duplicates found in barcode whitelist')
+
+        translate_keys = None
+        if translate_map is not None:
+            sorted_barcodes = [barcodes[i] for i in order]
+            translate_keys = pack_barcodes([translate_map.get(bc, '') for bc in sorted_barcodes])
+
+        return BarcodeWhitelistIndex(keys, order.astype(np.uint32), keys_by_index, translate_keys)
+
+    def save(self, dirname, replace=False):
+        """ Write the index arrays as .npy files into a new directory.
+        The directory is populated under a temporary name and renamed into place,
+        so concurrent readers never see a partial index. With replace, an existing
+        index is moved aside first; processes that have it open keep reading its files. """
+        parent_dirname = os.path.dirname(os.path.abspath(dirname))
+        tmp_dirname = tempfile.mkdtemp(prefix='.tmp_', dir=parent_dirname)
+        old_dirname = None
+        try:
+            # mkdtemp creates the directory private to this user
+            os.chmod(tmp_dirname, 0755)
+            for name in BARCODE_INDEX_ARRAYS:
+                array = getattr(self, name)
+                if array is not None:
+                    np.save(os.path.join(tmp_dirname, name + '.npy'), array)
+            if replace and os.path.isdir(dirname):
+                old_dirname = tempfile.mkdtemp(prefix='.old_', dir=parent_dirname)
+                os.rename(dirname, os.path.join(old_dirname, os.path.basename(dirname)))
+            os.rename(tmp_dirname, dirname)
+        except OSError:
+            # Another process may have won the race to write the index
+            shutil.rmtree(tmp_dirname, ignore_errors=True)
+            if not os.path.isdir(dirname):
+                raise
+        finally:
+            if old_dirname is not None:
+                shutil.rmtree(old_dirname, ignore_errors=True)
+
+    @staticmethod
+    def load(dirname, mmap_mode='r'):
+        """ Open an index directory written by save(). """
+        arrays = {}
+        for name in BARCODE_INDEX_ARRAYS:
+            path = os.path.join(dirname, name + '.npy')
+            arrays[name] = np.load(path, mmap_mode=mmap_mode) if os.path.exists(path) else None
+        return BarcodeWhitelistIndex(**arrays)
+
+    def _find(self, barcodes):
+        """ Returns the sorted position of each barcode and whether it was found """
+        query = pack_barcodes(barcodes)
+        if len(self.keys) == 0:
+            return np.zeros(len(query), dtype=np.intp), np.zeros(len(query), dtype=bool)
+        pos = np.minimum(np.searchsorted(self.keys, query), len(self.keys) - 1)
+        found = (self.keys[pos] == query) & (query != 0)
+        return pos, found
+
+    def get_indices(self, barcodes):
+        """ Look up whitelist indices of barcodes.
+        Args:
+          barcodes (iterable of str): Barcode sequences.
+        Returns:
+          np.array(int64): Whitelist index of each barcode, -1 if not on the whitelist.
+        """
+        pos, found = self._find(barcodes)
+        return np.where(found, self.indices[pos], -1).astype(np.int64)
+
+    def get_index(self, barcode):
+        """ Returns the whitelist index of a single barcode, or None.
+        Avoids the per-call overhead of the vectorized path for scalar lookups. """
+        key = pack_barcode(barcode)
+        if key == 0 or len(self.keys) == 0:
+            return None
+        pos = int(np.searchsorted(self.keys, np.uint64(key)))
+        if pos < len(self.keys) and self.keys[pos] == key:
+            return int(self.indices[pos])
+        return None
+
+    def contains(self, barcodes):
+        """ Returns a boolean array, True where the barcode is on the whitelist """
+        return self._find(barcodes)[1]
+
+    def get_barcodes(self, indices=None):
+        """ Returns whitelist sequences (all of them by default) in whitelist order """
+        keys = self.keys_by_index if indices is None else self.keys_by_index[indices]
+        return unpack_barcodes(keys)
+
+    def has_translation(self):
+        return self.translate_keys is not None
+
+    def translate(self, barcodes):
+        """ Translate barcodes using the whitelist translation.
+        Barcodes without a translation are returned unchanged.
+        Args:
+          barcodes (list of str): Barcode sequences.
+        Returns:
+          list of str: Translated sequences.
+        """
+        barcodes = list(barcodes)
+        if self.translate_keys is None or len(barcodes) == 0:
+            return barcodes
+        pos, found = self._find(barcodes)
+        translated_keys = np.where(found, self.translate_keys[pos], 0)
+        has_translation = np.flatnonzero(translated_keys)
+        for i, bc in itertools.izip(has_translation, unpack_barcodes(translated_keys[has_translation])):
+            barcodes[i] = bc
+        return barcodes
+
+
+def get_barcode_whitelist_index_path(path, translate_path=None):
+    """ Path of the index directory for a whitelist file, with or without its translation """
+    for extension in ['.txt.gz', '.txt', '.gz']:
+        if path.endswith(extension):
+            path = path[:-len(extension)]
+            break
+    if translate_path is not None:
+        path += '.translate'
+    return path + '.index'
+
+
+def _get_barcode_whitelist_index_sources(filename):
+    """ Whitelist path, translation path (or None) and index path for a whitelist name or path """
+    path = get_barcode_whitelist_path(filename)
+    if path is None:
+        return None, None, None
+
+    if not os.path.isfile(path):
+        raise NameError('Unable to find barcode whitelist: %s' % path)
+
+    translate_path = get_barcode_translate_path(filename)
+    return path, translate_path, get_barcode_whitelist_index_path(path, translate_path)
+
+
+def _is_barcode_whitelist_index_current(index_path, sources):
+    if not os.path.isdir(index_path):
+        return False
+    source_mtime = max(os.path.getmtime(p) for p in sources if p is not None)
+    return os.path.getmtime(index_path) >= source_mtime
+
+
+def get_barcode_whitelist_index_cache_dir():
+    """ Directory where pipeline runs cache the indices of whitelists without an installed index """
+    cache_dir = os.environ.get(BARCODE_INDEX_CACHE_ENV)
+    if not cache_dir:
+        cache_dir = os.path.join(tempfile.gettempdir(), 'cellranger-barcode-indices-%d' % os.getuid())
+    return cache_dir
+
+
+def _get_cached_barcode_whitelist_index_path(path, translate_path):
+    """ Cache path of the index of a whitelist. The name includes a digest of the
+    location, size and mtime of the whitelist and its translation, so an index
+    is never reused once either file changes. """
+    digest = hashlib.sha1()
+    for source in [path, translate_path]:
+        if source is not None:
+            stat = os.stat(source)
+            digest.update('%s\t%d\t%r\n' % (os.path.realpath(source), stat.st_size, stat.st_mtime))
+    index_path = get_barcode_whitelist_index_path(os.path.basename(path), translate_path)
+    return os.path.join(get_barcode_whitelist_index_cache_dir(),
+                        '%s-%s.index' % (index_path[:-len('.index')], digest.hexdigest()[:16]))
+
+
+def _find_barcode_whitelist_index(path, translate_path, index_path):
+    """ Path of an up-to-date index of a whitelist, installed or cached, or None """
+    if _is_barcode_whitelist_index_current(index_path, [path, translate_path]):
+        return index_path
+    cached_index_path = _get_cached_barcode_whitelist_index_path(path, translate_path)
+    if os.path.isdir(cached_index_path):
+        return cached_index_path
+    return None
+
+
+def load_barcode_whitelist_index(filename):
+    """ Load a barcode whitelist as a BarcodeWhitelistIndex.
+    An index installed next to the whitelist by build_barcode_whitelist_index is
+    memory-mapped if it is at least as new as the whitelist. Otherwise the index is
+    built by the first process that needs it into the cache directory, and
+    memory-mapped from there by later processes. If the cache can't be written,
+    the index is built in memory.
+
+    Args:
+      filename (str): Whitelist name or path, as for load_barcode_whitelist.
+    Returns:
+      BarcodeWhitelistIndex, or None if there is no whitelist.
+    """
+    path, translate_path, index_path = _get_barcode_whitelist_index_sources(filename)
+    if path is None:
+        return None
+
+    found_index_path = _find_barcode_whitelist_index(path, translate_path, index_path)
+    if found_index_path is not None:
+        return BarcodeWhitelistIndex.load(found_index_path)
+
+    index = BarcodeWhitelistIndex.build(load_barcode_tsv(path), load_barcode_translate_map(filename))
+    cached_index_path = _get_cached_barcode_whitelist_index_path(path, translate_path)
+    try:
+        cr_io.makedirs(os.path.dirname(cached_index_path), allow_existing=True)
+        index.save(cached_index_path)
+    except (IOError, OSError):
+        return index
+    return BarcodeWhitelistIndex.load(cached_index_path)
+
+
+def build_barcode_whitelist_index(filename):
+    """ Write the index of a whitelist next to it, for load_barcode_whitelist_index.
+    Run when installing whitelists, so that pipeline runs don't need to build the
+    index into their cache. An index older than the whitelist is replaced.
+
+    Args:
+      filename (str): Whitelist name or path, as for load_barcode_whitelist.
+    Returns:
+      str: Path of the index directory.
+    """
+    path, translate_path, index_path = _get_barcode_whitelist_index_sources(filename)
+    if not _is_barcode_whitelist_index_current(index_path, [path, translate_path]):
+        index = BarcodeWhitelistIndex.build(load_barcode_tsv(path), load_barcode_translate_map(filename))
+        index.save(index_path, replace=True)
+    return index_path
+
+
+def get_barcode_whitelist_size(filename):
+    """ Number of barcodes on a whitelist, or None if there is no whitelist.
+    Read from an existing index, without building one. """
+    path, translate_path, index_path = _get_barcode_whitelist_index_sources(filename)
+    if path is None:
+        return None
+
+    found_index_path = _find_barcode_whitelist_index(path, translate_path, index_path)
+    if found_index_path is not None:
+        return len(BarcodeWhitelistIndex.load(found_index_path))
+    return sum(1 for line in cr_io.open_maybe_gzip(path, 'r') if '#' not in line)
+
+
 def load_barcode_summary(barcode_summary):
     if barcode_summary:
         with h5py.File(barcode_summary) as f:
@@ -601,23 +1126,23 @@ def get_mem_gb_request_from_genome_fasta(reference_path):
 
 
 def get_mem_gb_request_from_barcode_whitelist(barcode_whitelist_fn, gem_groups=None, use_min=True, double=False):
-    barcode_whitelist = load_barcode_whitelist(barcode_whitelist_fn)
+    whitelist_size = get_barcode_whitelist_size(barcode_whitelist_fn)
 
     if use_min:
-        if barcode_whitelist is None:
+        if whitelist_size is None:
             min_mem_gb = h5_constants.MIN_MEM_GB_NOWHITELIST
         else:
             min_mem_gb = h5_constants.MIN_MEM_GB
     else:
         min_mem_gb = 0
 
-    if barcode_whitelist is None:
+    if whitelist_size is None:
         return min_mem_gb
 
     if gem_groups is not None:
-        num_bcs = len(barcode_whitelist)*max(gem_groups)
+        num_bcs = whitelist_size*max(gem_groups)
     else:
-        num_bcs = len(barcode_whitelist)
+        num_bcs = whitelist_size
 
     if double:
         return np.ceil(max(min_mem_gb, 2 * num_bcs / cr_constants.NUM_BARCODES_PER_MEM_GB))
@@ -4,7 +4,6 @@
 #
 import cPickle
 from collections import defaultdict
-from itertools import izip
 import sys
 
 import martian
@@ -39,12 +38,15 @@ stage CORRECT_CHEMISTRY_BATCH(
     in  pickle idx_to_batch_id,
     in  bool   need_reorder_barcode,
     in  pickle barcode_reorder_index,
-    out binary batch_nearest_neighbor,
+    out h5     batch_nearest_neighbor,
 )
 """
 
 NUM_ENTRIES_PER_MEM_GB = 2000000
-JOIN_MEM_GB = 64
+# int32 neighbor index stored per kNN pair
+NN_BYTES_PER_PAIR = 4
+# kNN pair in join: its int32 index, two int64 pair keys and their sorted copies
+JOIN_BYTES_PER_PAIR = 36
 
 def option(arg, default):
     return arg if arg is not None else default
@@ -110,10 +112,14 @@ def split(args):
     nbatch = len(batch_to_bc_indices)
     cbc_knn = option(args.cbc_knn, analysis_constants.CBC_KNN)
     matrix_mem_gb = sys.getsizeof(dimred_matrix) / 1e9 # float(nitem * ndim) / NUM_ENTRIES_PER_MEM_GB
-    # 72 for size of tuple, 32 * 2 for size of 2 np.int64's, and 40% for inefficient dictionaries
-    nn_mem_gb = 1.4 * nbatch * nitem * cbc_knn * (72 + 2 * 32) / 1e9
+    # each barcode has cbc_knn neighbors in each other batch
+    nn_pairs = nitem * cbc_knn * max(nbatch - 1, 1)
+    nn_mem_gb = nn_pairs * NN_BYTES_PER_PAIR / 1e9
     # presuming all in one batch, dimred_matrix, cur_matrix, ref_matrix
-    main_mem_gb = max(int(3.0 * matrix_mem_gb + nn_mem_gb + 1.0), h5_constants.MIN_MEM_GB)
+    main_mem_gb = max(int(np.ceil(3.0 * matrix_mem_gb + nn_mem_gb + 1.0)), h5_constants.MIN_MEM_GB)
+    # dimred_matrix, aligned matrix and correction vectors, plus the kNN pairs of all batches
+    join_mem_gb = max(int(np.ceil(3.0 * matrix_mem_gb + nn_pairs * JOIN_BYTES_PER_PAIR / 1e9 + 1.0)),
+                      h5_constants.MIN_MEM_GB)
 
     chunks = []
     for batch_id in xrange(len(batch_to_bc_indices)):
@@ -129,7 +135,7 @@ def split(args):
 
     return {
         'chunks': chunks,
-        'join': {'__mem_gb': JOIN_MEM_GB}
+        'join': {'__mem_gb': join_mem_gb}
     }
 
 def main(args, outs):
@@ -147,32 +153,25 @@ def main(args, outs):
     batch_end_idx = batch_to_bc_indices[args.batch_id][1]
     cur_matrix = dimred_matrix[batch_start_idx:batch_end_idx,:]
 
-    # nearest neighbor pair: stores the nearest neighbors from match_i to match_j
-    # key = (batch_i, batch_j), values = set((idx_i, idx_j), ...), the index here is the global index
-    batch_nearest_neighbor = defaultdict(set)
+    # nearest neighbors of each barcode of this batch in each other batch
+    # key = batch_j, value = int32 array of global indices (in dimred_matrix), one row per barcode
+    batch_nearest_neighbor = {}
 
-    from_idx, to_idx = None, None
     # Batch balanced KNN
     for batch in xrange(len(args.batch_to_bc_indices)):
         if batch == args.batch_id:
             continue
 
         ref_matrix = dimred_matrix[batch_to_bc_indices[batch][0]:batch_to_bc_indices[batch][1],]
-        nn_idx_right = cr_batch_correction.find_knn(cur_matrix, ref_matrix, cbc_knn)
+        nn_idx = cr_batch_correction.find_knn(cur_matrix, ref_matrix, cbc_knn)
 
-        # convert index (in cur_matrix and ref_matrix) to global index (in dimred_matrix)
-        nn_idx_left = np.repeat(np.arange(cur_matrix.shape[0]) + batch_start_idx, cbc_knn)
-        nn_idx_right += batch_to_bc_indices[batch][0]
+        # convert index (in ref_matrix) to global index (in dimred_matrix)
+        nn_idx = nn_idx.reshape(cur_matrix.shape[0], -1) + batch_to_bc_indices[batch][0]
+        batch_nearest_neighbor[batch] = nn_idx.astype(np.int32)
 
-        from_idx = nn_idx_left if from_idx is None else np.concatenate([from_idx, nn_idx_left])
-        to_idx = nn_idx_right if to_idx is None else np.concatenate([to_idx, nn_idx_right])
-
-        for i, j in izip(from_idx, to_idx):
-            batch_nearest_neighbor[(args.batch_id, batch)].add((i,j))
-
-    outs.batch_nearest_neighbor = martian.make_path('batch_nearest_neighbor.binary')
-    with open(outs.batch_nearest_neighbor, 'wb') as fp:
-        cr_batch_correction.serialize_batch_nearest_neighbor(fp, batch_nearest_neighbor)
+    outs.batch_nearest_neighbor = martian.make_path('batch_nearest_neighbor.h5')
+    cr_batch_correction.save_batch_nearest_neighbor(outs.batch_nearest_neighbor, args.batch_id,
+                                                    batch_start_idx, batch_nearest_neighbor)
 
     return
 
@@ -196,12 +195,13 @@ def join(args, outs, chunk_defs, chunk_outs):
     # batch score before correction
     outs.batch_score_before_correction = cr_batch_correction.batch_effect_score(dimred_matrix, idx_to_batch_id)
 
+    # key = (batch_i, batch_j), value = neighbors in batch_j of each barcode of batch_i
     nn_pairs = {}
     for chunk_out in chunk_outs:
-        with open(chunk_out.batch_nearest_neighbor, 'rb') as fp:
-            batch_nearest_neighbor = cr_batch_correction.deserialize_batch_nearest_neighbor(fp)
+        batch_id, _, batch_nearest_neighbor = \
+            cr_batch_correction.load_batch_nearest_neighbor(chunk_out.batch_nearest_neighbor)
         for k,v in batch_nearest_neighbor.iteritems():
-            nn_pairs[k] = v
+            nn_pairs[(batch_id, k)] = v
 
     mutual_nn = {} # mnn between batches
     overlap_percentage = {} # percentage of matching cells (max of batch i and batch j)
@@ -215,14 +215,14 @@ def join(args, outs, chunk_defs, chunk_outs):
             if (i,j) not in nn_pairs or (j,i) not in nn_pairs:
                 continue
 
-            nn_ij = nn_pairs[(i,j)]
-            nn_ji = set([(y,x) for x,y in nn_pairs[(j,i)]])
-            mutual_nn[(i,j)] = nn_ij & nn_ji
+            mutual_nn[(i,j)] = cr_batch_correction.find_mutual_nearest_neighbor(
+                nn_pairs[(i,j)], batch_to_bc_indices[i][0], nn_pairs[(j,i)], batch_to_bc_indices[j][0])
+            mnn_i, mnn_j = mutual_nn[(i,j)]
 
             batch_j_size = batch_to_bc_indices[j][1] - batch_to_bc_indices[j][0]
             overlap_percentage[(i,j)] = max(
-                float(len(set([idx for idx, _ in mutual_nn[(i,j)]]))) / batch_i_size,
-                float(len(set([idx for _, idx in mutual_nn[(i,j)]]))) / batch_j_size
+                float(len(np.unique(mnn_i))) / batch_i_size,
+                float(len(np.unique(mnn_j))) / batch_j_size
             )
 
     cbc_alpha = option(args.cbc_alpha, analysis_constants.CBC_ALPHA)
@@ -278,16 +278,20 @@ def join(args, outs, chunk_defs, chunk_outs):
         cur_submatrix_idx = np.concatenate([np.arange(batch_to_bc_indices[b][0], batch_to_bc_indices[b][1])
                                             for b in batches_in_panorama_j])
 
-        matches = []
+        mnn_cur_idx, mnn_ref_idx = [], []
         for ref in panoramas[panorama_idx_i]:
             for cur in panoramas[panorama_idx_j]:
                 if ref < cur and (ref, cur) in mutual_nn:
-                    matches.extend([(c,r) for r,c in mutual_nn[(ref, cur)]])
-                if ref > cur and (cur, ref) in mutual_nn:
-                    matches.extend(mutual_nn[(cur, ref)])
-
-        mnn_cur_idx = [a for a, _ in matches]
-        mnn_ref_idx = [b for _, b in matches]
+                    mnn_ref, mnn_cur = mutual_nn[(ref, cur)]
+                elif ref > cur and (cur, ref) in mutual_nn:
+                    mnn_cur, mnn_ref = mutual_nn[(cur, ref)]
+                else:
+                    continue
+                mnn_cur_idx.append(mnn_cur)
+                mnn_ref_idx.append(mnn_ref)
+
+        mnn_cur_idx = np.concatenate(mnn_cur_idx)
+        mnn_ref_idx = np.concatenate(mnn_ref_idx)
 
         corr_vector = cr_batch_correction.correction_vector(aligned_dimred_matrix, cur_submatrix_idx,
                                                             mnn_cur_idx, mnn_ref_idx, cbc_sigma)
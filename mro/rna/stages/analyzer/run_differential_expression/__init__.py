@@ -3,6 +3,7 @@
 # Copyright (c) 2017 10X Genomics, Inc. All rights reserved.
 #
 
+import martian
 import cellranger.analysis.diffexp as cr_diffexp
 import cellranger.analysis.io as analysis_io
 from cellranger.analysis.singlegenome import SingleGenomeAnalysis
@@ -13,7 +14,6 @@ import cellranger.io as cr_io
 import cellranger.rna.library as rna_library
 
 NUM_THREADS_MIN = 4
-#TODO Not clear why this stage takes > 1 thread. Martian thinks it does and kills it on long jobs
 
 __MRO__ = """
 stage RUN_DIFFERENTIAL_EXPRESSION(
@@ -57,16 +57,19 @@ def main(args, outs):
     if args.skip:
         return
 
-    matrix = cr_matrix.CountMatrix.load_h5_file(args.matrix_h5)
+    matrix = cr_matrix.CountMatrix.load_h5_file_lazy(args.matrix_h5)
 
     # For now, only compute for gene expression features
     if args.is_antibody_only:
         matrix = matrix.select_features_by_type(rna_library.ANTIBODY_LIBRARY_TYPE)
     else:
         matrix = matrix.select_features_by_type(rna_library.GENE_EXPRESSION_LIBRARY_TYPE)
+    matrix = matrix.load()
     clustering = SingleGenomeAnalysis.load_clustering_from_h5(args.clustering_h5, args.clustering_key)
 
-    diffexp = cr_diffexp.run_differential_expression(matrix, clustering.clusters)
+    # Clusters are spread over a process pool with one process per thread of the chunk
+    diffexp = cr_diffexp.run_differential_expression(matrix, clustering.clusters,
+                                                     num_procs=martian.get_threads_allocation())
 
     with analysis_io.open_h5_for_writing(outs.diffexp_h5) as f:
         cr_diffexp.save_differential_expression_h5(f, args.clustering_key, diffexp)
@@ -61,11 +61,12 @@ def join(args, outs, chunk_defs, chunk_outs):
         gg_id_to_batch_id[lib['gem_group']] = lib['batch_id']
         batch_id_to_name[lib['batch_id']] = lib['batch_name']
 
-    matrix = cr_matrix.CountMatrix.load_h5_file(args.matrix_h5)
+    matrix = cr_matrix.CountMatrix.load_h5_file_lazy(args.matrix_h5)
     if args.is_antibody_only:
         matrix = matrix.select_features_by_type(rna_library.ANTIBODY_LIBRARY_TYPE)
     else:
         matrix = matrix.select_features_by_type(rna_library.GENE_EXPRESSION_LIBRARY_TYPE)
+    matrix = matrix.load()
 
     batch_ids = np.array([gg_id_to_batch_id[cr_util.split_barcode_seq(bc)[1]] for bc in matrix.bcs])
 
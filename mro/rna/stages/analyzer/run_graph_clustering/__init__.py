@@ -7,10 +7,10 @@ import numpy as np
 import sys
 import cellranger.analysis.clustering as cr_clustering
 import cellranger.analysis.graphclust as cr_graphclust
+import cellranger.analysis.neighbors as cr_neighbors
 import cellranger.analysis.io as analysis_io
 from cellranger.analysis.singlegenome import SingleGenomeAnalysis
 import cellranger.h5_constants as h5_constants
-import cellranger.analysis.constants as analysis_constants
 from cellranger.logperf import LogPerf
 import cellranger.io as cr_io
 
@@ -25,6 +25,7 @@ stage RUN_GRAPH_CLUSTERING(
     in  int    input_pcs           "Use top N PCs",
     in  int    balltree_leaf_size,
     in  string similarity_type     "Type of similarity to use (nn or snn)",
+    in  h5     knn_graph_h5        "Precomputed kNN graph of all barcodes on all PCs",
     in  bool   skip,
     out h5     chunked_neighbors,
     out h5     clusters_h5,
@@ -56,6 +57,22 @@ SNN_SIMILARITY = 'snn'
 
 SIMILARITY_TYPES = [NN_SIMILARITY, SNN_SIMILARITY]
 
+def use_knn_graph(args):
+    """ The precomputed kNN graph covers all barcodes and PCs, so it can only replace
+    the neighbor search when neither is subselected. """
+    return args.knn_graph_h5 is not None and args.num_bcs is None and args.input_pcs is None
+
+def get_join_resources(similarity_type, num_neighbors, num_bcs):
+    if similarity_type == SNN_SIMILARITY:
+        join_mem_gb = 64
+        join_threads = 4 # Overallocate
+    else:
+        # Scale memory with size of nearest-neighbor adjacency matrix
+        join_mem_gb = max(h5_constants.MIN_MEM_GB, int(np.ceil((num_neighbors * num_bcs) / NN_ENTRIES_PER_MEM_GB)))
+        # HACK: use more threads for bigger mem requests to avoid mem oversubscription on clusters that don't enforce it
+        join_threads = cr_io.get_thread_request_from_mem_gb(join_mem_gb)
+    return join_mem_gb, join_threads
+
 # TODO: Martian needs to provide a way to give split more memory.
 # Workaround is mrp --overrides
 def split(args):
@@ -67,6 +84,18 @@ def split(args):
     if args.similarity_type not in SIMILARITY_TYPES:
         martian.exit("Unsupported similarity type: %s. Must be one of: %s" % (args.similarity_type, ','.join(SIMILARITY_TYPES)))
 
+    if use_knn_graph(args):
+        # The neighbors are already known; build the graph and cluster in the join
+        (num_bcs, _) = cr_neighbors.get_knn_graph_dims(args.knn_graph_h5)
+        num_neighbors = cr_graphclust.get_num_neighbors(num_bcs, args.num_neighbors, args.neighbor_a, args.neighbor_b)
+        join_mem_gb, join_threads = get_join_resources(args.similarity_type, num_neighbors, num_bcs)
+        return {
+            'chunks': [],
+            'join': {
+                '__mem_gb': join_mem_gb,
+                '__threads': join_threads,
+            }}
+
     with LogPerf('load'):
         pca_mat = SingleGenomeAnalysis.load_pca_from_h5(args.pca_h5).transformed_pca_matrix
 
@@ -94,15 +123,7 @@ def split(args):
         cr_graphclust.save_neighbor_index(balltree, neighbor_index)
 
     # Compute the actual number of nearest neighbors we'll use
-    given_num_neighbors = args.num_neighbors if args.num_neighbors is not None else analysis_constants.GRAPHCLUST_NEIGHBORS_DEFAULT
-    given_neighbor_a = args.neighbor_a if args.neighbor_a is not None else analysis_constants.GRAPHCLUST_NEIGHBOR_A_DEFAULT
-    given_neighbor_b = args.neighbor_b if args.neighbor_b is not None else analysis_constants.GRAPHCLUST_NEIGHBOR_B_DEFAULT
-
-    # Take max of {num_neighbors, a + b*log10(n)}
-    use_neighbors = int(max(given_num_neighbors, np.round(given_neighbor_a + given_neighbor_b * np.log10(len(use_bcs)))))
-
-    # Clamp to [1, n - 1]
-    num_neighbors = max(1, min(use_neighbors, len(use_bcs)-1))
+    num_neighbors = cr_graphclust.get_num_neighbors(len(use_bcs), args.num_neighbors, args.neighbor_a, args.neighbor_b)
     print "Using %d neighbors" % num_neighbors
 
     # Divide the PCA matrix up into rows for NN queries
@@ -124,14 +145,7 @@ def split(args):
                 'use_bcs': use_bcs_path,
             })
 
-    if args.similarity_type == SNN_SIMILARITY:
-        join_mem_gb = 64
-        join_threads = 4 # Overallocate
-    else:
-        # Scale memory with size of nearest-neighbor adjacency matrix
-        join_mem_gb = max(h5_constants.MIN_MEM_GB, int(np.ceil((num_neighbors * len(use_bcs)) / NN_ENTRIES_PER_MEM_GB)))
-        # HACK: use more threads for bigger mem requests to avoid mem oversubscription on clusters that don't enforce it
-        join_threads = cr_io.get_thread_request_from_mem_gb(join_mem_gb)
+    join_mem_gb, join_threads = get_join_resources(args.similarity_type, num_neighbors, len(use_bcs))
 
     return {
         'chunks': chunks,
@@ -160,10 +174,22 @@ def main(args, outs):
 def join(args, outs, chunk_defs, chunk_outs):
     if args.skip:
         return
-    # Merge the neighbor matrices
-    with LogPerf('merge_nn'):
-        nn = cr_graphclust.merge_nearest_neighbors([chunk.chunked_neighbors for chunk in chunk_outs],
-                                                   chunk_defs[0].total_rows)
+    if use_knn_graph(args):
+        (num_bcs, _) = cr_neighbors.get_knn_graph_dims(args.knn_graph_h5)
+        k_nearest = cr_graphclust.get_num_neighbors(num_bcs, args.num_neighbors, args.neighbor_a, args.neighbor_b)
+        print "Using %d neighbors" % k_nearest
+        with LogPerf('load_nn'):
+            nn_idx, _ = cr_neighbors.load_knn_graph(args.knn_graph_h5, k_nearest)
+            nn = cr_neighbors.knn_graph_to_adjacency(nn_idx)
+            del nn_idx
+        use_bcs = np.arange(num_bcs)
+    else:
+        # Merge the neighbor matrices
+        with LogPerf('merge_nn'):
+            nn = cr_graphclust.merge_nearest_neighbors([chunk.chunked_neighbors for chunk in chunk_outs],
+                                                       chunk_defs[0].total_rows)
+        k_nearest = chunk_defs[0].k_nearest
+        use_bcs = cr_graphclust.load_ndarray_h5(chunk_defs[0].use_bcs, 'use_bcs')
     print 'nn\tnn_nodes\t%0.4f' % nn.shape[0]
     print 'nn\tnn_links\t%0.4f' % nn.nnz
     print 'nn\tnn_density\t%0.4f' % cr_graphclust.matrix_density(nn)
@@ -174,25 +200,21 @@ def join(args, outs, chunk_defs, chunk_outs):
     louvain_out = martian.make_path('louvain.out')
 
     if args.similarity_type == 'snn':
-        snn = cr_graphclust.compute_snn_matrix(nn, chunk_defs[0].k_nearest)
+        # The SNN graph is written in row blocks straight to Louvain's binary format
+        with LogPerf('convert'):
+            snn_nnz = cr_graphclust.write_snn_louvain_graph(nn, k_nearest, matrix_bin, matrix_weights)
 
-        print 'snn\tsnn_nodes\t%d' % snn.shape[0]
-        print 'snn\tsnn_links\t%d' % (snn.nnz/2)
-        print 'snn\tsnn_density\t%0.4f' % ((snn.nnz) / float(snn.shape[0]*(snn.shape[0]-1)))
+        print 'snn\tsnn_nodes\t%d' % nn.shape[0]
+        print 'snn\tsnn_links\t%d' % (snn_nnz/2)
+        print 'snn\tsnn_density\t%0.4f' % ((snn_nnz) / float(nn.shape[0]*(nn.shape[0]-1)))
         sys.stdout.flush()
 
-        with LogPerf('convert'):
-            cr_graphclust.pipe_weighted_edgelist_to_convert(snn, matrix_bin, matrix_weights)
-
         with LogPerf('louvain'):
             cr_graphclust.run_louvain_weighted_clustering(matrix_bin, matrix_weights, louvain_out)
 
     else:
-        with LogPerf('tocoo'):
-            nn = nn.tocoo(copy=False)
-
         with LogPerf('convert'):
-            cr_graphclust.pipe_unweighted_edgelist_to_convert(nn, matrix_bin)
+            cr_graphclust.write_unweighted_louvain_graph(nn, matrix_bin)
 
         with LogPerf('louvain'):
             cr_graphclust.run_louvain_unweighted_clustering(matrix_bin, louvain_out)
@@ -200,9 +222,8 @@ def join(args, outs, chunk_defs, chunk_outs):
     with LogPerf('load_bcs'):
         barcodes = SingleGenomeAnalysis.load_bcs_from_matrix_h5(args.matrix_h5)
 
-    use_bcs = cr_graphclust.load_ndarray_h5(chunk_defs[0].use_bcs, 'use_bcs')
-
-    labels = cr_graphclust.load_louvain_results(len(barcodes), use_bcs, louvain_out)
+    with LogPerf('load_louvain'):
+        labels = cr_graphclust.load_louvain_results(len(barcodes), use_bcs, louvain_out)
 
     labels = cr_clustering.relabel_by_size(labels)
 
@@ -3,6 +3,7 @@
 # Copyright (c) 2017 10X Genomics, Inc. All rights reserved.
 #
 
+import martian
 import numpy as np
 import cellranger.analysis.clustering as cr_clustering
 import cellranger.analysis.kmeans as cr_kmeans
@@ -27,11 +28,20 @@ stage RUN_KMEANS(
     src py   "stages/analyzer/run_kmeans",
 ) split using (
     in  int  n_clusters,
+    in  int  max_n_clusters,
+    in  bool use_minibatch,
 )
 """
 
 MEM_FACTOR = 1.1
 
+# Fit all K in a single chunk, warm-starting each K from the previous one,
+# when clustering at least this many barcodes
+SWEEP_MIN_BCS = 100000
+
+# Use mini-batch k-means when clustering at least this many barcodes
+MINIBATCH_MIN_BCS = 500000
+
 def split(args):
     if args.skip:
         return {'chunks': []}
@@ -45,11 +55,22 @@ def split(args):
     max_clusters = min(max_clusters, matrix_dims[1])
 
     matrix_mem_gb = np.ceil(MEM_FACTOR * cr_matrix.CountMatrix.get_mem_gb_from_matrix_h5(args.matrix_h5))
+    chunk_mem_gb = max(matrix_mem_gb, h5_constants.MIN_MEM_GB)
+
+    num_bcs = matrix_dims[1] if args.num_bcs is None else min(args.num_bcs, matrix_dims[1])
+    if num_bcs >= SWEEP_MIN_BCS:
+        return {'chunks': [{
+            'n_clusters': min_clusters,
+            'max_n_clusters': max_clusters,
+            'use_minibatch': num_bcs >= MINIBATCH_MIN_BCS,
+            '__mem_gb': chunk_mem_gb,
+        }]}
 
     for n_clusters in xrange(min_clusters, max_clusters + 1):
-        chunk_mem_gb = max(matrix_mem_gb, h5_constants.MIN_MEM_GB)
         chunks.append({
             'n_clusters': n_clusters,
+            'max_n_clusters': n_clusters,
+            'use_minibatch': False,
             '__mem_gb': chunk_mem_gb,
         })
 
@@ -75,14 +96,37 @@ def main(args, outs):
     if args.num_pcs is not None:
         pca_mat = pca_mat[:,np.arange(args.num_pcs)]
 
-    kmeans = cr_kmeans.run_kmeans(pca_mat, args.n_clusters, random_state=args.random_seed)
+    max_n_clusters = args.max_n_clusters if args.max_n_clusters is not None else args.n_clusters
+
+    if max_n_clusters == args.n_clusters:
+        kmeans = cr_kmeans.run_kmeans(pca_mat, args.n_clusters, random_state=args.random_seed)
+
+        with analysis_io.open_h5_for_writing(outs.kmeans_h5) as f:
+            cr_kmeans.save_kmeans_h5(f, args.n_clusters, kmeans)
+
+        clustering_key = cr_clustering.format_clustering_key(cr_clustering.CLUSTER_TYPE_KMEANS, args.n_clusters)
+
+        cr_clustering.save_clustering_csv(outs.kmeans_csv, clustering_key, kmeans.clusters, matrix.bcs)
+        return
+
+    # Sweep over all K in this chunk
+    kmeans_list = cr_kmeans.run_kmeans_sweep(pca_mat, args.n_clusters, max_n_clusters,
+                                             random_state=args.random_seed,
+                                             use_minibatch=args.use_minibatch)
+
+    kmeans_h5s = []
+    for n_clusters, kmeans in zip(xrange(args.n_clusters, max_n_clusters + 1), kmeans_list):
+        kmeans_h5 = martian.make_path('kmeans_%d.h5' % n_clusters)
+        with analysis_io.open_h5_for_writing(kmeans_h5) as f:
+            cr_kmeans.save_kmeans_h5(f, n_clusters, kmeans)
+        kmeans_h5s.append(kmeans_h5)
 
-    with analysis_io.open_h5_for_writing(outs.kmeans_h5) as f:
-        cr_kmeans.save_kmeans_h5(f, args.n_clusters, kmeans)
+        clustering_key = cr_clustering.format_clustering_key(cr_clustering.CLUSTER_TYPE_KMEANS, n_clusters)
 
-    clustering_key = cr_clustering.format_clustering_key(cr_clustering.CLUSTER_TYPE_KMEANS, args.n_clusters)
+        cr_clustering.save_clustering_csv(outs.kmeans_csv, clustering_key, kmeans.clusters, matrix.bcs)
 
-    cr_clustering.save_clustering_csv(outs.kmeans_csv, clustering_key, kmeans.clusters, matrix.bcs)
+    analysis_io.combine_h5_files(kmeans_h5s, outs.kmeans_h5, [analysis_constants.ANALYSIS_H5_CLUSTERING_GROUP,
+                                                        analysis_constants.ANALYSIS_H5_KMEANS_GROUP])
 
 def join(args, outs, chunk_defs, chunk_outs):
     if args.skip:
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2019 10X Genomics, Inc. All rights reserved.
+#
+import martian
+import numpy as np
+import cellranger.analysis.graphclust as cr_graphclust
+import cellranger.analysis.neighbors as cr_neighbors
+import cellranger.analysis.pca as cr_pca
+import cellranger.analysis.constants as analysis_constants
+import cellranger.h5_constants as h5_constants
+from cellranger.logperf import LogPerf
+
+__MRO__ = """
+stage RUN_KNN_GRAPH(
+    in  h5     pca_h5,
+    in  int    num_neighbors       "Graph clustering: use this many neighbors",
+    in  float  neighbor_a          "Graph clustering: use larger of (a+b*log10(n_cells) neighbors or num_neighbors",
+    in  float  neighbor_b          "Graph clustering: use larger of (a+b*log10(n_cells) neighbors or num_neighbors",
+    in  int    umap_n_neighbors    "UMAP: number of neighbors, if it reads the graph",
+    in  string umap_metric         "UMAP: distance metric; the graph is only used with euclidean",
+    in  bool   approximate         "Allow neighbors slightly farther than the exact ones",
+    in  bool   skip,
+    out h5     knn_graph_h5,
+    src py     "stages/analyzer/run_knn_graph",
+) split using (
+    in  pickle neighbor_index,
+    in  int    row_start,
+    in  int    row_end,
+    in  int    k_nearest,
+    out h5     chunk_knn_graph_h5,
+)
+"""
+
+# 1e6 cells => ~10 chunks
+NN_QUERIES_PER_CHUNK = 100000
+
+NN_QUERY_THREADS = 4
+
+# Index and PCA matrix, relative to the size of the PCA matrix
+NN_CHUNK_MEM_FACTOR = 4
+
+# float64 distance and int64 index returned by the query, plus their narrowed copies
+NN_QUERY_BYTES_PER_NEIGHBOR = 28
+
+def get_num_neighbors(args, num_bcs):
+    """ Largest number of neighbors, excluding the barcode itself, needed by any consumer of the graph """
+    graphclust_neighbors = cr_graphclust.get_num_neighbors(num_bcs, args.num_neighbors,
+                                                           args.neighbor_a, args.neighbor_b)
+    num_neighbors = graphclust_neighbors
+
+    umap_metric = args.umap_metric if args.umap_metric is not None else analysis_constants.UMAP_DEFAULT_METRIC
+    if umap_metric == cr_neighbors.KNN_GRAPH_METRIC:
+        # UMAP counts each barcode as one of its own neighbors
+        umap_n_neighbors = args.umap_n_neighbors if args.umap_n_neighbors is not None else analysis_constants.UMAP_DEFAULT_N_NEIGHBORS
+        num_neighbors = max(num_neighbors, umap_n_neighbors - 1)
+
+    return max(1, min(num_neighbors, num_bcs - 1))
+
+def split(args):
+    if args.skip:
+        return {'chunks': []}
+
+    with LogPerf('load'):
+        pca_mat = cr_pca.load_pca_from_h5(args.pca_h5).transformed_pca_matrix
+
+    with LogPerf('nn_build'):
+        neighbor_index = martian.make_path('neighbor_index.pickle')
+        cr_neighbors.save_neighbor_index(cr_neighbors.build_neighbor_index(pca_mat), neighbor_index)
+
+    num_neighbors = get_num_neighbors(args, pca_mat.shape[0])
+    print "Using %d neighbors" % num_neighbors
+
+    pca_mem_gb = pca_mat.nbytes / 1e9
+    chunks = []
+    for row_start in xrange(0, pca_mat.shape[0], NN_QUERIES_PER_CHUNK):
+        row_end = min(row_start + NN_QUERIES_PER_CHUNK, pca_mat.shape[0])
+        result_mem_gb = (row_end - row_start) * (num_neighbors + 1) * NN_QUERY_BYTES_PER_NEIGHBOR / 1e9
+        chunks.append({
+            'neighbor_index': neighbor_index,
+            'row_start': row_start,
+            'row_end': row_end,
+            'k_nearest': num_neighbors,
+            '__mem_gb': max(h5_constants.MIN_MEM_GB,
+                            int(np.ceil(NN_CHUNK_MEM_FACTOR * pca_mem_gb + result_mem_gb))),
+            '__threads': NN_QUERY_THREADS,
+        })
+
+    return {'chunks': chunks, 'join': {'__mem_gb': h5_constants.MIN_MEM_GB}}
+
+def main(args, outs):
+    if args.skip:
+        return
+
+    with LogPerf('load'):
+        pca_mat = cr_pca.load_pca_from_h5(args.pca_h5).transformed_pca_matrix
+        neighbor_index = cr_neighbors.load_neighbor_index(args.neighbor_index)
+
+    with LogPerf('nn_query'):
+        nn_idx, nn_dist = cr_neighbors.query_knn(neighbor_index, pca_mat[args.row_start:args.row_end, :],
+                                                 args.k_nearest, threads=martian.get_threads_allocation(),
+                                                 approximate=bool(args.approximate))
+        cr_neighbors.save_knn_graph(outs.chunk_knn_graph_h5, nn_idx, nn_dist)
+
+def join(args, outs, chunk_defs, chunk_outs):
+    if args.skip:
+        return
+
+    with LogPerf('merge_nn'):
+        cr_neighbors.create_knn_graph(outs.knn_graph_h5, chunk_defs[-1].row_end, chunk_defs[0].k_nearest)
+        for chunk_def, chunk_out in zip(chunk_defs, chunk_outs):
+            nn_idx, nn_dist = cr_neighbors.load_knn_graph(chunk_out.chunk_knn_graph_h5)
+            cr_neighbors.write_knn_graph_rows(outs.knn_graph_h5, chunk_def.row_start, nn_idx, nn_dist)
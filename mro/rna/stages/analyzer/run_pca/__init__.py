@@ -56,22 +56,24 @@ def main(args, outs):
     if args.skip:
         return
 
-    matrix = cr_matrix.CountMatrix.load_h5_file(args.matrix_h5)
+    matrix = cr_matrix.CountMatrix.load_h5_file_lazy(args.matrix_h5)
     if args.is_antibody_only:
         matrix = matrix.select_features_by_type(rna_library.ANTIBODY_LIBRARY_TYPE)
     else:
         matrix = matrix.select_features_by_type(rna_library.GENE_EXPRESSION_LIBRARY_TYPE)
+    matrix = matrix.load()
 
     try:
         pca = cr_pca.run_pca(matrix, pca_features=args.num_genes, pca_bcs=args.num_bcs,
                              n_pca_components=args.num_pcs, random_state=args.random_seed,
-                             min_count_threshold=cr_pca.DEFAULT_RUNPCA_THRESHOLD)
+                             min_count_threshold=cr_pca.DEFAULT_RUNPCA_THRESHOLD,
+                             threads=martian.get_threads_allocation())
     except (cr_matrix.NullAxisMatrixError, cr_pca.MatrixRankTooSmallException):
         martian.log_warn("insufficient counts for min_count_threshold=2, downgrading to min_count_threshold=0")
         try:
             pca = cr_pca.run_pca(matrix, pca_features=args.num_genes, pca_bcs=args.num_bcs,
                              n_pca_components=args.num_pcs, random_state=args.random_seed,
-                             min_count_threshold=0)
+                             min_count_threshold=0, threads=martian.get_threads_allocation())
         except ValueError as e:
             martian.exit(e)
 
@@ -80,8 +80,8 @@ def main(args, outs):
 
 
     if args.is_antibody_only:
-        matrix = cr_matrix.CountMatrix.load_h5_file(args.matrix_h5)
-        matrix = matrix.select_features_by_type(rna_library.ANTIBODY_LIBRARY_TYPE)
+        matrix = cr_matrix.CountMatrix.load_h5_file_lazy(args.matrix_h5)
+        matrix = matrix.select_features_by_type(rna_library.ANTIBODY_LIBRARY_TYPE).load()
         matrix.m.data = np.log2(1 + matrix.m.data)
         tsne_input = matrix.m.transpose().todense()
 
@@ -106,8 +106,8 @@ def main(args, outs):
     else:
         # Use feature space for other feature types
         # Assumes other feature types are much lower dimension than gene expression
-        matrix = cr_matrix.CountMatrix.load_h5_file(args.matrix_h5)
-        matrix = matrix.select_features_by_type(args.feature_type)
+        matrix = cr_matrix.CountMatrix.load_h5_file_lazy(args.matrix_h5)
+        matrix = matrix.select_features_by_type(args.feature_type).load()
         matrix.m.data = np.log2(1 + matrix.m.data)
         tsne_input = matrix.m.transpose().todense()
 
@@ -7,6 +7,7 @@ import numpy as np
 import tables
 import cellranger.analysis.pca as cr_pca
 import cellranger.analysis.lm_umap as cr_umap
+import cellranger.analysis.neighbors as cr_neighbors
 import cellranger.analysis.io as analysis_io
 import cellranger.h5_constants as h5_constants
 import cellranger.analysis.constants as analysis_constants
@@ -26,6 +27,7 @@ stage RUN_UMAP(
     in  float min_dist,
     in  string metric,
     in  bool  is_antibody_only,
+    in  h5    knn_graph_h5     "Precomputed kNN graph of all barcodes on all PCs, used with the euclidean metric",
     out h5    umap_h5,
     out path  umap_csv,
     src py    "stages/analyzer/run_umap",
@@ -72,14 +74,26 @@ def get_umap_key(feature_type, n_components):
     else:
         return '%s_%d' % (lower_no_space(feature_type), n_components)
 
+def load_pca_knn(args):
+    """ Load the neighbors of the PCA kNN graph if UMAP would find the same ones """
+    metric = args.metric if args.metric is not None else analysis_constants.UMAP_DEFAULT_METRIC
+    if args.knn_graph_h5 is None or args.input_pcs is not None or metric != cr_neighbors.KNN_GRAPH_METRIC:
+        return None
+
+    n_neighbors = args.n_neighbors if args.n_neighbors is not None else analysis_constants.UMAP_DEFAULT_N_NEIGHBORS
+    (_, graph_neighbors) = cr_neighbors.get_knn_graph_dims(args.knn_graph_h5)
+    if graph_neighbors < n_neighbors - 1:
+        return None
+    return cr_neighbors.load_knn_graph(args.knn_graph_h5, n_neighbors - 1)
+
 def main(args, outs):
     if args.skip:
         return
 
     umap_dims = args.umap_dims
     if args.is_antibody_only:
-        matrix = cr_matrix.CountMatrix.load_h5_file(args.matrix_h5)
-        matrix = matrix.select_features_by_type(rna_library.ANTIBODY_LIBRARY_TYPE)
+        matrix = cr_matrix.CountMatrix.load_h5_file_lazy(args.matrix_h5)
+        matrix = matrix.select_features_by_type(rna_library.ANTIBODY_LIBRARY_TYPE).load()
         matrix.m.data = np.log2(1 + matrix.m.data)
         umap_input = matrix.m.transpose().todense()
 
@@ -100,19 +114,22 @@ def main(args, outs):
         # Use PCA for gene expression
         pca = cr_pca.load_pca_from_h5(args.pca_h5)
         umap_input = pca.transformed_pca_matrix
+        knn = load_pca_knn(args)
     else:
         # Use feature space for other feature types
         # Assumes other feature types are much lower dimension than gene expression
-        matrix = cr_matrix.CountMatrix.load_h5_file(args.matrix_h5)
-        matrix = matrix.select_features_by_type(args.feature_type)
+        matrix = cr_matrix.CountMatrix.load_h5_file_lazy(args.matrix_h5)
+        matrix = matrix.select_features_by_type(args.feature_type).load()
         matrix.m.data = np.log2(1 + matrix.m.data)
         umap_input = matrix.m.transpose().todense()
+        knn = None
 
     name = get_umap_name(args.feature_type, args.umap_dims)
     key = get_umap_key(args.feature_type, args.umap_dims)
 
     umap = cr_umap.run_umap(umap_input, name=name, key=key, input_pcs=args.input_pcs, n_neighbors=args.n_neighbors,
-            min_dist=args.min_dist, metric=args.metric, umap_dims=umap_dims, random_state=args.random_seed)
+            min_dist=args.min_dist, metric=args.metric, umap_dims=umap_dims, random_state=args.random_seed,
+            knn=knn)
 
     filters = tables.Filters(complevel=h5_constants.H5_COMPRESSION_LEVEL)
     with tables.open_file(outs.umap_h5, 'w', filters=filters) as f:
@@ -2,12 +2,14 @@
 #
 # Copyright (c) 2015 10X Genomics, Inc. All rights reserved.
 #
-from collections import defaultdict
+from collections import defaultdict, deque
 import itertools
 import json
 import martian
+import multiprocessing
 import numpy as np
 import random
+import time
 import tenkit.constants as tk_constants
 import tenkit.safe_json as tk_safe_json
 import tenkit.seq as tk_seq
@@ -18,8 +20,8 @@ import cellranger.rna.library as rna_library
 import cellranger.report as cr_report
 import cellranger.utils as cr_utils
 from cellranger.fastq import BarcodeCounter, FastqReader, FastqFeatureReader, \
-    ChunkedFastqWriter, AugmentedFastqHeader, get_bamtofastq_defs
-from cellranger.fastq import infer_barcode_reverse_complement
+    ChunkedFastqWriter, AugmentedFastqHeader, get_bamtofastq_defs, get_feature_match_func
+from cellranger.fastq import infer_barcode_reverse_complement, write_barcode_counts_json
 
 
 __MRO__ = """
@@ -65,6 +67,9 @@ stage EXTRACT_READS(
     in  int      gem_group,
     in  string   target_set_name,
     out fastq    read,
+    out npz      chunk_barcode_counts,
+    out int      num_reads,
+    out float    elapsed_sec,
 ) using (
     mem_gb = 2,
 )
@@ -72,6 +77,20 @@ stage EXTRACT_READS(
 
 COMPRESSION = 'lz4'
 
+# Number of reads parsed and processed together
+READ_BLOCK_SIZE = 10000
+
+# Worker processes for header construction and feature barcode extraction
+EXTRACT_READS_THREADS = 4
+
+# Blocks in flight per worker process; bounds memory while keeping workers busy
+BLOCKS_PER_WORKER = 2
+
+EMPTY_READ = (None, '', '')
+
+# Per-process state for process_read_block, set by init_read_block_worker
+_block_ctx = None
+
 
 def validate_concordance(r1, r2, bc, umi, si):
     """ A fastq file is corrupt if the reads in different files (which are supposed to be in order)
@@ -101,10 +120,147 @@ def validate_concordance(r1, r2, bc, umi, si):
                                       " Check the input FASTQ files for corruption.").format(
                     reads[0], read))
 
+def init_read_block_worker(feature_extractor, barcode_rc, paired_end, augment_fastq,
+                           r1_length, r2_length):
+    global _block_ctx
+    feature_match_func = None
+    if feature_extractor.has_features_to_extract():
+        feature_match_func = get_feature_match_func(feature_extractor,
+                                                    feature_extractor.get_read_types(),
+                                                    r1_length, r2_length)
+    _block_ctx = (feature_match_func, barcode_rc, paired_end, augment_fastq)
+
+def make_augmented_header(name, bc_read, si_read, umi_read, feat_raw_bc, feat_qual, feat_proc_bc, feat_ids):
+    fastq_header = AugmentedFastqHeader(name)
+    fastq_header.set_tag(tk_constants.SAMPLE_INDEX_TAG, si_read[1])
+    fastq_header.set_tag(tk_constants.SAMPLE_INDEX_QUAL_TAG, si_read[2])
+    fastq_header.set_tag(cr_constants.RAW_BARCODE_TAG, bc_read[1])
+    fastq_header.set_tag(cr_constants.RAW_BARCODE_QUAL_TAG, bc_read[2])
+    fastq_header.set_tag(cr_constants.RAW_UMI_TAG, umi_read[1])
+    fastq_header.set_tag(cr_constants.UMI_QUAL_TAG, umi_read[2])
+
+    if feat_raw_bc:
+        fastq_header.set_tag(cr_constants.RAW_FEATURE_BARCODE_TAG, feat_raw_bc)
+        fastq_header.set_tag(cr_constants.FEATURE_BARCODE_QUAL_TAG, feat_qual)
+    if feat_ids:
+        fastq_header.set_tag(cr_constants.PROCESSED_FEATURE_BARCODE_TAG, feat_proc_bc)
+        fastq_header.set_tag(cr_constants.FEATURE_IDS_TAG, feat_ids)
+
+    return fastq_header.to_string()
+
+def process_read_block(block):
+    """ Build the output records for a block of read extractions.
+        Args: block - list of (rna, rna2, bc, si, umi, feature pair) extractions
+        Returns: list of (rna_read, rna_read2, bc_read, si_read, umi_read,
+                          read1 record, read2 record, tag record, feature index),
+                 one per read that passes filtering. Records are None if not written.
+                 The feature index is None unless the read hit a single feature. """
+    feature_match_func, barcode_rc, paired_end, augment_fastq = _block_ctx
+
+    results = []
+    for extractions in block:
+        rna_extraction, rna2_extraction, bc_extraction, si_extraction, umi_extraction, feature_pair = extractions
+
+        rna_read = rna_extraction if rna_extraction is not None else EMPTY_READ
+        rna_read2 = rna2_extraction if rna2_extraction is not None else EMPTY_READ
+        bc_read = bc_extraction if bc_extraction is not None else EMPTY_READ
+        si_read = si_extraction if si_extraction is not None else EMPTY_READ
+        umi_read = umi_extraction if umi_extraction is not None else EMPTY_READ
+
+        if (not rna_read[1]) or (paired_end and (not rna_read2[1])):
+            # Read 1 is empty or read 2 is empty (if paired_end)
+            # Empty reads causes issue with STAR aligner, so eliminate
+            # them here
+            continue
+
+        validate_concordance(rna_read, rna_read2, bc_read, si_read, umi_read)
+
+        # Reverse complement the barcode if necessary
+        if bc_read != EMPTY_READ and barcode_rc:
+            bc_read = (bc_read[0], tk_seq.get_rev_comp(bc_read[1]), bc_read[2][::-1])
+
+        feat_raw_bc = None
+        feat_proc_bc = None
+        feat_qual = None
+        feat_ids = None
+        feature_idx = None
+
+        if feature_pair is not None and feature_match_func is not None:
+            feature_extraction = feature_match_func(feature_pair)
+
+            if feature_extraction.barcode:
+                feat_raw_bc = feature_extraction.barcode
+                feat_qual = feature_extraction.qual
+
+            if len(feature_extraction.ids) > 0:
+                feat_proc_bc = feature_extraction.barcode
+                feat_ids = ';'.join(feature_extraction.ids)
+
+                # If hit a single feature ID, count its frequency
+                if len(feature_extraction.ids) == 1:
+                    feature_idx = feature_extraction.indices[0]
+
+        header1 = make_augmented_header(rna_read[0], bc_read, si_read, umi_read,
+                                        feat_raw_bc, feat_qual, feat_proc_bc, feat_ids)
+        if augment_fastq:
+            read1_record = (header1, rna_read[1], rna_read[2])
+            tag_record = None
+        else:
+            read1_record = (rna_read[0], rna_read[1], rna_read[2])
+            tag_record = (header1, '', '')
+
+        read2_record = None
+        if paired_end:
+            if augment_fastq:
+                header2 = make_augmented_header(rna_read2[0], bc_read, si_read, umi_read,
+                                                feat_raw_bc, feat_qual, feat_proc_bc, feat_ids)
+                read2_record = (header2, rna_read2[1], rna_read2[2])
+            else:
+                read2_record = (rna_read2[0], rna_read2[1], rna_read2[2])
+
+        results.append((rna_read, rna_read2, bc_read, si_read, umi_read,
+                        read1_record, read2_record, tag_record, feature_idx))
+    return results
+
+def map_read_blocks(pool, blocks, max_pending):
+    """ Process read blocks in a pool, yielding results in input order.
+        At most max_pending blocks are queued at a time. """
+    if pool is None:
+        for block in blocks:
+            yield process_read_block(block)
+        return
+
+    pending = deque()
+    for block in blocks:
+        pending.append(pool.apply_async(process_read_block, (block,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def iter_sampled_blocks(block_iters, max_reads, subsample_rate, prng):
+    """ Zip blocks of extractions across readers, downsample, and re-block.
+        Args: block_iters - one block iterator per reader; a missing reader yields no blocks
+              max_reads - stop after this many input reads (None for all)
+              subsample_rate - keep each read with this probability
+              prng - random.Random used only for downsampling
+        Yields: (number of input reads consumed, list of extraction tuples) """
+    num_reads = 0
+    for blocks in itertools.izip_longest(*block_iters, fillvalue=[]):
+        extractions = list(itertools.izip_longest(*blocks))
+        if max_reads is not None:
+            extractions = extractions[:max(0, max_reads - num_reads)]
+            if len(extractions) == 0:
+                return
+        num_reads += len(extractions)
+
+        # Downsample
+        yield len(extractions), [x for x in extractions if prng.random() <= subsample_rate]
+
 def split(args):
     chunks = []
     for chunk in args.chunks:
-        chunk['__threads'] = 1
+        chunk['__threads'] = EXTRACT_READS_THREADS
         chunk['__mem_gb'] = 6
 
         if args.initial_reads is None:
@@ -146,12 +302,11 @@ def join(args, outs, chunk_defs, chunk_outs):
     outs.bam_comments = chunk_outs[0].bam_comments
 
     # Write barcode counts (merged by library_type)
-    bc_counters = BarcodeCounter.merge_by([co.barcode_counts for co in chunk_outs],
+    bc_counters = BarcodeCounter.merge_by([co.chunk_barcode_counts for co in chunk_outs],
                                           [cd.library_type for cd in chunk_defs],
                                           args.barcode_whitelist,
                                           outs.gem_groups)
-    with open(outs.barcode_counts, 'w') as f:
-        tk_safe_json.dump_numpy(bc_counters, f)
+    write_barcode_counts_json(bc_counters, outs.barcode_counts)
 
     # Write feature counts
     feature_counts = None
@@ -195,6 +350,11 @@ def join(args, outs, chunk_defs, chunk_outs):
     tmp_reporter.store_chemistry_metadata(args.chemistry_def)
     summary.update(tmp_reporter.to_json())
 
+    # Per-chunk read processing throughput
+    total_reads = sum(chunk_out.num_reads or 0 for chunk_out in chunk_outs)
+    total_sec = sum(chunk_out.elapsed_sec or 0 for chunk_out in chunk_outs)
+    summary['extract_reads_per_sec'] = total_reads / total_sec if total_sec > 0 else None
+
     # Write summary JSON
     with open(outs.summary, 'w') as f:
         tk_safe_json.dump_numpy(summary, f, pretty=True)
@@ -243,7 +403,7 @@ def main(args, outs):
 
     # Determine if barcode sequences need to be reverse complemented.
     with FastqReader(args.read_chunks, bc_read_def, args.reads_interleaved, None, None) as bc_check_rc:
-        barcode_whitelist = cr_utils.load_barcode_whitelist(args.barcode_whitelist, True)
+        barcode_whitelist = cr_utils.load_barcode_whitelist_index(args.barcode_whitelist)
         barcode_rc = infer_barcode_reverse_complement(barcode_whitelist, bc_check_rc.in_iter)
 
     # Log the untrimmed read lengths to stdout
@@ -290,11 +450,10 @@ def main(args, outs):
         feature_reads = FastqFeatureReader(args.read_chunks, feature_extractor,
                                            args.reads_interleaved,
                                            r1_length, r2_length)
+        feature_blocks = feature_reads.iter_pair_blocks(READ_BLOCK_SIZE)
     else:
         feature_reads = FastqReader(None, None, None, r1_length, r2_length)
-
-
-    fastq_readers = (rna_reads, rna_read2s, bc_reads, si_reads, umi_reads, feature_reads)
+        feature_blocks = iter([])
 
     read1_writer = ChunkedFastqWriter(outs.reads, args.reads_per_file, compression=COMPRESSION)
     if paired_end:
@@ -304,107 +463,64 @@ def main(args, outs):
     if not args.augment_fastq:
         tag_writer = ChunkedFastqWriter(outs.tags, args.reads_per_file, compression=COMPRESSION)
 
-    bc_counter = BarcodeCounter(args.barcode_whitelist, outs.barcode_counts)
-
-    all_read_iter = itertools.izip_longest(*[reader.in_iter for reader in fastq_readers])
-
-    EMPTY_READ = (None, '', '')
+    bc_counter = BarcodeCounter(args.barcode_whitelist, outs.chunk_barcode_counts)
+
+    # Parse each input in blocks; the last iterator yields raw pairs for feature extraction
+    block_iters = [reader.iter_blocks(READ_BLOCK_SIZE) for reader in
+                   (rna_reads, rna_read2s, bc_reads, si_reads, umi_reads)] + [feature_blocks]
+    # Blocks are sampled ahead of the reporter, which also draws from the global PRNG,
+    # so downsampling uses its own PRNG to keep results independent of the worker count
+    sampled_blocks = iter_sampled_blocks(block_iters, args.chunk_initial_reads, args.chunk_subsample_rate,
+                                         random.Random(0))
+
+    # Count the input reads as their blocks are handed off for processing
+    outs.num_reads = 0
+    def counted_blocks():
+        for num_block_reads, block in sampled_blocks:
+            outs.num_reads += num_block_reads
+            yield block
+
+    lib_idx = [i for i,x in enumerate(args.library_info) if x['library_id'] == args.library_id][0]
+
+    worker_args = (feature_extractor, barcode_rc, paired_end, args.augment_fastq, r1_length, r2_length)
+    num_procs = martian.get_threads_allocation()
+    pool = None
+    if num_procs > 1:
+        pool = multiprocessing.Pool(num_procs, init_read_block_worker, worker_args)
+    else:
+        init_read_block_worker(*worker_args)
 
     reporter.extract_reads_init()
 
-    for extractions in itertools.islice(all_read_iter, args.chunk_initial_reads):
-        # Downsample
-        if random.random() > args.chunk_subsample_rate:
-            continue
-
-        rna_extraction, rna2_extraction, bc_extraction, si_extraction, umi_extraction, feature_extraction = extractions
-
-        rna_read = rna_extraction if rna_extraction is not None else EMPTY_READ
-        rna_read2 = rna2_extraction if rna2_extraction is not None else EMPTY_READ
-        bc_read = bc_extraction if bc_extraction is not None else EMPTY_READ
-        si_read = si_extraction if si_extraction is not None else EMPTY_READ
-        umi_read = umi_extraction if umi_extraction is not None else EMPTY_READ
-
-        if (not rna_read[1]) or (paired_end and (not rna_read2[1])):
-            # Read 1 is empty or read 2 is empty (if paired_end)
-            # Empty reads causes issue with STAR aligner, so eliminate
-            # them here
-            continue
-
-        validate_concordance(rna_read, rna_read2, bc_read, si_read, umi_read)
-
-        if bc_read != EMPTY_READ:
-            # Reverse complement the barcode if necessary
-            if barcode_rc:
-                bc_read = (bc_read[0], tk_seq.get_rev_comp(bc_read[1]), bc_read[2][::-1])
-            # Track the barcode count distribution
-            bc_counter.count(*bc_read)
-
-        # Calculate metrics on raw sequences
-        lib_idx = [i for i,x in enumerate(args.library_info) if x['library_id'] == args.library_id][0]
-        reporter.raw_fastq_cb(rna_read, rna_read2, bc_read, si_read, umi_read, lib_idx,
-                              skip_metrics=args.skip_metrics)
-
-        # Construct new fastq headers
-        fastq_header1 = AugmentedFastqHeader(rna_read[0])
-        fastq_header1.set_tag(tk_constants.SAMPLE_INDEX_TAG, si_read[1])
-        fastq_header1.set_tag(tk_constants.SAMPLE_INDEX_QUAL_TAG, si_read[2])
-        fastq_header1.set_tag(cr_constants.RAW_BARCODE_TAG, bc_read[1])
-        fastq_header1.set_tag(cr_constants.RAW_BARCODE_QUAL_TAG, bc_read[2])
-        fastq_header1.set_tag(cr_constants.RAW_UMI_TAG, umi_read[1])
-        fastq_header1.set_tag(cr_constants.UMI_QUAL_TAG, umi_read[2])
-
-        feat_raw_bc = None
-        feat_proc_bc = None
-        feat_qual = None
-        feat_ids = None
-
-        if feature_extraction:
-            if feature_extraction.barcode:
-                feat_raw_bc = feature_extraction.barcode
-                feat_qual = feature_extraction.qual
-
-            if len(feature_extraction.ids) > 0:
-                feat_proc_bc = feature_extraction.barcode
-                feat_ids = ';'.join(feature_extraction.ids)
-
-                # If hit a single feature ID, count its frequency
-                if len(feature_extraction.ids) == 1:
-                    feature_counts[feature_extraction.indices[0]] += 1
-
-        if feat_raw_bc:
-            fastq_header1.set_tag(cr_constants.RAW_FEATURE_BARCODE_TAG, feat_raw_bc)
-            fastq_header1.set_tag(cr_constants.FEATURE_BARCODE_QUAL_TAG, feat_qual)
-        if feat_ids:
-            fastq_header1.set_tag(cr_constants.PROCESSED_FEATURE_BARCODE_TAG, feat_proc_bc)
-            fastq_header1.set_tag(cr_constants.FEATURE_IDS_TAG, feat_ids)
-
-        if args.augment_fastq:
-            read1_writer.write((fastq_header1.to_string(), rna_read[1], rna_read[2]))
-        else:
-            read1_writer.write((rna_read[0], rna_read[1], rna_read[2]))
-            tag_writer.write((fastq_header1.to_string(), '', ''))
-
-        if paired_end:
-            fastq_header2 = AugmentedFastqHeader(rna_read2[0])
-            fastq_header2.set_tag(tk_constants.SAMPLE_INDEX_TAG, si_read[1])
-            fastq_header2.set_tag(tk_constants.SAMPLE_INDEX_QUAL_TAG, si_read[2])
-            fastq_header2.set_tag(cr_constants.RAW_BARCODE_TAG, bc_read[1])
-            fastq_header2.set_tag(cr_constants.RAW_BARCODE_QUAL_TAG, bc_read[2])
-            fastq_header2.set_tag(cr_constants.RAW_UMI_TAG, umi_read[1])
-            fastq_header2.set_tag(cr_constants.UMI_QUAL_TAG, umi_read[2])
-
-            if feat_raw_bc:
-                fastq_header2.set_tag(cr_constants.RAW_FEATURE_BARCODE_TAG, feat_raw_bc)
-                fastq_header2.set_tag(cr_constants.FEATURE_BARCODE_QUAL_TAG, feat_qual)
-            if feat_ids:
-                fastq_header2.set_tag(cr_constants.PROCESSED_FEATURE_BARCODE_TAG, feat_proc_bc)
-                fastq_header2.set_tag(cr_constants.FEATURE_IDS_TAG, feat_ids)
-
-            if args.augment_fastq:
-                read2_writer.write((fastq_header2.to_string(), rna_read2[1], rna_read2[2]))
-            else:
-                read2_writer.write((rna_read2[0], rna_read2[1], rna_read2[2]))
+    start_time = time.time()
+    try:
+        for results in map_read_blocks(pool, counted_blocks(), BLOCKS_PER_WORKER * num_procs):
+            for rna_read, rna_read2, bc_read, si_read, umi_read, read1_record, read2_record, tag_record, feature_idx in results:
+                # Track the barcode count distribution
+                if bc_read != EMPTY_READ:
+                    bc_counter.count(*bc_read)
+
+                # Calculate metrics on raw sequences
+                reporter.raw_fastq_cb(rna_read, rna_read2, bc_read, si_read, umi_read, lib_idx,
+                                      skip_metrics=args.skip_metrics)
+
+                if feature_idx is not None:
+                    feature_counts[feature_idx] += 1
+
+                read1_writer.write(read1_record)
+                if tag_record is not None:
+                    tag_writer.write(tag_record)
+                if paired_end:
+                    read2_writer.write(read2_record)
+    finally:
+        # All submitted blocks have been consumed unless an error occurred
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    outs.elapsed_sec = time.time() - start_time
+    print 'Processed %d reads in %0.1f sec (%0.0f reads/sec)' % \
+        (outs.num_reads, outs.elapsed_sec, outs.num_reads / max(outs.elapsed_sec, 1e-6))
 
     reporter.extract_reads_finalize()
 
@@ -415,6 +531,7 @@ def main(args, outs):
     bc_reads.close()
     si_reads.close()
     umi_reads.close()
+    feature_reads.close()
 
     read1_writer.close()
     if paired_end:
@@ -9,7 +9,6 @@ target set that were defined in the optional input feature_reference file.
 
 import martian
 import cellranger.io as cr_io
-import cellranger.utils as cr_utils
 import cellranger.reference as cr_reference
 import cellranger.sample_def as cr_sample_def
 import cellranger.rna.feature_ref as rna_feature_ref
@@ -34,12 +33,12 @@ def main(args, outs):
     outs.target_features = []
     outs.off_target_features = []
 
-    ref_idx = cr_utils.get_reference_genes_index(args.reference_path)
-    ref_gene_index = cr_reference.GeneIndex.load_pickle(ref_idx)
-    gene_name_map = {gene.name: i for i, gene in enumerate(ref_gene_index.genes)}
+    ref_gene_index = cr_reference.load_gene_index(args.reference_path)
+    ref_gene_ids = ref_gene_index.get_gene_ids()
+    gene_name_map = {gene_name: i for i, gene_name in enumerate(ref_gene_index.get_gene_names())}
 
     # keep track of all ints in order to find off-target genes
-    all_gene_ints = {ref_gene_index.gene_id_to_int(x) for x in ref_gene_index.get_gene_ids()}
+    all_gene_ints = {ref_gene_index.gene_id_to_int(x) for x in ref_gene_ids}
     # we keep track of the union of target features for this analysis
     # this union will be what gets sliced out of the count matrix
     union_target_gene_ids = set()
@@ -49,7 +48,7 @@ def main(args, outs):
     if args.feature_reference is not None:
         csv_feature_defs, _ = rna_feature_ref.parse_feature_def_file(
             args.feature_reference,
-            index_offset=len(ref_gene_index.genes))
+            index_offset=len(ref_gene_ids))
         feature_ref_ids = {x.id for x in csv_feature_defs}
         feature_ref_indices = [x.index for x in csv_feature_defs]
         union_target_gene_ids.update(feature_ref_ids)
@@ -75,7 +74,7 @@ def main(args, outs):
     outs.disable_targeted = all(cr_sample_def.get_target_set(sd) is None
                                 for sd in args.sample_def)
     if outs.disable_targeted:
-        all_gene_ids = set(ref_gene_index.get_gene_ids()) | feature_ref_ids
+        all_gene_ids = set(ref_gene_ids) | feature_ref_ids
         # this is used to hook in to the existing gene subsetting functionality of the Matrix object
         cr_io.write_target_features_csv(
             outs.target_gene_ids, all_gene_ids, header='Gene')
@@ -88,7 +87,7 @@ def main(args, outs):
             off_target_features = []
             # TODO: should it be possible to perform analysis only on the target set
             #   when a non-targeted library is combined with a targeted one?
-            union_target_gene_ids.update(set(ref_gene_index.get_gene_ids()))
+            union_target_gene_ids.update(set(ref_gene_ids))
         else:  # targeted library
             target_features = feature_ref_indices[:]
             with open(target_genes_filename, 'r') as fh:
@@ -103,7 +102,7 @@ def main(args, outs):
                         martian.exit('Gene {} not seen in reference'.format(gene_id))
                     j = valid_gene_ints[0]
                     target_features.append(j)
-                    union_target_gene_ids.add(ref_gene_index.genes[j].id)
+                    union_target_gene_ids.add(ref_gene_ids[j])
                 target_features = sorted(target_features)
 
             off_target_features = all_gene_ints - set(target_features)
@@ -2,7 +2,6 @@
 #
 # Copyright (c) 2019 10X Genomics, Inc. All rights reserved.
 #
-from collections import defaultdict
 import itertools
 import json
 import martian
@@ -54,6 +53,7 @@ stage ATTACH_BCS_AND_UMIS(
     in  json     library_info_json,
     in  json     bam_comments_json,
     in  bool     do_skip_translate,
+    in  string   gene_index_tab,
     out bincode chunked_reporter,
 ) using (
     # No index file is generated for the bam.
@@ -73,6 +73,9 @@ def split(args):
     with open(libraries_fn, 'w') as f:
         json.dump(tk_safe_json.json_sanitize(args.library_info), f, indent=4, sort_keys=True)
 
+    # Transcript table for annotate_reads, shared by all chunks
+    gene_index_tab = get_transcript_tsv(args.reference_path)
+
     chunks = []
     for chunk_genome_input, tags, gem_group, library_type, library_id, in itertools.izip_longest(
             args.genome_inputs, args.tags, args.gem_groups, args.library_types, args.library_ids):
@@ -102,6 +105,7 @@ def split(args):
             'library_info_json': libraries_fn,
             'bam_comments_json': bam_comment_fn,
             'do_skip_translate': this_skip_translate,
+            'gene_index_tab': gene_index_tab,
             '__mem_gb': 4,
         })
     join_def = {
@@ -110,9 +114,6 @@ def split(args):
     return {'chunks': chunks, 'join': join_def}
 
 def main(args, outs):
-    gene_index_tab = martian.make_path('gene_index.tab')
-    convert_pickle_to_rust_index(cr_utils.get_reference_genes_index(args.reference_path), gene_index_tab)
-
     if args.barcode_whitelist is None:
         barcode_whitelist = 'null'
     elif not os.path.exists(args.barcode_whitelist):
@@ -132,7 +133,7 @@ def main(args, outs):
         output,
         chunked_reporter,
         args.reference_path,
-        gene_index_tab,
+        args.gene_index_tab,
         args.barcode_counts,
         barcode_whitelist,
         str(args.gem_group),
@@ -191,19 +192,17 @@ def join(args, outs, chunk_defs, chunk_outs):
     print >> sys.stderr, 'Running', ' '.join(cmd)
     tk_subproc.check_call(cmd, cwd=os.getcwd())
 
-def convert_pickle_to_rust_index(pickle_path, out_path):
-    # NOTE: we could possibly avoid this by using serde-pickle
-    # NOTE2: Nope, can't deserialize custom classes apparently.
-    gene_index = cr_reference.GeneIndex.load_pickle(pickle_path)
-    with open(out_path, 'w') as writer:
-        writer.write('\t'.join(["transcript_id", "gene_id", "gene_name", "transcript_length"]))
-
-        # NOTE: It is critical that these genes be in the same order that they are used in
-        # FeatureReference construction (i.e., gene_index.genes)
-        gene2transcripts = defaultdict(list)
-        for (transcript_id, transcript) in gene_index.transcripts.iteritems():
-            gene2transcripts[transcript.gene.id].append((transcript_id, transcript))
-
-        for gene in gene_index.genes:
-            for (transcript_id, transcript) in gene2transcripts[gene.id]:
-                writer.write('\n' + '\t'.join([transcript_id, transcript.gene.id, transcript.gene.name, str(transcript.length)]))
+def get_transcript_tsv(reference_path):
+    """ Get the transcript table consumed by annotate_reads.
+    References built by this version ship the table; for older references it is
+    converted from the gene index once per run. """
+    tsv_path = cr_utils.get_reference_transcripts_tsv(reference_path)
+    if os.path.exists(tsv_path):
+        return tsv_path
+
+    tsv_path = martian.make_path('gene_index.tab')
+    gene_index = cr_reference.load_gene_index(reference_path)
+    if not isinstance(gene_index, cr_reference.BinaryGeneIndex):
+        gene_index = cr_reference.BinaryGeneIndex.from_gene_index(gene_index)
+    gene_index.write_transcript_tsv(tsv_path)
+    return tsv_path
@@ -5,10 +5,13 @@
 # Put BAM file into buckets by (gem group, barcode prefix)
 #
 from collections import OrderedDict
+import heapq
 import itertools
 import martian
 import math
+import numpy as np
 import os
+import pysam
 import tenkit.bam as tk_bam
 import tenkit.stats as tk_stats
 import cellranger.h5_constants as h5_constants
@@ -35,6 +38,13 @@ PYSAM_TO_BAM_COMPRESSION_RATIO = 10.0
 # Empirical observation + 1.25x safety factor
 BAM_ALIGNMENTS_PER_MEM_GB = 750000
 
+# Bound the number of alignments held in memory. Beyond this, each bucket is
+# sorted and spilled to disk as a run, and the runs are merged at the end.
+MAX_BUFFERED_ALIGNMENTS = 6 * BAM_ALIGNMENTS_PER_MEM_GB
+
+# Memory needed by a chunk that spills: the buffer plus merge overhead
+MAX_MEM_GB = 8
+
 def get_mem_gb_request_from_bam(bam_path):
     bytes_on_disk = os.path.getsize(bam_path)
     bytes_in_ram = round(PYSAM_TO_BAM_COMPRESSION_RATIO * bytes_on_disk)
@@ -74,6 +84,8 @@ def split(args):
             mem_gb = get_mem_gb_request_from_bam(chunk_input)
         else:
             mem_gb = get_mem_gb_request_from_num_alignments(num_alignments)
+        # Larger chunks spill to disk instead of using more memory
+        mem_gb = min(mem_gb, MAX_MEM_GB)
 
         chunks.append({
             'chunk_input': chunk_input,
@@ -100,37 +112,80 @@ def main(args, outs):
             bucket_names.append('%s-%d' % (prefix, gg))
     bucket_names.append('')
 
-    # Read all records
-    reads = [read for read in bam_in]
+    # Bucket the records, spilling sorted runs to disk whenever the buffer is full
+    buckets = OrderedDict((bucket_name, []) for bucket_name in bucket_names)
+    spills = {bucket_name: [] for bucket_name in bucket_names}
+    num_buffered = 0
+    for r in bam_in:
+        buckets[get_bucket_name(r, args.nbases)].append(r)
+        num_buffered += 1
+        if num_buffered >= MAX_BUFFERED_ALIGNMENTS:
+            spill_buckets(buckets, spills, bam_in)
+            num_buffered = 0
 
-    # Bucket the records
-    bams_out = {}
     outs.buckets = {}
-    buckets = {}
-    for bucket_name in bucket_names:
+    for bucket_name, bucket in buckets.iteritems():
         filename = martian.make_path("bc-%s.bam" % bucket_name)
         bam_out, _ = tk_bam.create_bam_outfile(filename, None, None, template=bam_in, rgs=args.read_groups, replace_rg=True)
-
-        bams_out[bucket_name] = bam_out
         outs.buckets[bucket_name] = filename
-        buckets[bucket_name] = []
 
-    for r in reads:
-        barcode = cr_utils.get_read_barcode(r)
-        if barcode is None:
-            bucket_name = ''
+        bucket.sort(key=cr_utils.barcode_qname_sort_key)
+        keys_filename = cr_utils.get_sort_keys_path(filename)
+        if len(spills[bucket_name]) == 0:
+            write_bucket(bucket, bam_out, keys_filename)
         else:
-            barcode_seq, gem_group = cr_utils.split_barcode_seq(barcode)
-            prefix = barcode_seq[:args.nbases]
-            bucket_name = '%s-%d' % (prefix, gem_group)
-        buckets[bucket_name].append(r)
-
+            spill_bams = [tk_bam.create_bam_infile(fn) for fn in spills[bucket_name]]
+            write_bucket(merge_sorted_runs(spill_bams + [bucket]), bam_out, keys_filename)
+            for spill_bam, fn in itertools.izip(spill_bams, spills[bucket_name]):
+                spill_bam.close()
+                os.remove(fn)
+        bam_out.close()
+        del bucket[:]
+
+def get_bucket_name(read, nbases):
+    barcode = cr_utils.get_read_barcode(read)
+    if barcode is None:
+        return ''
+    barcode_seq, gem_group = cr_utils.split_barcode_seq(barcode)
+    return '%s-%d' % (barcode_seq[:nbases], gem_group)
+
+def write_bucket(reads, bam_out, keys_filename):
+    """ Write sorted reads to a bucket BAM. Their packed sort keys are saved
+    alongside it for SORT_BY_BC, unless some read's key cannot be packed. """
+    sort_keys = []
+    for r in reads:
+        bam_out.write(r)
+        if sort_keys is not None:
+            try:
+                sort_keys.append(cr_utils.barcode_sort_key_ints(r))
+            except ValueError:
+                sort_keys = None
+    if sort_keys is not None:
+        np.save(keys_filename, np.array(sort_keys, dtype=np.uint64).reshape(-1, 2))
+
+def spill_buckets(buckets, spills, template):
+    """ Sort each non-empty bucket and write it to an uncompressed BAM run. """
     for bucket_name, bucket in buckets.iteritems():
-        bucket.sort(key=cr_utils.barcode_sort_key)
-        bam_out = bams_out[bucket_name]
+        if len(bucket) == 0:
+            continue
+        bucket.sort(key=cr_utils.barcode_qname_sort_key)
+        filename = martian.make_path("spill-%s-%d.bam" % (bucket_name, len(spills[bucket_name])))
+        spill_bam = pysam.Samfile(filename, 'wbu', template=template)
         for r in bucket:
-            bam_out.write(r)
-        bam_out.close()
+            spill_bam.write(r)
+        spill_bam.close()
+        spills[bucket_name].append(filename)
+        del bucket[:]
+
+def merge_sorted_runs(runs):
+    """ K-way merge of sorted runs of reads (open BAMs or lists).
+    Ties are broken by run order, then position within the run,
+    so the result matches a stable sort of the concatenated input. """
+    def keyed_run(run_idx, run):
+        for i, r in enumerate(run):
+            yield cr_utils.barcode_qname_sort_key(r), run_idx, i, r
+    for _, _, _, r in heapq.merge(*[keyed_run(run_idx, run) for run_idx, run in enumerate(runs)]):
+        yield r
 
 def join(args, outs, chunk_defs, chunk_outs):
     outs.coerce_strings()
@@ -108,8 +108,7 @@ def join(args, outs, chunk_defs, chunk_outs):
         gem_group, lib = chunk_def.gem_group, chunk_def.library_type
         sampled_barcodes[gem_group][lib].extend(chunk_out.sampled_barcodes)
 
-    barcodes_in_whitelist = cr_utils.load_barcode_whitelist(args.barcode_whitelist, as_set=True)
-    barcode_translate_map = cr_utils.load_barcode_translate_map(args.barcode_whitelist)
+    whitelist_index = cr_utils.load_barcode_whitelist_index(args.barcode_whitelist)
 
     sampled_bc_counter_in_wl = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
 
@@ -118,7 +117,8 @@ def join(args, outs, chunk_defs, chunk_outs):
         for lib in sampled_barcodes[gem_group]:
             sampled_bc = sampled_barcodes[gem_group][lib]
             unique_bc = set(sampled_bc)
-            unique_bc_in_wl = unique_bc.intersection(barcodes_in_whitelist)
+            unique_bc_list = list(unique_bc)
+            unique_bc_in_wl = set(bc for bc, in_wl in zip(unique_bc_list, whitelist_index.contains(unique_bc_list)) if in_wl)
 
             outs.barcode_compatibility_info[gem_group][lib] = {}
             outs.barcode_compatibility_info[gem_group][lib]['num_barcodes_sampled'] = len(sampled_bc)
@@ -161,8 +161,9 @@ def join(args, outs, chunk_defs, chunk_outs):
             outs.skip_translate[gem_group][lib] = True
 
             # with translate
-            if (lib != GENE_EXPRESSION_LIBRARY_TYPE) and (barcode_translate_map is not None):
-                translated_counter = {barcode_translate_map.get(k,k) : v for (k,v) in lib_counter.iteritems()}
+            if (lib != GENE_EXPRESSION_LIBRARY_TYPE) and whitelist_index.has_translation():
+                lib_bcs, lib_counts = lib_counter.keys(), lib_counter.values()
+                translated_counter = dict(zip(whitelist_index.translate(lib_bcs), lib_counts))
                 overlap_size_translated = len(set(base_lib_counter).intersection(set(translated_counter)))
                 cosine_sim_translated = robust_cosine_similarity(base_lib_counter, translated_counter)
 
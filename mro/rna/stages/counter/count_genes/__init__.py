@@ -6,6 +6,7 @@ import martian
 import tenkit.bam as tk_bam
 import cellranger.chemistry as cr_chem
 import cellranger.constants as cr_constants
+import cellranger.h5_storage as cr_h5_storage
 import cellranger.io as cr_io
 import cellranger.rna.feature_ref as rna_feature_ref
 import cellranger.matrix as cr_matrix
@@ -50,8 +51,9 @@ def split(args):
             '__mem_gb': 8,
         })
 
-    # FIXME: Need two copies of the matrix, but we don't have matrices yet
-    #        Consider using info from MARK_DUPLICATES and the whitelists
+    # Chunk matrices are merged block-wise on disk; only the merged matrix
+    # is loaded (for MEX output).
+    # FIXME: Consider using info from MARK_DUPLICATES and the whitelists
     #          to estimate the matrix memory size.
     join_def = {
         '__mem_gb': 12,
@@ -60,11 +62,15 @@ def split(args):
 
 def join_matrices(args, outs, chunk_defs, chunk_outs):
     chunk_h5s = [chunk_out.matrices_h5 for chunk_out in chunk_outs]
-    matrix = cr_matrix.merge_matrices(chunk_h5s)
+    matrix_attrs = cr_matrix.make_matrix_attrs_count(args.sample_id, args.gem_groups, cr_chem.get_description(args.chemistry_def))
+    cr_matrix.merge_matrices_h5(chunk_h5s, outs.matrices_h5, extra_attrs=matrix_attrs, sw_version=martian.get_pipelines_version(),
+                                storage_profile=cr_h5_storage.DELIVERABLE_STORAGE_PROFILE)
+
+    matrix = cr_matrix.CountMatrix.load_h5_file(outs.matrices_h5)
     if args.is_antibody_only:
         matrix = matrix.select_features_by_type(rna_library.ANTIBODY_LIBRARY_TYPE)
-    matrix_attrs = cr_matrix.make_matrix_attrs_count(args.sample_id, args.gem_groups, cr_chem.get_description(args.chemistry_def))
-    matrix.save_h5_file(outs.matrices_h5, extra_attrs=matrix_attrs, sw_version=martian.get_pipelines_version())
+        matrix.save_h5_file(outs.matrices_h5, extra_attrs=matrix_attrs, sw_version=martian.get_pipelines_version(),
+                            storage_profile=cr_h5_storage.DELIVERABLE_STORAGE_PROFILE)
 
     rna_matrix.save_mex(matrix,
                         outs.matrices_mex,
@@ -95,7 +101,7 @@ def main(args, outs):
     barcode_summary = cr_utils.load_barcode_tsv(args.barcodes_detected) if not barcode_whitelist else None
 
     # TODO: this is redundant
-    gene_index = cr_reference.GeneIndex.load_pickle(cr_utils.get_reference_genes_index(args.reference_path))
+    gene_index = cr_reference.load_gene_index(args.reference_path)
     reporter = cr_report.Reporter(reference_path=args.reference_path,
                                   high_conf_mapq=cr_utils.get_high_conf_mapq(args.align),
                                   gene_index=gene_index,
@@ -119,7 +125,7 @@ def main(args, outs):
     else:
         barcode_seqs = barcode_summary
 
-    matrix = cr_matrix.CountMatrix.empty(feature_ref, barcode_seqs, dtype='int32')
+    matrix_builder = cr_matrix.CountMatrixBuilder(feature_ref, barcode_seqs, dtype='int32')
 
     for _, reads_iter, _ in cr_utils.iter_by_qname(in_bam, None):
         is_conf_mapped_deduped, _, feature_id, bc = reporter.count_genes_bam_cb(reads_iter,
@@ -127,11 +133,13 @@ def main(args, outs):
                                                                                      library_prefixes,
                                                                                      use_umis=cr_chem.has_umis(args.chemistry_def))
         if is_conf_mapped_deduped:
-            matrix.add(feature_id, bc)
+            matrix_builder.add(feature_id, bc)
 
     in_bam.close()
 
     reporter.store_reference_metadata(args.reference_path, cr_constants.REFERENCE_TYPE, cr_constants.REFERENCE_METRIC_PREFIX)
 
-    matrix.save_h5_file(outs.matrices_h5, sw_version=martian.get_pipelines_version())
+    matrix = matrix_builder.build()
+    matrix.save_h5_file(outs.matrices_h5, sw_version=martian.get_pipelines_version(),
+                        storage_profile=cr_h5_storage.SCRATCH_STORAGE_PROFILE)
     reporter.save(outs.chunked_reporter)
@@ -12,6 +12,7 @@ import tenkit.safe_json as tk_safe_json
 import cellranger.chemistry as cr_chem
 import cellranger.matrix as cr_matrix
 import cellranger.constants as cr_constants
+import cellranger.h5_storage as cr_h5_storage
 import cellranger.rna.matrix as rna_matrix
 import cellranger.rna.library as rna_library
 import cellranger.rna.report_matrix as rna_report_mat
@@ -23,6 +24,9 @@ from cellranger.cell_calling_helpers import FilterMethod
 
 FILTER_BARCODES_MIN_MEM_GB = 2.0
 
+# Processes used to simulate ambient log-likelihoods for non-ambient cell calling
+FILTER_BARCODES_THREADS = 4
+
 __MRO__ = """
 stage FILTER_BARCODES(
     in  string sample_id,
@@ -61,6 +65,7 @@ def split(args):
         'chunks': [],
         'join': {
             '__mem_gb': mem_gb,
+            '__threads': FILTER_BARCODES_THREADS,
         }
     }
 
@@ -73,7 +78,8 @@ def join(args, outs, _chunk_defs, _chunk_outs):
     filtered_matrix = filter_barcodes(args, outs)
 
     matrix_attrs = cr_matrix.make_matrix_attrs_count(args.sample_id, args.gem_groups, cr_chem.get_description(args.chemistry_def))
-    filtered_matrix.save_h5_file(outs.filtered_matrices_h5, extra_attrs=matrix_attrs, sw_version=martian.get_pipelines_version())
+    filtered_matrix.save_h5_file(outs.filtered_matrices_h5, extra_attrs=matrix_attrs, sw_version=martian.get_pipelines_version(),
+                                 storage_profile=cr_h5_storage.DELIVERABLE_STORAGE_PROFILE)
 
     rna_matrix.save_mex(filtered_matrix,
                         outs.filtered_matrices_mex,
@@ -159,7 +165,8 @@ def filter_barcodes(args, outs):
                 rna_library.GENE_EXPRESSION_LIBRARY_TYPE)
             filtered_bcs_groups, nonambient_summary = helpers.call_additional_cells(full_gex_matrix,
                                                                                     unique_gem_groups,
-                                                                                    genomes, filtered_bcs_groups)
+                                                                                    genomes, filtered_bcs_groups,
+                                                                                    num_procs=martian.get_threads_allocation())
             nonambient_summary.to_csv(outs.nonambient_calls)
 
         # Record all filtered barcodes
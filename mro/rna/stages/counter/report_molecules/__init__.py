@@ -5,14 +5,14 @@
 """ Report info on each detected molecule
 """
 
-from collections import defaultdict, OrderedDict, Counter
+from collections import Counter
 import itertools
 import math
-import numpy as np
 import tenkit.bam as tk_bam
 import tenkit.stats as tk_stats
 from tenkit.safe_json import safe_jsonify
 import cellranger.constants as cr_constants
+import cellranger.h5_storage as cr_h5_storage
 import cellranger.molecule_counter as cr_mol_counter
 from cellranger.molecule_counter import MoleculeCounter
 import cellranger.report as cr_report
@@ -65,12 +65,10 @@ def split(args):
     else:
         chunk_mem_gb = 1
 
-    # Memory for concatenating molecule info
-    # N = total number of rows
-    # 8*N bytes to store the sort indices
-    # (8+8+8)*N bytes to load, concatenate, and index into a 64-bit data column
-    mol_info_mem_gb = int(math.ceil((32 * mol_info_rows)/2.5e8))
-    join_mem_gb = min(MAX_MEM_GB, max(4, mol_info_mem_gb))
+    # Memory for concatenating molecule info.
+    # The columns are copied in fixed-size blocks, so only the barcode row index
+    # (at most one 18-byte entry per row) grows with the number of rows.
+    join_mem_gb = min(MAX_MEM_GB, max(4, int(math.ceil((18 * mol_info_rows)/1e9))))
 
     chunks = []
     for chunk_input in args.inputs:
@@ -87,8 +85,8 @@ def main(args, outs):
     outs.coerce_strings()
 
     # Load whitelist
-    whitelist = cr_utils.load_barcode_whitelist(args.barcode_whitelist)
-    barcode_to_idx = OrderedDict((k, i) for i,k in enumerate(whitelist))
+    whitelist_index = cr_utils.load_barcode_whitelist_index(args.barcode_whitelist)
+    whitelist = whitelist_index.get_barcodes()
 
     # Load library info from BAM
     in_bam = tk_bam.create_bam_infile(args.chunk_input)
@@ -113,14 +111,15 @@ def main(args, outs):
     # Create the barcode info
     barcode_info = MoleculeCounter.build_barcode_info(filtered_bcs_by_genome,
                                                       library_info,
-                                                      whitelist)
+                                                      whitelist_index)
 
     # Create the molecule info file
     mc = MoleculeCounter.open(outs.output, mode='w',
                               feature_ref=feature_ref,
                               barcodes=whitelist,
                               library_info=library_info,
-                              barcode_info=barcode_info)
+                              barcode_info=barcode_info,
+                              storage_profile=cr_h5_storage.SCRATCH_STORAGE_PROFILE)
 
     # Initialize per-library metrics
     lib_metrics = {}
@@ -131,7 +130,10 @@ def main(args, outs):
             lib_metrics[str(lib_idx)][cr_mol_counter.ON_TARGET_USABLE_READS_METRIC] = 0
 
     # Record read-counts per molecule. Note that UMIs are not contiguous
-    # in the input because no sorting was done after UMI correction.
+    # in the input because no sorting was done after UMI correction,
+    # so reads are buffered and collapsed into molecules in large blocks.
+    mol_buffer = cr_mol_counter.MoleculeReadBuffer()
+    umi_bits = MoleculeCounter.get_column_dtype('umi').itemsize*8
 
     prev_gem_group = None
     prev_barcode_idx = None
@@ -141,7 +143,9 @@ def main(args, outs):
         if barcode_seq is None:
             continue
 
-        barcode_idx = barcode_to_idx[barcode_seq]
+        barcode_idx = whitelist_index.get_index(barcode_seq)
+        if barcode_idx is None:
+            raise KeyError(barcode_seq)
 
         # Assert expected sort order of input BAM
         assert gem_group >= prev_gem_group
@@ -150,7 +154,10 @@ def main(args, outs):
 
         is_cell_barcode = cr_utils.format_barcode_seq(barcode_seq, gem_group) in filtered_bc_union
 
-        counts = defaultdict(int)
+        # Flush only between barcodes so that no molecule is split across blocks
+        if mol_buffer.is_full():
+            mol_buffer.flush(mc)
+        mol_buffer.start_barcode(gem_group, barcode_idx)
 
         for read in reads_iter:
             # ignore read2 to avoid double-counting. the mapping + annotation should be equivalent.
@@ -164,7 +171,7 @@ def main(args, outs):
             if umi_seq is None:
                 continue
 
-            umi_int = MoleculeCounter.compress_umi_seq(umi_seq, MoleculeCounter.get_column_dtype('umi').itemsize*8)
+            umi_int = MoleculeCounter.compress_umi_seq(umi_seq, umi_bits)
 
             feature_ids = cr_utils.get_read_gene_ids(read)
             assert len(feature_ids) == 1
@@ -172,7 +179,7 @@ def main(args, outs):
 
             library_idx = cr_utils.get_read_library_index(read)
 
-            counts[(umi_int, library_idx, feature_int)] += 1
+            mol_buffer.add_read(umi_int, library_idx, feature_int)
 
             if is_cell_barcode:
                 lib_metrics[str(library_idx)][cr_mol_counter.USABLE_READS_METRIC] += 1
@@ -182,38 +189,7 @@ def main(args, outs):
             prev_gem_group = gem_group
             prev_barcode_idx = barcode_idx
 
-        # Record data for this barcode
-        gg_int = MoleculeCounter.get_column_dtype('gem_group').type(gem_group)
-        mc.append_column('gem_group', np.repeat(gg_int, len(counts)))
-        bc_int = MoleculeCounter.get_column_dtype('barcode_idx').type(barcode_idx)
-        mc.append_column('barcode_idx', np.repeat(bc_int, len(counts)))
-
-        feature_ints = np.fromiter((k[2] for k in counts.iterkeys()),
-                                   dtype=MoleculeCounter.get_column_dtype('feature_idx'),
-                                   count=len(counts))
-        # Sort by feature for fast matrix construction
-        order = np.argsort(feature_ints)
-        feature_ints = feature_ints[order]
-        mc.append_column('feature_idx', feature_ints)
-        del feature_ints
-
-        li_ints = np.fromiter((k[1] for k in counts.iterkeys()),
-                               dtype=MoleculeCounter.get_column_dtype('library_idx'),
-                               count=len(counts))[order]
-        mc.append_column('library_idx', li_ints)
-        del li_ints
-
-        umi_ints = np.fromiter((k[0] for k in counts.iterkeys()),
-                               dtype=MoleculeCounter.get_column_dtype('umi'),
-                               count=len(counts))[order]
-        mc.append_column('umi', umi_ints)
-        del umi_ints
-
-        count_ints = np.fromiter(counts.itervalues(),
-                                 dtype=MoleculeCounter.get_column_dtype('count'),
-                                 count=len(counts))[order]
-        mc.append_column('count', count_ints)
-        del count_ints
+    mol_buffer.flush(mc)
 
     in_bam.close()
 
@@ -255,7 +231,8 @@ def join(args, outs, chunk_defs, chunk_outs):
         for lib_key, value in summed_lib_metrics.iteritems():
             metrics[cr_mol_counter.LIBRARIES_METRIC][lib_key][chunk_metric] = value
 
-    MoleculeCounter.concatenate(outs.output, input_h5_filenames, metrics=metrics)
+    MoleculeCounter.concatenate(outs.output, input_h5_filenames, metrics=metrics,
+                                storage_profile=cr_h5_storage.DELIVERABLE_STORAGE_PROFILE)
 
     # write out targeting specific metrics
     with MoleculeCounter.open(outs.output, 'r') as mc:
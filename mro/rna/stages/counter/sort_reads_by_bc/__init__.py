@@ -5,9 +5,14 @@
 # Sort BAM file by sorting buckets, then concatenating bucket files
 #
 import heapq
+import itertools
+import math
+import numpy as np
+import os
 import pysam
 import tenkit.bam as tk_bam
 import tenkit.cache as tk_cache
+import cellranger.h5_constants as h5_constants
 import cellranger.utils as cr_utils
 
 __MRO__ = """
@@ -25,25 +30,97 @@ stage SORT_BY_BC(
 def split(args):
     chunks = []
     for prefix, bucket in args.buckets.iteritems():
-        chunks.append({
+        chunk = {
             'prefix': prefix,
             'bucket': bucket,
-        })
+        }
+        if has_sort_keys(bucket):
+            # 16 bytes per read for the keys, plus sorting and ranking them
+            keys_bytes = sum(os.path.getsize(cr_utils.get_sort_keys_path(fn)) for fn in bucket)
+            chunk['__mem_gb'] = max(h5_constants.MIN_MEM_GB, int(math.ceil(4 * keys_bytes / 1e9)))
+        chunks.append(chunk)
     return {'chunks': chunks}
 
+def has_sort_keys(bam_filenames):
+    return all(os.path.exists(cr_utils.get_sort_keys_path(fn)) for fn in bam_filenames)
+
 def main(args, outs):
     outs.coerce_strings()
     bam_in = tk_bam.create_bam_infile(args.bucket[0])
     bam_out, _ = tk_bam.create_bam_outfile(outs.default, None, None, template=bam_in)
     bam_in.close()
 
-    outs.total_reads = merge_by_key(args.bucket, bc_and_qname_sort_key, bam_out)
+    if has_sort_keys(args.bucket):
+        outs.total_reads = merge_by_sort_keys(args.bucket, bam_out)
+    else:
+        outs.total_reads = merge_by_key(args.bucket, cr_utils.barcode_qname_sort_key, bam_out)
     bam_out.close()
 
-def bc_and_qname_sort_key(read):
-    # Maintain qname ordering within each BC
-    bc_key = cr_utils.barcode_sort_key(read)
-    return (bc_key, read.qname)
+def rank_sort_keys(bam_filenames):
+    """ Load the packed sort keys of each BAM and replace them with dense ranks
+    shared across all of the BAMs, so each read has a single integer key. """
+    keys = [np.load(cr_utils.get_sort_keys_path(fn)) for fn in bam_filenames]
+    all_keys = np.concatenate(keys)
+    order = np.lexsort((all_keys[:, 1], all_keys[:, 0]))
+    sorted_keys = all_keys[order]
+    is_new_key = np.ones(len(order), dtype=bool)
+    is_new_key[1:] = np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1)
+    del all_keys, sorted_keys
+
+    all_ranks = np.empty(len(order), dtype=np.int64)
+    all_ranks[order] = np.cumsum(is_new_key) - 1
+    offsets = np.cumsum([0] + [len(k) for k in keys])
+    return [all_ranks[start:end] for start, end in itertools.izip(offsets[:-1], offsets[1:])]
+
+def merge_by_sort_keys(bam_filenames, bam_out):
+    """ Merge BAMs sorted by barcode_qname_sort_key using their packed sort keys.
+    Whole runs of reads whose keys precede every other BAM's next key are copied
+    without computing any per-read key. Reads whose packed keys are tied across
+    BAMs are ordered by qname. """
+    file_cache = tk_cache.FileHandleCache(mode='rb', open_func=pysam.Samfile)
+    ranks = rank_sort_keys(bam_filenames)
+    positions = [0] * len(bam_filenames)
+    total_reads = 0
+
+    heap = [(r[0], i) for i, r in enumerate(ranks) if len(r) > 0]
+    heapq.heapify(heap)
+
+    def advance(i, end):
+        reads = itertools.islice(file_cache.get(bam_filenames[i]), end - positions[i])
+        positions[i] = end
+        if end < len(ranks[i]):
+            heapq.heappush(heap, (ranks[i][end], i))
+        return reads
+
+    while len(heap) > 0:
+        rank, i = heapq.heappop(heap)
+
+        if len(heap) > 0 and heap[0][0] == rank:
+            # Identical packed keys in several BAMs; fall back to comparing qnames
+            tied = [i]
+            while len(heap) > 0 and heap[0][0] == rank:
+                tied.append(heapq.heappop(heap)[1])
+            group = []
+            for j in sorted(tied):
+                end = np.searchsorted(ranks[j], rank, side='right')
+                group.extend(advance(j, end))
+            group.sort(key=lambda read: read.qname)
+            for read in group:
+                bam_out.write(read)
+            total_reads += len(group)
+
+        else:
+            # Copy everything up to the next BAM's first key
+            if len(heap) > 0:
+                end = np.searchsorted(ranks[i], heap[0][0], side='left')
+            else:
+                end = len(ranks[i])
+            num_reads = end - positions[i]
+            for read in advance(i, end):
+                bam_out.write(read)
+            total_reads += num_reads
+
+    return total_reads
 
 def merge_by_key(bam_filenames, key_func, bam_out):
     file_cache = tk_cache.FileHandleCache(mode='rb', open_func=pysam.Samfile)